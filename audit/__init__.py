@@ -1,6 +1,22 @@
+from array import array
 from datetime import datetime as dt
 from hashlib import md5
 
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# Integer timestamp of the Unix epoch, converting between get_tm values and datetime64[us]
+TM_EPOCH_OFFSET = dt(1970, 1, 1).toordinal() * 86400 * 1000000
+
+# Signed 64 bit array typecode; 'q' is not available before Python 3.3
+try:
+	array('q')
+	INT64_TYPECODE = 'q'
+except ValueError:
+	INT64_TYPECODE = 'l'
+
 def get_tm(d=None):
 	"""
 	Converts a datetime to an integer
@@ -11,21 +27,42 @@ def get_tm(d=None):
 
 def from_tm(t):
 	"""
-	Converts an integer to a datetime
+	Converts an integer to a datetime, using integer arithmetic only so that no precision is lost
 	"""
-	def extract(val, modulo):
-		num = val % modulo
-		return ((val-num)/modulo, num)
-
-	microseconds = t - (t/1000000)*1000000
-	tt = (t - microseconds)/1000000
-	(tt, seconds) = extract(tt, 60)
-	(tt, minutes) = extract(tt, 60)
-	(tt, hours) = extract(tt, 24)
+	(seconds, microseconds) = divmod(int(t), 1000000)
+	(days, seconds) = divmod(seconds, 86400)
+	(hours, seconds) = divmod(seconds, 3600)
+	(minutes, seconds) = divmod(seconds, 60)
 
-	d = dt.fromordinal(tt)
+	d = dt.fromordinal(days)
 	return dt(d.year, d.month, d.day, hours, minutes, seconds, microseconds)
 
+def get_tm_batch(values):
+	"""
+	Converts many datetimes to integers.
+
+	Accepts a NumPy datetime64 array or a sequence of datetimes.  Returns a NumPy int64 array,
+	or an array of signed 64 bit integers if NumPy is not installed
+	"""
+	if np is None:
+		return array(INT64_TYPECODE, (get_tm(d) for d in values))
+
+	if not (isinstance(values, np.ndarray) and values.dtype.kind == 'M'):
+		values = np.array(values, dtype='datetime64[us]')
+	return values.astype('datetime64[us]').astype(np.int64) + TM_EPOCH_OFFSET
+
+def from_tm_batch(values):
+	"""
+	Converts many integers to datetimes.
+
+	Accepts a NumPy integer array or a sequence of integers.  Returns a NumPy datetime64[us] array,
+	or a list of datetimes if NumPy is not installed
+	"""
+	if np is None:
+		return [from_tm(t) for t in values]
+
+	return (np.asarray(values, dtype=np.int64) - TM_EPOCH_OFFSET).astype('datetime64[us]')
+
 
 def create_hash(separator='|', *items):
 	"""Helper that creates a hash from the supplied items"""
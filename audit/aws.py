@@ -1,69 +1,346 @@
-from boto.dynamodb2 import regions
-from boto.dynamodb2.table import Table
-from boto.dynamodb2.layer1 import DynamoDBConnection
-from audit import get_tm, create_hash
+from audit import get_tm
+from audit.backends.dynamodb import DynamoDBBackend
+from audit.buffer import WriteBehindBuffer, BufferFull
+from audit.cache import LRUCache, QueryCache, CachedQueryBackend
+from audit.changes import CHANGES_FIELD, DEFAULT_INLINE_LIMIT, encode_changes, decode_changes
+from audit.hashing import KeyHasher, shard_key, record_shard
+from audit.idempotency import IdempotencyKeys, NEW, POSSIBLE, DUPLICATE, PENDING, marker_item
+from audit.metrics import SAVE_STAGE_SECONDS, BATCH_STAGE_SECONDS
+from audit.ratelimit import RateLimiter, RateLimitedBackend
+from audit.rollup import RollupCounters, aggregate, hour_of, rollup_hash, rollup_item, rollup_from_item
+from audit.tail import TailFeed
+from audit.query import RecordStream, MergedRecordStream, CursorError, record_from_item
+from audit.record import AuditRecord, ITEM_ENCODINGS
+from audit.schema import Field, ValidationError, compile_schema, validate_batch
+import atexit
+from functools import partial
+from threading import Lock
+from time import time
 from uuid import uuid4 as uuid
 
-class ValidationError(Exception):
+class SaveError(Exception):
 	pass
 
-class SaveError(Exception):
+class SaveInProgress(SaveError):
+	"""Raised for a save repeating the idempotency key of a save still in progress, which may be retried"""
 	pass
 
+# Distinguishes a cache miss from a cached None
+_MISSING = object()
+
+# Number of items read from storage at a time by record queries
+QUERY_PAGE_SIZE = 100
+
+# Maximum number of hash keys a single investigation may query
+MAX_INVESTIGATION_KEYS = 1000
+
+# Longest time a tail may wait for new records, in seconds
+MAX_TAIL_TIMEOUT = 60
+
+# Supported acknowledgement modes for write-behind saves
+WRITE_ACK_MODES = ('enqueue', 'flush')
+
+# Longest identifier, longest organisation detail, and longest idempotency key, accepted in a payload
+MAX_ID_LENGTH = 1024
+MAX_DETAIL_LENGTH = 256
+MAX_IDEMPOTENCY_KEY_LENGTH = 256
+
+# Validators of the organisation registration and audit record payloads
+validate_register_data = compile_schema([
+	Field('name', 'S', max_length=MAX_DETAIL_LENGTH),
+	Field('contact', 'S', max_length=MAX_DETAIL_LENGTH),
+	Field('website', 'S', max_length=MAX_DETAIL_LENGTH),
+])
+
+validate_save_record = compile_schema([
+	Field('timestamp', 'N'),
+	Field('obo_id', 'S', max_length=MAX_ID_LENGTH),
+	Field('actor_id', 'S', max_length=MAX_ID_LENGTH),
+	CHANGES_FIELD,
+	Field('idempotency_key', 'S', required=False, max_length=MAX_IDEMPOTENCY_KEY_LENGTH),
+])
+
 class Audit(object):
 	"""
-	Provides all the functionality required to validate and save data into AWS
+	Provides all the functionality required to validate and save data into AWS,
+	or into one of the other storage backends
 	"""
-	def __init__(self):
+	def __init__(self, org_cache_size=4096, org_cache_ttl=60, org_negative_ttl=5,
+					hash_version=1, read_hash_versions=None, hash_cache_size=65536,
+					tail_buffer_size=1024, tail_max_keys=4096):
 		self.connected = False
-		self.conn = None
+		self.backend = None
 		self.prefix = None
-		self.tables = {}
+
+		# Org status by org_id; None records an org known not to exist
+		self.org_cache = LRUCache(org_cache_size, org_cache_ttl)
+		self.org_negative_ttl = org_negative_ttl
+
+		# Creates the hash keys of Audit items; reads query the write version, and any others given
+		self.hasher = KeyHasher(hash_version, read_hash_versions, hash_cache_size)
+
+		# Number of write shards by (org_id, service_id), for pairs spread over several hash keys
+		self.write_shards = {}
+
+		# Encoding of new Audit items; reads accept any
+		self.item_encoding = 'full'
+
+		# Optional write-behind buffering of Audit items
+		self.write_buffer = None
+		self.write_ack = None
+
+		# Optional client-side rate limiting of storage requests, by table
+		self.rate_limiter = None
+
+		# Optional read-through cache of Audit query pages, and the arguments of its backend view
+		self.query_cache = None
+		self.query_cache_args = None
+
+		# Records saved by this process, for tails of org/service pairs
+		self.tail_feed = TailFeed(tail_buffer_size, tail_max_keys)
+
+		# Optional hourly rollup counters, flushed to the Rollup table in the background
+		self.rollups = None
+
+		# Optional store of change payloads too large to hold in their Audit items
+		self.blob_store = None
+		self.changes_inline_limit = DEFAULT_INLINE_LIMIT
+
+		# Optional deduplication of saves by idempotency key, and how long keys are kept in storage, in seconds
+		self.idempotency = None
+		self.idempotency_window = None
+
+	def enable_write_behind(self, ack='enqueue', max_size=10000, batch_size=100, max_age=0.05, put_timeout=1.0,
+					retries=3, retry_backoff=0.1, dead_letter_path=None):
+		"""
+		Queue Audit items for background batch writing, rather than writing during the save.
+
+		ack determines when a save returns: 'enqueue' once the item is queued, 'flush' once it is written.
+		Items that cannot be written once retried are appended to dead_letter_path, when given
+		"""
+		if ack not in WRITE_ACK_MODES:
+			raise ValueError('Write ack mode must be one of {}'.format(', '.join(WRITE_ACK_MODES)))
+		if self.write_buffer is not None:
+			raise Exception('Write-behind already enabled')
+
+		self.write_ack = ack
+		self.write_buffer = WriteBehindBuffer(
+					lambda items: self._batch_save_to_table('Audit', items),
+					max_size=max_size,
+					batch_size=batch_size,
+					max_age=max_age,
+					put_timeout=put_timeout,
+					retries=retries,
+					retry_backoff=retry_backoff,
+					dead_letter_path=dead_letter_path)
+		self.write_buffer.start()
+
+		# Don't lose queued items on a clean exit
+		atexit.register(self.disable_write_behind)
+
+	def disable_write_behind(self):
+		"""
+		Flush any queued items and revert to synchronous saves
+		"""
+		write_buffer, self.write_buffer = self.write_buffer, None
+		if write_buffer is not None:
+			write_buffer.stop()
+
+	def enable_rollups(self, interval=10.0):
+		"""
+		Count saved records by org, service and hour, adding the counts to the Rollup table every interval seconds
+		"""
+		if self.rollups is not None:
+			raise Exception('Rollups already enabled')
+		self.rollups = RollupCounters(self._flush_rollup, interval)
+		self.rollups.start()
+
+		# Don't lose counts on a clean exit
+		atexit.register(self.disable_rollups)
+
+	def disable_rollups(self):
+		"""
+		Flush any pending counts and stop counting
+		"""
+		rollups, self.rollups = self.rollups, None
+		if rollups is not None:
+			rollups.stop()
+
+	def flush_and_stop(self):
+		"""
+		Flush queued saves and pending rollup counts, stopping their background threads
+		"""
+		self.disable_write_behind()
+		self.disable_rollups()
+
+	def _flush_rollup(self, org_id, service_id, hour, count, obo_count):
+		"""
+		Adds the counts of a bucket to the Rollup table
+
+		Internal use only
+		"""
+		self._get_backend().increment('Rollup', {'org-service_id': rollup_hash(org_id, service_id), 'hour': hour},
+					{'count': count, 'obo_count': obo_count})
+
+	def enable_rate_limiting(self, rates=None, default_rate=10, deadline=5.0, **limiter_args):
+		"""
+		Limit the rate of storage requests to each table, adapting it to the throttles reported by storage.
+
+		rates gives the initial requests per second of each table, typically its provisioned capacity.
+		Throttled requests are retried until deadline seconds have passed
+		"""
+		self.rate_limiter = RateLimiter(rates, default_rate, deadline, **limiter_args)
+		if self.backend is not None:
+			self.backend.set_throttle_listener(self.rate_limiter.throttled)
+
+	def disable_rate_limiting(self):
+		"""
+		Remove the rate limits; throttled requests then fail
+		"""
+		self.rate_limiter = None
+		if self.backend is not None:
+			self.backend.set_throttle_listener(None)
+
+	def rate_limit_stats(self):
+		"""
+		Returns the current rate, throttle and retry counts of each table, when rate limiting is enabled
+		"""
+		return self.rate_limiter.stats() if self.rate_limiter is not None else {}
+
+	def enable_query_cache(self, max_bytes=64 * 1024 * 1024, open_ttl=5, closed_ttl=3600, closed_after=300):
+		"""
+		Cache Audit query pages in up to max_bytes of memory, invalidating them on saves by this process.
+
+		Pages of time ranges that ended over closed_after seconds ago are kept for closed_ttl seconds, and others
+		for open_ttl seconds, which bounds how long saves by other processes go unseen
+		"""
+		self.query_cache = QueryCache(max_bytes)
+		self.query_cache_args = {'open_ttl': open_ttl, 'closed_ttl': closed_ttl, 'closed_after': closed_after}
+
+	def disable_query_cache(self):
+		"""
+		Remove the query cache; queries then always read storage
+		"""
+		self.query_cache = None
+
+	def cache_stats(self):
+		"""
+		Returns the hit/miss counters of the in-process caches
+		"""
+		stats = {'org': self.org_cache.stats(), 'hash': self.hasher.stats()}
+		query_cache = self.query_cache
+		if query_cache is not None:
+			stats['query'] = query_cache.stats()
+		return stats
+
+	def enable_idempotency(self, capacity=100000, error_rate=0.001, recent_size=10000, window=86400, check_storage=False):
+		"""
+		Acknowledge saves of records whose idempotency key was already saved, without saving them again.
+
+		Keys are remembered by this process (see IdempotencyKeys), and in storage for at least window seconds.
+		check_storage is required where other processes save records of the same org/service pairs
+		"""
+		self.idempotency_window = window
+		self.idempotency = IdempotencyKeys(capacity, error_rate, recent_size, check_storage)
+
+	def disable_idempotency(self):
+		"""
+		Save records without checking their idempotency keys
+		"""
+		self.idempotency = None
+
+	def set_blob_store(self, blob_store, inline_limit=DEFAULT_INLINE_LIMIT):
+		"""
+		Offload change payloads larger than inline_limit bytes, once compressed, to the blob store.
+
+		The store is also needed to read payloads offloaded before, so should not be removed once used
+		"""
+		self.blob_store = blob_store
+		self.changes_inline_limit = inline_limit
+
+	def set_hash_versions(self, version, read_versions=None):
+		"""
+		Assign the hash version of new Audit keys, and the versions queried on reads
+		"""
+		self.hasher = KeyHasher(version, read_versions, self.hasher.cache.max_size)
+
+	def set_item_encoding(self, encoding):
+		"""
+		Assign the encoding of new Audit items, 'full' or 'compact'.
+
+		Only switch to compact once every reader of the table understands it
+		"""
+		if encoding not in ITEM_ENCODINGS:
+			raise ValueError('Item encoding must be one of {}'.format(', '.join(ITEM_ENCODINGS)))
+		self.item_encoding = encoding
+
+	def set_write_shards(self, org_id, service_id, shards):
+		"""
+		Spread the records of the org/service pair over shards hash keys, to avoid a hot partition.
+
+		Records saved before sharding, or with fewer shards, remain readable provided the shard count
+		is never reduced
+		"""
+		if not isinstance(shards, (int, long)) or shards < 1:
+			raise ValueError('Shard count must be at least 1')
+		if shards == 1:
+			self.write_shards.pop((org_id, service_id), None)
+		else:
+			self.write_shards[(org_id, service_id)] = shards
+
+	def _service_hashes(self, org_id, service_id):
+		"""
+		Returns every hash key the records of the org/service pair may be stored under
+
+		Internal use only
+		"""
+		hashes = self.hasher.read_hashes((service_id, org_id))
+		shards = self.write_shards.get((org_id, service_id), 1)
+		if shards > 1:
+			hashes = hashes + [shard_key(hash_value, shard) for hash_value in hashes for shard in range(shards)]
+		return hashes
 
 	def set_prefix(self, prefix):
 		"""
 		Assign the table prefix
 		"""
 		self.prefix = prefix
+		if self.backend is not None:
+			self.backend.set_prefix(prefix)
+
+	def set_backend(self, backend):
+		"""
+		Assign the storage backend used for all tables
+		"""
+		backend.set_prefix(self.prefix)
+		if self.rate_limiter is not None:
+			backend.set_throttle_listener(self.rate_limiter.throttled)
+		self.backend = backend
+		self.connected = True
 
 	def connect(self, region_name, access_key, secret_key):
 		"""
 		Initialise connection to AWS
 		"""
-		region = None
-		for r in regions():
-			if r.name == region_name:
-				region = r
-				break
-
-		if not region:
-			raise Exception('Invalid DynamoDB region specified')
-
-		try:
-			self.conn = DynamoDBConnection(region=region, 
-						aws_access_key_id=access_key,
-						aws_secret_access_key=secret_key)
+		self.set_backend(DynamoDBBackend(region_name, access_key, secret_key))
 
-			self.connected = True
-		except Exception as e:
-			raise Exception('Failed to connect to AWS')
-
-	def _get_table(self, table_name):
+	def _get_backend(self):
 		"""
-		Lazy connection of tables
+		Returns the storage backend, once connected, limited by the rate limiter if one is enabled, and
+		read through the query cache if one is enabled
 
 		Internal use only
 		"""
 		if not self.connected:
 			raise Exception('Attempting to retrieve table but no connection available')
-		if not self.prefix:
-			raise Exception('Attempting to retrieve table prior to prefix assignment')
-
-		table = self.tables.get(table_name, None)
-		if not table:
-			table = Table('_'.join([self.prefix, table_name]), connection=self.conn)
-			self.tables[table_name] = table
-		return table
+		backend = self.backend
+		if self.rate_limiter is not None:
+			backend = RateLimitedBackend(backend, self.rate_limiter)
+		query_cache = self.query_cache
+		if query_cache is not None:
+			# Outside the rate limiter, so that hits cost no tokens
+			backend = CachedQueryBackend(backend, query_cache, **self.query_cache_args)
+		return backend
 
 	def _save_to_table(self, table_name, item):
 		"""
@@ -72,74 +349,125 @@ class Audit(object):
 		Internal use only
 		"""
 		try:
-			return self._get_table(table_name).put_item(item)
+			return self._get_backend().put(table_name, item)
 
 		except Exception as e:
 			raise SaveError(e.message)
 
+	def _batch_save_to_table(self, table_name, items):
+		"""
+		Save items to the specified table as a batch.
 
-	def _validate_data(self, required_data, data):
-		"""Validates that the required fields are present"""
-
-		# Should have only this data and no more or less
-		if len(data) != len(required_data):
-			raise ValidationError('Incorrect data length supplied')
+		Returns a list holding None for each saved item, or the error message if it failed.
 
-		# Verify names and types are correct
-		for field, field_type in required_data:
-			if not field in data:
-				raise ValidationError('Invalid data supplied')
-			else:
-				if field_type == 'N' and not isinstance(data[field], int):
-					raise ValidationError('Invalid data type supplied')
+		Internal use only
+		"""
+		try:
+			return self._get_backend().batch_put(table_name, items)
 
+		except Exception as e:
+			return [e.message or str(e)] * len(items)
 
 	def _get_latest_org_details(self, org_id):
 		"""Retrieves latest details for the specified organisation"""
 		try:
-			return list(self._get_table('Org').query(
-					org_id__eq = org_id,
-					reverse = False,		# By default brings latest, set to True to get earliest
-					limit = 1))				# Sets the retrieval count		
+			items, _ = self._get_backend().query('Org', org_id,
+					descending = True,		# Latest first
+					limit = 1)				# Sets the retrieval count
+			return items
 
 		except Exception as e:
 			print e
 			raise ValidationError('Error retrieving organisation details')
 
+	def _get_org_status(self, org_id):
+		"""
+		Returns the latest status of the org, or None if it doesn't exist.
+
+		Results (including non-existence) are cached, so that steady state saves avoid the Org table
+		"""
+		status = self.org_cache.get(org_id, _MISSING)
+		if status is _MISSING:
+			org_info = self._get_latest_org_details(org_id)
+			if org_info:
+				status = int(org_info[0]['status'])
+				self.org_cache.put(org_id, status)
+			else:
+				status = None
+				self.org_cache.put(org_id, status, self.org_negative_ttl)
+		return status
+
+	def warm_up(self, load_orgs=True):
+		"""
+		Prepare the calling thread to serve requests by readying the storage backend.  With load_orgs,
+		also loads the org cache with the latest status of each org, so that the first saves of each
+		org don't query the Org table.
+
+		Returns the number of orgs cached
+		"""
+		self._get_backend().warm_up()
+		if not load_orgs:
+			return 0
+
+		latest = {}
+		for item in self._scan_items('Org'):
+			timestamp = item['timestamp']
+			if item['org_id'] not in latest or timestamp > latest[item['org_id']][0]:
+				latest[item['org_id']] = (timestamp, int(item['status']))
+
+		# Most recently changed orgs first, in case they don't all fit
+		orgs = sorted(latest.items(), key=lambda org: org[1][0], reverse=True)[:self.org_cache.max_size]
+		for org_id, (_, status) in reversed(orgs):
+			self.org_cache.put(org_id, status)
+		return len(orgs)
+
+	def _scan_items(self, table_name):
+		"""
+		Yields every item of the table, reading a page at a time
+
+		Internal use only
+		"""
+		backend = self._get_backend()
+		start_key = None
+		while True:
+			items, start_key = backend.scan(table_name, limit=QUERY_PAGE_SIZE, start_key=start_key)
+			for item in items:
+				yield item
+			if not start_key:
+				return
+
 	def _validate_org(self, org_id):
 		"""Validates existence of the org, and if it is active"""
-		org_info = self._get_latest_org_details(org_id)
-		if not org_info:
+		status = self._get_org_status(org_id)
+		if status is None:
 			# Org doesnt exist
 			raise ValidationError('Specified organisation does not exist')
 
 		# Have a record; check if the organisation is active
-		return True if org_info['status'] == 1 else False
+		return True if status == 1 else False
 
 
 	def _validate_register_data(self, data):
 		"""Validates that all required fields are present"""
+		validate_register_data(data)
 
-		# This is the set of data to be saved
-		REQUIRED_FIELDS = [('name', 'S'), ('contact', 'S'), ('website', 'S')]
 
-		# Validate structure
-		self._validate_data(REQUIRED_FIELDS, data)
+	def _validate_save_record(self, data):
+		"""Validates that the required fields of a single audit record are present"""
+		validate_save_record(data)
 
-
-	def _validate_save_data(self, org_id, service_id, data):
-		"""Validates that the required fields are present"""
-
-		# This is the set of data to be saved
-		REQUIRED_FIELDS = [('timestamp', 'N'), ('obo_id', 'S'), ('actor_id', 'S')]
-
-		# Validate structure
-		self._validate_data(REQUIRED_FIELDS, data)
+	def _validate_save_org(self, org_id, service_id):
+		"""Validates that the org/service pair may save data"""
 
 		# Validate that the organistion exists and is active
 		if not self._validate_org(org_id):
 			raise ValidationError('Invalid organisation supplied')
 
+	def _validate_save_data(self, org_id, service_id, data):
+		"""Validates that the required fields are present"""
+		self._validate_save_record(data)
+		self._validate_save_org(org_id, service_id)
+
 
 	def register_org(self, org_id, data):
 		"""
@@ -163,6 +491,7 @@ class Audit(object):
 		item['status'] = 1 						# Mark as active
 
 		self._save_to_table('Org', item)
+		self.org_cache.put(item['org_id'], item['status'])
 
 		# Return original data plus identifier
 		data['id'] = org_id
@@ -184,6 +513,7 @@ class Audit(object):
 		item['status'] = 0 						# Mark as inactive
 
 		self._save_to_table('Org', item)
+		self.org_cache.put(item['org_id'], item['status'])
 
 		# Return identifier
 		return {'id':org_id}
@@ -191,19 +521,510 @@ class Audit(object):
 
 	def save_data(self, org_id, service_id, data):
 		"""
-		Save the audit information supplied by the specified org/service pair
+		Save the audit information supplied by the specified org/service pair.
+
+		A record whose idempotency key was already saved is acknowledged without being saved again
 		"""
 
 		# Ensure we can use the data
-		self._validate_save_data(org_id, service_id, data)
+		with SAVE_STAGE_SECONDS.time('validate'):
+			self._validate_save_record(data)
+		with SAVE_STAGE_SECONDS.time('org'):
+			self._validate_save_org(org_id, service_id)
 
-		# Create item
-		item = {}
-		item['service-org_hash'] = create_hash(service_id, org_id)
-		item['org_user_hash'] = create_hash(org_id, data['obo_id'])
-		item['timestamp'] = data['timestamp']
-		item['obo_id'] = data['obo_id']
-		item['actor_id'] = data['actor_id']
+		with SAVE_STAGE_SECONDS.time('hash'):
+			item = self._create_audit_item(org_id, service_id, data)
+
+		idempotency = self.idempotency
+		claims = {}
+		if idempotency is not None and data.get('idempotency_key', None) is not None:
+			with SAVE_STAGE_SECONDS.time('dedupe'):
+				claim = self._check_idempotency_key(idempotency, org_id, service_id, data)
+			if claim[2] == DUPLICATE:
+				return True
+			claims[0] = claim
+		settle = (lambda errors: self._settle_idempotency_keys(idempotency, claims, enumerate(errors))) if claims else None
+
+		write_buffer = self.write_buffer
+		try:
+			with SAVE_STAGE_SECONDS.time('put'):
+				if write_buffer is not None:
+					# The key is settled once the item has been written, which may be after the save returns
+					error = self._enqueue_items(write_buffer, [item], settle)[0]
+					if error:
+						raise SaveError(error)
+					result = True
+				else:
+					result = self._save_to_table('Audit', item)
+		except Exception as e:
+			if settle is not None and write_buffer is None:
+				settle([e.message or str(e)])
+			raise
+		if settle is not None and write_buffer is None:
+			settle([None])
+
+		self._publish(org_id, service_id, [record_from_item(item)])
+		return result
+
+	def save_batch(self, org_id, service_id, records):
+		"""
+		Save a list of audit records supplied by the specified org/service pair.
+
+		The org/service pair is validated once for the whole batch, each record is validated individually.
+		Records whose idempotency key was already saved, or repeats that of an earlier record of the batch,
+		are not saved again, and share the result of the record saved.
+		Returns a list with a result for each record, in the order supplied
+		"""
+		if not isinstance(records, list) or not records:
+			raise ValidationError('A non-empty list of records must be supplied')
+
+		# Ensure the org/service pair can save data
+		with BATCH_STAGE_SECONDS.time('org'):
+			self._validate_save_org(org_id, service_id)
+
+		results = [None] * len(records)
+		valid = []
+		with BATCH_STAGE_SECONDS.time('validate'):
+			for idx, error in enumerate(validate_batch(validate_save_record, records)):
+				if error:
+					results[idx] = {'status': 'failed', 'error_message': error}
+				else:
+					valid.append(idx)
+
+		with BATCH_STAGE_SECONDS.time('hash'):
+			# Change payloads are only checked for size, and stored, once encoded
+			items = []
+			encoded = []
+			for idx in valid:
+				try:
+					items.append(self._create_audit_item(org_id, service_id, records[idx]))
+					encoded.append(idx)
+				except ValidationError as e:
+					results[idx] = {'status': 'failed', 'error_message': e.message}
+			valid = encoded
+
+		idempotency = self.idempotency
+		claims = {}
+		repeats = {}
+		if idempotency is not None:
+			with BATCH_STAGE_SECONDS.time('dedupe'):
+				first = {}
+				saving = []
+				for idx, item in zip(valid, items):
+					key = records[idx].get('idempotency_key', None)
+					if key is not None:
+						if key in first:
+							repeats[idx] = first[key]
+							continue
+						first[key] = idx
+						try:
+							claim = self._check_idempotency_key(idempotency, org_id, service_id, records[idx])
+						except SaveInProgress as e:
+							results[idx] = {'status': 'in_progress', 'error_message': e.message}
+							continue
+						except Exception as e:
+							results[idx] = {'status': 'failed', 'error_message': e.message or str(e)}
+							continue
+						if claim[2] == DUPLICATE:
+							results[idx] = {'status': 'saved'}
+							continue
+						claims[idx] = claim
+					saving.append((idx, item))
+				valid = [idx for idx, _ in saving]
+				items = [item for _, item in saving]
+
+		if items:
+			settle = (lambda errors: self._settle_idempotency_keys(idempotency, claims, zip(valid, errors))) if claims else None
+			with BATCH_STAGE_SECONDS.time('put'):
+				write_buffer = self.write_buffer
+				if write_buffer is not None:
+					# Keys are settled once the items have been written, which may be after the save returns
+					errors = self._enqueue_items(write_buffer, items, settle)
+				else:
+					errors = self._batch_save_to_table('Audit', items)
+					if settle is not None:
+						settle(errors)
+			for idx, error in zip(valid, errors):
+				results[idx] = {'status': 'failed', 'error_message': error} if error else {'status': 'saved'}
+			self._publish(org_id, service_id, [record_from_item(item) for item, error in zip(items, errors) if not error])
+
+		for idx, first_idx in repeats.items():
+			results[idx] = dict(results[first_idx])
+
+		return results
+
+	def _check_idempotency_key(self, idempotency, org_id, service_id, data):
+		"""
+		Checks whether the idempotency key of a record was saved, making a conditional put of its marker if
+		this process cannot tell.  Returns (key, marker, result), where result is NEW, POSSIBLE (the marker has
+		been written, so must be removed if the record is not saved) or DUPLICATE.  NEW and POSSIBLE keys are
+		claimed until passed to _settle_idempotency_keys.
+
+		Raises SaveInProgress while another save of the key is in flight
+
+		Internal use only
+		"""
+		marker = marker_item(org_id, service_id, data['idempotency_key'], data['timestamp'],
+					int(time()) + self.idempotency_window)
+		key = '{}|{}'.format(marker['org-service_id'], marker['key_hash'])
+		result = idempotency.check(key)
+		if result == PENDING:
+			raise SaveInProgress('A save with this idempotency key is in progress')
+		if result == POSSIBLE:
+			try:
+				stored = self._get_backend().put_if_absent('Idempotency', marker)
+			except Exception:
+				idempotency.released(key)
+				raise
+			if stored:
+				idempotency.stored_new()
+			else:
+				idempotency.stored_duplicate(key)
+				result = DUPLICATE
+		return (key, marker, result)
+
+	def _settle_idempotency_keys(self, idempotency, claims, outcomes):
+		"""
+		Completes the idempotency keys of records once written: the keys of saved records are remembered, and
+		their markers written if not already; the markers of records that failed are removed, and their keys
+		released.
+
+		claims holds the result of _check_idempotency_key by record index, and outcomes (index, error) pairs.
+
+		Internal use only
+		"""
+		if not claims:
+			return
+
+		markers = []
+		for idx, error in outcomes:
+			claim = claims.get(idx, None)
+			if claim is None:
+				continue
+			key, marker, result = claim
+			if error:
+				if result == POSSIBLE:
+					try:
+						self._get_backend().delete('Idempotency', marker)
+					except Exception:
+						idempotency.marker_failed()
+				idempotency.released(key)
+			else:
+				idempotency.saved(key)
+				if result == NEW:
+					markers.append(marker)
+
+		# Unconditional, and after the records, so a marker never outlives a failed save
+		if markers:
+			failed = len([error for error in self._batch_save_to_table('Idempotency', markers) if error])
+			if failed:
+				idempotency.marker_failed(failed)
+
+	def _publish(self, org_id, service_id, records):
+		"""
+		Passes saved records to the tail feed, and to the rollups when enabled
+
+		Internal use only
+		"""
+		self.tail_feed.publish(org_id, service_id, records)
+		rollups = self.rollups
+		if rollups is not None:
+			rollups.add(org_id, service_id, records)
+
+	def _validate_query(self, org_id, tm_from, tm_to, limit):
+		"""Validates the organisation exists and the query bounds are usable"""
+		if self._get_org_status(org_id) is None:
+			raise ValidationError('Specified organisation does not exist')
+
+		for value in (tm_from, tm_to, limit):
+			if value is not None and not isinstance(value, (int, long)):
+				raise ValidationError('Invalid query bounds supplied')
+		if tm_from is not None and tm_to is not None and tm_from > tm_to:
+			raise ValidationError('Invalid query bounds supplied')
+		if limit is not None and limit < 1:
+			raise ValidationError('Invalid query limit supplied')
+
+	def _load_changes(self, value):
+		"""
+		Decodes a stored change payload, from the blob store if it was offloaded
+
+		Internal use only
+		"""
+		return decode_changes(value, self.blob_store)
+
+	def _record_stream(self, hash_value, index, tm_from, tm_to, descending, limit, cursor, changes=False):
+		"""
+		Creates the stream of records for the hash key, including their change payloads if changes is set
+
+		Internal use only
+		"""
+		try:
+			return RecordStream(self._get_backend(), hash_value,
+						index=index,
+						tm_from=tm_from,
+						tm_to=tm_to,
+						descending=descending,
+						limit=limit,
+						cursor=cursor,
+						page_size=min(limit or QUERY_PAGE_SIZE, QUERY_PAGE_SIZE),
+						load_changes=self._load_changes if changes else None)
+		except CursorError as e:
+			raise ValidationError(e.message)
+
+	def _hash_records(self, hashes, index, tm_from, tm_to, descending, limit, cursor, concurrency=None, record_filter=None,
+						changes=False):
+		"""
+		Creates the stream of records for the hash keys, merging them in timestamp order if there are several
 
-		self._save_to_table('Audit', item)
+		Internal use only
+		"""
+		if len(hashes) == 1 and not record_filter:
+			return self._record_stream(hashes[0], index, tm_from, tm_to, descending, limit, cursor, changes)
+
+		streams = [self._record_stream(hash_value, index, tm_from, tm_to, descending, None, None) for hash_value in hashes]
+		try:
+			return MergedRecordStream(streams,
+						descending=descending,
+						limit=limit,
+						cursor=cursor,
+						concurrency=concurrency or len(streams),
+						record_filter=record_filter,
+						load_changes=self._load_changes if changes else None)
+		except CursorError as e:
+			raise ValidationError(e.message)
+
+	def query_service_records(self, org_id, service_id, tm_from=None, tm_to=None, descending=False, limit=None, cursor=None,
+								changes=False):
+		"""
+		Returns a stream of the records saved by the org/service pair, with timestamps in the inclusive range.
+
+		The stream is read lazily, a page at a time; its next_cursor resumes the query if the limit was reached.
+		If the pair has write shards, all shards are queried in parallel and merged.  Records include their
+		change payloads if changes is set
+		"""
+		self._validate_query(org_id, tm_from, tm_to, limit)
+		return self._hash_records(self._service_hashes(org_id, service_id), None,
+						tm_from, tm_to, descending, limit, cursor, changes=changes)
+
+	def tail_service_records(self, org_id, service_id, after=None, timeout=20, limit=QUERY_PAGE_SIZE):
+		"""
+		Returns up to limit records saved by the org/service pair with timestamps after the given one,
+		in timestamp order.  If there are none, waits up to timeout seconds for one to be saved.
+
+		Returns a tuple of (records, cursor), where cursor is the timestamp to continue the tail from.
+		Without after, the tail starts from the latest record saved
+		"""
+		self._validate_query(org_id, after, None, limit)
+		if not isinstance(timeout, (int, long, float)) or timeout < 0 or timeout > MAX_TAIL_TIMEOUT:
+			raise ValidationError('Invalid timeout supplied')
+
+		if after is None:
+			latest = list(self.query_service_records(org_id, service_id, descending=True, limit=1))
+			after = latest[0]['timestamp'] if latest else 0
+
+		def read_storage(after, limit):
+			return list(self.query_service_records(org_id, service_id, tm_from=after + 1, limit=limit))
+
+		records = self.tail_feed.tail(org_id, service_id, after, timeout, limit, read_storage)
+		return (records, records[-1]['timestamp'] if records else after)
+
+	def query_service_rollups(self, org_id, service_id, tm_from=None, tm_to=None):
+		"""
+		Returns the hourly counts of the records saved by the org/service pair, for the hours overlapping the
+		inclusive range, in hour order.  Counts not yet flushed by this process are included
+		"""
+		self._validate_query(org_id, tm_from, tm_to, None)
+		hour_from = hour_of(tm_from) if tm_from is not None else None
+		hour_to = hour_of(tm_to) if tm_to is not None else None
+
+		backend = self._get_backend()
+		buckets = {}
+		start_key = None
+		while True:
+			items, start_key = backend.query('Rollup', rollup_hash(org_id, service_id),
+						range_min=hour_from, range_max=hour_to, limit=QUERY_PAGE_SIZE, start_key=start_key)
+			for item in items:
+				bucket = rollup_from_item(item)
+				buckets[bucket['hour']] = bucket
+			if not start_key:
+				break
+
+		rollups = self.rollups
+		if rollups is not None:
+			for hour, (count, obo_count) in rollups.pending(org_id, service_id, hour_from, hour_to).items():
+				bucket = buckets.setdefault(hour, {'hour': hour, 'count': 0, 'obo_count': 0})
+				bucket['count'] += count
+				bucket['obo_count'] += obo_count
+
+		return [buckets[hour] for hour in sorted(buckets)]
+
+	def query_org_rollups(self, org_id, services, tm_from=None, tm_to=None):
+		"""
+		Returns the hourly counts of the records saved by the org in any of the services, summed across them
+		"""
+		if not isinstance(services, list) or not services:
+			raise ValidationError('A non-empty list of services must be supplied')
+		if len(set(services)) > MAX_INVESTIGATION_KEYS:
+			raise ValidationError('Too many services supplied')
+
+		buckets = {}
+		for service_id in set(services):
+			for bucket in self.query_service_rollups(org_id, service_id, tm_from, tm_to):
+				total = buckets.setdefault(bucket['hour'], {'hour': bucket['hour'], 'count': 0, 'obo_count': 0})
+				total['count'] += bucket['count']
+				total['obo_count'] += bucket['obo_count']
+		return [buckets[hour] for hour in sorted(buckets)]
+
+	def rebuild_rollups(self, reader, org_ids=None, tm_from=None, tm_to=None):
+		"""
+		Recounts the rollups from an ExportReader, replacing the stored counts of every bucket in the export.
+
+		Exported items don't hold the org, so each is matched to an org/service pair by its hash key, for
+		the orgs given (defaulting to every registered org); hash versions and write shards must be configured
+		as they were when the records were saved.  Buckets updated after the export was taken would lose
+		those updates, so tm_to should normally fall before the export started.
+
+		Returns the numbers of records counted, records matching no org, and buckets written
+		"""
+		if org_ids is None:
+			org_ids = set(item['org_id'] for item in self._scan_items('Org'))
+
+		# Hash key to org/service pair, extended as services are found in the export
+		pairs = {}
+		services = set()
+		counts = {}
+		unmatched = 0
+		for item in reader.records(tm_from=tm_from, tm_to=tm_to):
+			service_id = item.get('service_id', None)
+			if service_id is not None and service_id not in services:
+				services.add(service_id)
+				for org_id in org_ids:
+					for hash_value in self._service_hashes(org_id, service_id):
+						pairs[hash_value] = (org_id, service_id)
+
+			pair = pairs.get(item['service-org_hash'], None)
+			if pair is None:
+				unmatched += 1
+				continue
+			aggregate(counts, pair[0], pair[1], [item])
+
+		items = [rollup_item(org_id, service_id, hour, count, obo_count)
+					for (org_id, service_id, hour), (count, obo_count) in counts.items()]
+		errors = []
+		for start in range(0, len(items), QUERY_PAGE_SIZE):
+			errors.extend(error for error in self._batch_save_to_table('Rollup', items[start:start + QUERY_PAGE_SIZE]) if error)
+		if errors:
+			raise SaveError('Failed to save {} rollups: {}'.format(len(errors), errors[0]))
+
+		return {
+			'records': sum(count for count, _ in counts.values()),
+			'unmatched': unmatched,
+			'buckets': len(items)
+		}
+
+	def query_user_records(self, org_id, user_id, tm_from=None, tm_to=None, descending=False, limit=None, cursor=None,
+							changes=False):
+		"""
+		Returns a stream of the records saved on behalf of the user of the org, across all services,
+		with timestamps in the inclusive range.
+
+		The stream is read lazily, a page at a time; its next_cursor resumes the query if the limit was reached.
+		Records include their change payloads if changes is set
+		"""
+		self._validate_query(org_id, tm_from, tm_to, limit)
+		return self._hash_records(self.hasher.read_hashes((org_id, user_id)), 'org-user',
+						tm_from, tm_to, descending, limit, cursor, changes=changes)
+
+	def investigate_records(self, org_id, users=None, services=None, tm_from=None, tm_to=None, descending=False,
+							limit=None, cursor=None, concurrency=8, changes=False):
+		"""
+		Returns a stream of the records of the org made on behalf of any of the users, in any of the services,
+		with timestamps in the inclusive range, merged into timestamp order.
+
+		Either or both of users and services may be supplied.  One query is made per user (against the
+		org-user index) or per service, whichever is fewer, and per hash version read, with up to
+		concurrency queries in flight; records are then filtered on the other set.  Records include their
+		change payloads if changes is set.
+		"""
+		self._validate_query(org_id, tm_from, tm_to, limit)
+
+		users = set(users or [])
+		services = set(services or [])
+		if not users and not services:
+			raise ValidationError('Users or services must be supplied')
+		for value in users | services:
+			if not isinstance(value, basestring) or not value:
+				raise ValidationError('Invalid users or services supplied')
+		if not isinstance(concurrency, (int, long)) or concurrency < 1:
+			raise ValidationError('Invalid concurrency supplied')
+
+		by_user = users and (not services or len(users) <= len(services))
+		if by_user:
+			hashes = [hash_value for user_id in sorted(users) for hash_value in self.hasher.read_hashes((org_id, user_id))]
+			record_filter = (lambda record: record['service_id'] in services) if services else None
+		else:
+			hashes = [hash_value for service_id in sorted(services) for hash_value in self._service_hashes(org_id, service_id)]
+			record_filter = (lambda record: record['obo_id'] in users) if users else None
+
+		if len(hashes) > MAX_INVESTIGATION_KEYS:
+			raise ValidationError('Too many users or services supplied')
+
+		return self._hash_records(hashes, 'org-user' if by_user else None, tm_from, tm_to, descending, limit, cursor,
+						concurrency=concurrency, record_filter=record_filter, changes=changes)
+
+	def _enqueue_items(self, write_buffer, items, on_written=None):
+		"""
+		Queue Audit items on the write-behind buffer, waiting for the flush if required by the ack mode.
+
+		Returns a list holding None for each accepted item, or the error message if it was not.
+		on_written, if given, is called with the outcome of every item once all have been written or have
+		failed; in 'enqueue' mode, that is usually on the flusher thread after this has returned.
+
+		Internal use only
+		"""
+		results = [None] * len(items)
+		callback = None
+		if on_written is not None:
+			outcomes = [None] * len(items)
+			remaining = [len(items)]
+			lock = Lock()
+
+			def callback(idx, error):
+				outcomes[idx] = error
+				with lock:
+					remaining[0] -= 1
+					if remaining[0]:
+						return
+				on_written(outcomes)
+
+		tickets = []
+		for idx, item in enumerate(items):
+			try:
+				tickets.append((idx, write_buffer.put(item, on_done=partial(callback, idx) if callback else None)))
+			except BufferFull as e:
+				results[idx] = e.message
+				if callback is not None:
+					callback(idx, e.message)
+
+		if self.write_ack == 'flush':
+			for idx, ticket in tickets:
+				results[idx] = ticket.wait()
+
+		return results
+
+	def _create_audit_item(self, org_id, service_id, data):
+		"""
+		Creates the Audit table item for a validated record, storing its change payload inline or in the blob store
+
+		Internal use only
+		"""
+		service_hash = self.hasher.hash((service_id, org_id))
+		shards = self.write_shards.get((org_id, service_id), 1)
+		if shards > 1:
+			service_hash = shard_key(service_hash, record_shard(data['obo_id'], data['timestamp'], shards))
+		changes = data.get('changes', None)
+		if changes is not None:
+			changes = encode_changes(changes, self.blob_store, self.changes_inline_limit)
+		record = AuditRecord(data['timestamp'], service_id, data['obo_id'], data['actor_id'], changes)
+		return record.to_item(service_hash, self.hasher.hash((org_id, data['obo_id'])), self.item_encoding)
 
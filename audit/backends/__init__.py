@@ -0,0 +1,191 @@
+"""
+Storage backends for the audit service.
+
+Audit talks to storage only through the StorageBackend interface, so that the same service
+can run against DynamoDB, or against local engines for testing and benchmarking without AWS.
+"""
+from audit.metrics import STORAGE_THROTTLES
+from zlib import crc32
+
+class StorageError(Exception):
+	"""Raised by backends when a storage operation fails"""
+	pass
+
+class StorageThrottled(StorageError):
+	"""Raised by backends when a request is rejected for exceeding the table's capacity"""
+	pass
+
+# Key schema of each table: hash key, range key and global secondary indexes (hash key, range key)
+TABLES = {
+	'Audit': {
+		'hash': 'service-org_hash',
+		'range': 'timestamp',
+		'indexes': {
+			'org-user': ('org-user_hash', 'timestamp'),
+		},
+	},
+	'Org': {
+		'hash': 'org_id',
+		'range': 'timestamp',
+		'indexes': {},
+	},
+	'OrgService': {
+		'hash': 'org-service_id',
+		'range': 'timestamp',
+		'indexes': {},
+	},
+	'Rollup': {
+		'hash': 'org-service_id',
+		'range': 'hour',
+		'indexes': {},
+	},
+	'Idempotency': {
+		'hash': 'org-service_id',
+		'range': 'key_hash',
+		'indexes': {},
+	},
+}
+
+def table_keys(table_name, index=None):
+	"""
+	Returns the (hash key, range key) attribute names of the table, or of one of its indexes
+	"""
+	try:
+		schema = TABLES[table_name]
+		if index:
+			return schema['indexes'][index]
+		return (schema['hash'], schema['range'])
+	except KeyError:
+		raise StorageError('Unknown table or index: {}'.format(index or table_name))
+
+def scan_segment(hash_value, total_segments):
+	"""
+	Returns the scan segment of a hash key value, for backends without native segments
+	"""
+	if not isinstance(hash_value, basestring):
+		hash_value = str(hash_value)
+	if isinstance(hash_value, unicode):
+		hash_value = hash_value.encode('utf-8')
+	return (crc32(hash_value) & 0xffffffff) % total_segments
+
+class StorageBackend(object):
+	"""
+	Interface implemented by each storage engine.
+
+	Items are plain dicts.  Range keys are numeric, and queries return items in range key order.
+	"""
+	name = None
+
+	def __init__(self):
+		self.prefix = None
+		self.throttle_listener = None
+
+	def set_prefix(self, prefix):
+		"""
+		Assign the table prefix, allowing multiple installs side by side
+		"""
+		self.prefix = prefix
+
+	def set_throttle_listener(self, listener):
+		"""
+		Assign a function called with the table name whenever a request to it is throttled
+		"""
+		self.throttle_listener = listener
+
+	def _throttled(self, table_name):
+		"""
+		Counts a throttled request, and reports it to the listener
+		"""
+		STORAGE_THROTTLES.inc(label_value=table_name)
+		if self.throttle_listener is not None:
+			self.throttle_listener(table_name)
+
+	def create_tables(self):
+		"""
+		Create the storage for all the tables in TABLES, if needed
+		"""
+		raise NotImplementedError()
+
+	def put(self, table_name, item):
+		"""
+		Save a single item to the table
+		"""
+		raise NotImplementedError()
+
+	def batch_put(self, table_name, items):
+		"""
+		Save a list of items to the table.
+
+		Returns a list holding None for each saved item, or the error message if it failed
+		"""
+		raise NotImplementedError()
+
+	def put_if_absent(self, table_name, item):
+		"""
+		Save a single item to the table, unless an item with its key exists.
+
+		Returns True if the item was saved, False if it was not
+		"""
+		raise NotImplementedError()
+
+	def delete(self, table_name, key):
+		"""
+		Remove the item with the key, which holds the hash and range key values, if there is one
+		"""
+		raise NotImplementedError()
+
+	def increment(self, table_name, key, counters):
+		"""
+		Atomically add to numeric attributes of the item with the key, creating the item if needed.
+
+		key holds the hash and range key values, and counters the amount to add to each attribute
+		"""
+		raise NotImplementedError()
+
+	def query(self, table_name, hash_value, range_min=None, range_max=None, index=None,
+				descending=False, limit=None, start_key=None):
+		"""
+		Retrieve items with the hash key value, and range key within the inclusive bounds, from
+		the table or one of its global secondary indexes.
+
+		start_key continues a previous query, and is the last_key returned by it.
+
+		Returns a tuple of (items, last_key), where last_key is None once no more items are available
+		"""
+		raise NotImplementedError()
+
+	def scan(self, table_name, limit=None, start_key=None, segment=None, total_segments=None):
+		"""
+		Retrieve all items of the table, a page at a time.
+
+		start_key continues a previous scan, and is the last_key returned by it.  With total_segments, only
+		the items of one of that many disjoint segments of the table are returned, so that segments can be
+		scanned in parallel.
+
+		Returns a tuple of (items, last_key), where last_key is None once no more items are available
+		"""
+		raise NotImplementedError()
+
+	def warm_up(self):
+		"""
+		Prepare the calling thread for requests, for instance by connecting to storage
+		"""
+		pass
+
+def create_backend(name, **kwargs):
+	"""
+	Creates the named storage backend; kwargs are passed to its constructor
+	"""
+	if name == 'dynamodb':
+		from audit.backends.dynamodb import DynamoDBBackend
+		return DynamoDBBackend(**kwargs)
+	elif name == 'memory':
+		from audit.backends.memory import MemoryBackend
+		return MemoryBackend(**kwargs)
+	elif name == 'sqlite':
+		from audit.backends.sqlite import SQLiteBackend
+		return SQLiteBackend(**kwargs)
+
+	raise StorageError('Unknown storage backend: {}'.format(name))
+
+BACKENDS = ('dynamodb', 'memory', 'sqlite')
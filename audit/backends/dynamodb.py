@@ -0,0 +1,337 @@
+"""
+AWS DynamoDB storage backend
+"""
+from boto.dynamodb2 import regions
+from boto.dynamodb2.table import Table
+from boto.dynamodb2.layer1 import DynamoDBConnection
+from boto.dynamodb2.exceptions import ConditionalCheckFailedException, ProvisionedThroughputExceededException
+from boto.dynamodb.types import Dynamizer
+from audit.backends import StorageBackend, StorageError, StorageThrottled, TABLES, table_keys
+from audit.metrics import STORAGE_RETRIES
+from boto.compat import json
+from functools import partial
+from os import getpid
+from threading import RLock, current_thread, local
+from time import sleep
+import weakref
+
+# Maximum number of put requests DynamoDB accepts in one BatchWriteItem call
+BATCH_WRITE_SIZE = 25
+
+class _DynamoDBConnection(DynamoDBConnection):
+	"""
+	Connection that can raise throttles on the first occurrence, rather than retrying them, while boto
+	still retries server and connection errors
+	"""
+	raise_throttles = False
+
+	def _retry_handler(self, response, i, next_sleep):
+		if self.raise_throttles and response.status == 400:
+			# boto caches the body, so the default handler can read it again
+			data = json.loads(response.read().decode('utf-8'))
+			if 'ProvisionedThroughputExceededException' in data.get('__type', ''):
+				self.throughput_exceeded_events += 1
+				raise ProvisionedThroughputExceededException(response.status, response.reason, data)
+		return DynamoDBConnection._retry_handler(self, response, i, next_sleep)
+
+class DynamoDBBackend(StorageBackend):
+	"""
+	Stores items in DynamoDB tables, named with the prefix
+	"""
+	name = 'dynamodb'
+
+	def __init__(self, region_name, access_key, secret_key, max_retries=5, backoff=0.05):
+		super(DynamoDBBackend, self).__init__()
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self._dynamizer = Dynamizer()
+
+		region = None
+		for r in regions():
+			if r.name == region_name:
+				region = r
+				break
+
+		if not region:
+			raise Exception('Invalid DynamoDB region specified')
+
+		self._connect_args = {
+			'region': region,
+			'aws_access_key_id': access_key,
+			'aws_secret_access_key': secret_key
+		}
+		self._raise_throttles = False
+
+		# Connection and Table handles of each thread, in the process that created them.  Each thread holding
+		# a connection has a weak reference here, whose callback releases the connection once the thread is gone
+		self._local = local()
+		self._threads = set()
+		self._pid = getpid()
+		self._lock = RLock()
+
+		# Connect now, so that bad settings are reported immediately
+		self._state()
+
+	def _state(self):
+		"""
+		Returns the connection state of the calling thread, connecting on first use.
+
+		boto connections are not safe to share between threads, and must not be used by a forked child,
+		so each thread of each process has its own; each keeps its HTTP connections alive for reuse, until
+		the thread exits.
+
+		Internal use only
+		"""
+		state = self._local
+		pid = getpid()
+		if getattr(state, 'pid', None) != pid:
+			try:
+				state.conn = _DynamoDBConnection(**self._connect_args)
+			except Exception as e:
+				raise Exception('Failed to connect to AWS')
+			state.tables = {}
+			state.pid = pid
+			with self._lock:
+				if self._pid != pid:
+					# Forked: the connections of the parent's threads are not this process's
+					self._threads = set()
+					self._pid = pid
+				self._threads.add(weakref.ref(current_thread(), partial(self._release, state.conn)))
+		if state.conn.raise_throttles != self._raise_throttles:
+			state.conn.raise_throttles = self._raise_throttles
+		return state
+
+	@property
+	def conn(self):
+		"""
+		The connection of the calling thread
+		"""
+		return self._state().conn
+
+	def _release(self, conn, thread_ref):
+		"""
+		Closes the connection of a thread that has exited
+
+		Internal use only
+		"""
+		with self._lock:
+			if thread_ref not in self._threads:
+				return
+			self._threads.discard(thread_ref)
+		for host_pool in conn._pool.host_to_pool.values():
+			for http_conn, _ in host_pool.queue:
+				http_conn.close()
+			del host_pool.queue[:]
+
+	def connection_count(self):
+		"""
+		Returns the number of open connections, one per live thread of this process that has used the backend
+		"""
+		with self._lock:
+			return len(self._threads)
+
+	def set_throttle_listener(self, listener):
+		"""
+		Assign the throttle listener, which then also handles retries of throttled requests; boto raises on
+		the first throttle rather than retrying internally, so that each one is reported.  Other errors are
+		still retried by boto
+		"""
+		super(DynamoDBBackend, self).set_throttle_listener(listener)
+		self._raise_throttles = listener is not None
+
+	def create_tables(self):
+		"""
+		DynamoDB tables are created by the installer
+		"""
+		raise StorageError('DynamoDB tables must be created with install.audit_install_db')
+
+	def _get_table(self, table_name):
+		"""
+		Lazy connection of tables; handles are cached per thread, so lookups take no lock
+
+		Internal use only
+		"""
+		if not self.prefix:
+			raise Exception('Attempting to retrieve table prior to prefix assignment')
+
+		full_name = '_'.join([self.prefix, table_name])
+		state = self._state()
+		table = state.tables.get(full_name, None)
+		if table is None:
+			table = Table(full_name, connection=state.conn)
+			state.tables[full_name] = table
+		return table
+
+	def _encode(self, item):
+		return dict((k, self._dynamizer.encode(v)) for k, v in item.items())
+
+	def _decode(self, item):
+		return dict((k, self._dynamizer.decode(v)) for k, v in item.items())
+
+	def put(self, table_name, item):
+		try:
+			return self._get_table(table_name).put_item(item)
+		except ProvisionedThroughputExceededException as e:
+			self._throttled(table_name)
+			raise StorageThrottled(e.message or str(e))
+
+	def batch_put(self, table_name, items):
+		"""
+		Save items using BatchWriteItem, in chunks of BATCH_WRITE_SIZE.
+
+		Unprocessed items, and chunks rejected as throttled, are resent with exponential backoff,
+		up to max_retries times.
+		"""
+		table = self._get_table(table_name)
+		key_names = table_keys(table_name)
+
+		def encoded_key(encoded_item):
+			return tuple((k, tuple(encoded_item[k].items())) for k in key_names)
+
+		encoded = [self._encode(item) for item in items]
+		results = [None] * len(items)
+		attempts = [0] * len(items)
+		pending = range(len(items))
+
+		while pending:
+			# Build a chunk; a batch may not contain the same key twice, so defer duplicates
+			chunk = {}
+			deferred = []
+			for idx in pending:
+				key = encoded_key(encoded[idx])
+				if len(chunk) == BATCH_WRITE_SIZE or key in chunk:
+					deferred.append(idx)
+				else:
+					chunk[key] = idx
+
+			try:
+				resp = self.conn.batch_write_item({
+						table.table_name: [{'PutRequest': {'Item': encoded[idx]}} for idx in chunk.values()]
+					})
+				unprocessed = [chunk[encoded_key(request['PutRequest']['Item'])]
+							for request in resp.get('UnprocessedItems', {}).get(table.table_name, [])]
+			except ProvisionedThroughputExceededException:
+				unprocessed = list(chunk.values())
+			except Exception as e:
+				for idx in chunk.values():
+					results[idx] = e.message or str(e)
+				pending = deferred
+				continue
+
+			if unprocessed:
+				self._throttled(table_name)
+
+			retry = []
+			for idx in unprocessed:
+				attempts[idx] += 1
+				if attempts[idx] > self.max_retries:
+					results[idx] = 'Item unprocessed after {} retries'.format(self.max_retries)
+				else:
+					retry.append(idx)
+
+			if retry:
+				STORAGE_RETRIES.inc(len(retry), table_name)
+				sleep(self.backoff * (2 ** (max(attempts[idx] for idx in retry) - 1)))
+			pending = retry + deferred
+
+		return results
+
+	def put_if_absent(self, table_name, item):
+		"""
+		Saves the item with a PutItem conditional on its hash key not existing
+		"""
+		hash_key, _ = table_keys(table_name)
+		try:
+			self.conn.put_item(self._get_table(table_name).table_name, self._encode(item),
+						expected={hash_key: {'Exists': False}})
+		except ConditionalCheckFailedException:
+			return False
+		except ProvisionedThroughputExceededException as e:
+			self._throttled(table_name)
+			raise StorageThrottled(e.message or str(e))
+		return True
+
+	def delete(self, table_name, key):
+		try:
+			self.conn.delete_item(self._get_table(table_name).table_name, self._encode(key))
+		except ProvisionedThroughputExceededException as e:
+			self._throttled(table_name)
+			raise StorageThrottled(e.message or str(e))
+		return True
+
+	def increment(self, table_name, key, counters):
+		"""
+		Adds the counters with a single UpdateItem of ADD actions, which creates the item if needed
+		"""
+		try:
+			self.conn.update_item(self._get_table(table_name).table_name,
+						key=self._encode(key),
+						attribute_updates=dict((name, {'Action': 'ADD', 'Value': self._dynamizer.encode(amount)})
+									for name, amount in counters.items()))
+		except ProvisionedThroughputExceededException as e:
+			self._throttled(table_name)
+			raise StorageThrottled(e.message or str(e))
+		return True
+
+	def query(self, table_name, hash_value, range_min=None, range_max=None, index=None,
+				descending=False, limit=None, start_key=None):
+		hash_key, range_key = table_keys(table_name, index)
+
+		key_conditions = {
+			hash_key: {
+				'AttributeValueList': [self._dynamizer.encode(hash_value)],
+				'ComparisonOperator': 'EQ'
+			}
+		}
+		if range_min is not None and range_max is not None:
+			key_conditions[range_key] = {
+				'AttributeValueList': [self._dynamizer.encode(range_min), self._dynamizer.encode(range_max)],
+				'ComparisonOperator': 'BETWEEN'
+			}
+		elif range_min is not None:
+			key_conditions[range_key] = {
+				'AttributeValueList': [self._dynamizer.encode(range_min)],
+				'ComparisonOperator': 'GE'
+			}
+		elif range_max is not None:
+			key_conditions[range_key] = {
+				'AttributeValueList': [self._dynamizer.encode(range_max)],
+				'ComparisonOperator': 'LE'
+			}
+
+		try:
+			resp = self.conn.query(self._get_table(table_name).table_name,
+						key_conditions=key_conditions,
+						index_name=index,
+						limit=limit,
+						scan_index_forward=not descending,
+						exclusive_start_key=self._encode(start_key) if start_key else None)
+		except ProvisionedThroughputExceededException as e:
+			self._throttled(table_name)
+			raise StorageThrottled(e.message or str(e))
+
+		last_key = resp.get('LastEvaluatedKey', None)
+		return ([self._decode(item) for item in resp.get('Items', [])],
+				self._decode(last_key) if last_key else None)
+
+	def scan(self, table_name, limit=None, start_key=None, segment=None, total_segments=None):
+		try:
+			resp = self.conn.scan(self._get_table(table_name).table_name,
+						limit=limit,
+						exclusive_start_key=self._encode(start_key) if start_key else None,
+						segment=segment,
+						total_segments=total_segments)
+		except ProvisionedThroughputExceededException as e:
+			self._throttled(table_name)
+			raise StorageThrottled(e.message or str(e))
+
+		last_key = resp.get('LastEvaluatedKey', None)
+		return ([self._decode(item) for item in resp.get('Items', [])],
+				self._decode(last_key) if last_key else None)
+
+	def warm_up(self):
+		"""
+		Connects the calling thread and opens its table handles, checking that each table exists
+		"""
+		for table_name in TABLES:
+			self.conn.describe_table(self._get_table(table_name).table_name)
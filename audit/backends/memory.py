@@ -0,0 +1,221 @@
+"""
+In-memory storage backend, for testing and for benchmarking the service without network latency.
+
+Each hash key value holds its range keys in a sorted list, so that range queries are a bisection.
+"""
+from bisect import bisect_left, bisect_right, insort
+from threading import Lock
+from audit.backends import StorageBackend, TABLES, scan_segment, table_keys
+
+class _Partition(object):
+	"""
+	Items sharing a hash key value, ordered by their sort key
+	"""
+	__slots__ = ('keys', 'items')
+
+	def __init__(self):
+		self.keys = []
+		self.items = {}
+
+	def put(self, key, item):
+		if key not in self.items:
+			insort(self.keys, key)
+		self.items[key] = item
+
+	def remove(self, key):
+		if self.items.pop(key, None) is not None:
+			del self.keys[bisect_left(self.keys, key)]
+
+class _HighestType(object):
+	"""
+	Compares greater than any other value, to bound index sort keys from above
+	"""
+	def __cmp__(self, other):
+		return 0 if other is self else 1
+
+	def __lt__(self, other):
+		return False
+
+	def __gt__(self, other):
+		return other is not self
+
+	def __eq__(self, other):
+		return other is self
+
+_Highest = _HighestType()
+
+class MemoryBackend(StorageBackend):
+	"""
+	Holds all tables in process memory; contents are lost when the process exits.
+
+	Table partitions are sorted by range key.  Index partitions are sorted by
+	(index range key, table hash key, table range key), since index keys need not be unique.
+	"""
+	name = 'memory'
+
+	def __init__(self):
+		super(MemoryBackend, self).__init__()
+		self._lock = Lock()
+		self._tables = {}
+		self.create_tables()
+
+	def create_tables(self):
+		with self._lock:
+			for table_name, schema in TABLES.items():
+				if table_name not in self._tables:
+					self._tables[table_name] = {
+						None: {},
+						'indexes': dict((index, {}) for index in schema['indexes'])
+					}
+
+	def _index_key(self, table_name, index, item):
+		"""
+		Returns (index hash value, sort key) for the item, or None if it lacks the index attributes
+		"""
+		hash_key, range_key = table_keys(table_name)
+		idx_hash, idx_range = table_keys(table_name, index)
+		if idx_hash not in item or idx_range not in item:
+			return None
+		return (item[idx_hash], (item[idx_range], item[hash_key], item[range_key]))
+
+	def _put(self, table_name, item):
+		"""
+		Store the item, replacing any with the same key; must hold the lock
+		"""
+		hash_key, range_key = table_keys(table_name)
+		table = self._tables[table_name]
+		item = dict(item)
+
+		partition = table[None].setdefault(item[hash_key], _Partition())
+		previous = partition.items.get(item[range_key], None)
+		partition.put(item[range_key], item)
+
+		for index, partitions in table['indexes'].items():
+			if previous is not None:
+				old = self._index_key(table_name, index, previous)
+				if old:
+					partitions[old[0]].remove(old[1])
+			new = self._index_key(table_name, index, item)
+			if new:
+				partitions.setdefault(new[0], _Partition()).put(new[1], item)
+
+	def put(self, table_name, item):
+		with self._lock:
+			self._put(table_name, item)
+		return True
+
+	def batch_put(self, table_name, items):
+		with self._lock:
+			for item in items:
+				self._put(table_name, item)
+		return [None] * len(items)
+
+	def put_if_absent(self, table_name, item):
+		hash_key, range_key = table_keys(table_name)
+		with self._lock:
+			partition = self._tables[table_name][None].get(item[hash_key], None)
+			if partition is not None and item[range_key] in partition.items:
+				return False
+			self._put(table_name, item)
+		return True
+
+	def delete(self, table_name, key):
+		hash_key, range_key = table_keys(table_name)
+		table = self._tables[table_name]
+		with self._lock:
+			partition = table[None].get(key[hash_key], None)
+			item = partition.items.get(key[range_key], None) if partition is not None else None
+			if item is None:
+				return True
+			partition.remove(key[range_key])
+			for index, partitions in table['indexes'].items():
+				index_key = self._index_key(table_name, index, item)
+				if index_key:
+					partitions[index_key[0]].remove(index_key[1])
+		return True
+
+	def increment(self, table_name, key, counters):
+		hash_key, range_key = table_keys(table_name)
+		with self._lock:
+			partition = self._tables[table_name][None].get(key[hash_key], None)
+			item = dict(partition.items.get(key[range_key], key)) if partition is not None else dict(key)
+			for name, amount in counters.items():
+				item[name] = item.get(name, 0) + amount
+			self._put(table_name, item)
+		return True
+
+	def query(self, table_name, hash_value, range_min=None, range_max=None, index=None,
+				descending=False, limit=None, start_key=None):
+		table = self._tables[table_name]
+		if index:
+			partition = table['indexes'][index].get(hash_value, None)
+			sort_key = lambda item: self._index_key(table_name, index, item)[1]
+			lower = (range_min,) if range_min is not None else None
+			upper = (range_max, _Highest, _Highest) if range_max is not None else None
+		else:
+			hash_key, range_key = table_keys(table_name)
+			partition = table[None].get(hash_value, None)
+			sort_key = lambda item: item[range_key]
+			lower = range_min
+			upper = range_max
+
+		if partition is None:
+			return ([], None)
+
+		with self._lock:
+			keys = partition.keys
+			start = bisect_left(keys, lower) if lower is not None else 0
+			end = bisect_right(keys, upper) if upper is not None else len(keys)
+
+			# Continue after the last item returned by the previous query
+			if start_key:
+				if descending:
+					end = min(end, bisect_left(keys, sort_key(start_key)))
+				else:
+					start = max(start, bisect_right(keys, sort_key(start_key)))
+
+			if descending:
+				selected = keys[max(start, end - limit) if limit else start:end][::-1]
+			else:
+				selected = keys[start:min(end, start + limit) if limit else end]
+
+			items = [dict(partition.items[key]) for key in selected]
+			more = limit and len(selected) == limit and end - start > limit
+
+		last_key = None
+		if more:
+			key_names = set(table_keys(table_name))
+			if index:
+				key_names.update(table_keys(table_name, index))
+			last_key = dict((k, items[-1][k]) for k in key_names)
+		return (items, last_key)
+
+	def scan(self, table_name, limit=None, start_key=None, segment=None, total_segments=None):
+		hash_key, range_key = table_keys(table_name)
+		partitions = self._tables[table_name][None]
+		items = []
+
+		with self._lock:
+			# Items in (hash key, range key) order, so that a scan can continue from any item
+			hash_values = sorted(partitions)
+			if total_segments:
+				hash_values = [h for h in hash_values if scan_segment(h, total_segments) == segment]
+			first = bisect_left(hash_values, start_key[hash_key]) if start_key else 0
+			for hash_value in hash_values[first:]:
+				partition = partitions[hash_value]
+				keys = partition.keys
+				if start_key and hash_value == start_key[hash_key]:
+					keys = keys[bisect_right(keys, start_key[range_key]):]
+
+				# Take one extra item to learn whether more are available
+				if limit:
+					keys = keys[:limit + 1 - len(items)]
+				items.extend(dict(partition.items[key]) for key in keys)
+				if limit and len(items) > limit:
+					break
+
+		last_key = None
+		if limit and len(items) > limit:
+			items = items[:limit]
+			last_key = dict((k, items[-1][k]) for k in (hash_key, range_key))
+		return (items, last_key)
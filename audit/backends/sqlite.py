@@ -0,0 +1,207 @@
+"""
+SQLite storage backend, for running the service on a single node without AWS.
+
+Key attributes are held in their own indexed columns, and the whole item as JSON.
+"""
+import json
+import sqlite3
+from threading import Lock
+from audit.backends import StorageBackend, StorageError, TABLES, scan_segment, table_keys
+
+def _quote(name):
+	return '"{}"'.format(name)
+
+class SQLiteBackend(StorageBackend):
+	"""
+	Stores each table in a SQLite table, named with the prefix
+	"""
+	name = 'sqlite'
+
+	def __init__(self, path=':memory:'):
+		super(SQLiteBackend, self).__init__()
+		self.path = path
+		self._lock = Lock()
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		self.conn.create_function('scan_segment', 2, scan_segment)
+		if path != ':memory:':
+			self.conn.execute('PRAGMA journal_mode=WAL')
+			self.conn.execute('PRAGMA synchronous=NORMAL')
+		self.create_tables()
+
+	def set_prefix(self, prefix):
+		super(SQLiteBackend, self).set_prefix(prefix)
+		self.create_tables()
+
+	def _table_name(self, table_name):
+		return _quote(table_name if not self.prefix else '_'.join((self.prefix, table_name)))
+
+	def _key_names(self, table_name):
+		"""
+		Returns the names of all key attributes of the table and its indexes, table keys first
+		"""
+		names = list(table_keys(table_name))
+		for index in TABLES[table_name]['indexes']:
+			names.extend(name for name in table_keys(table_name, index) if name not in names)
+		return names
+
+	def create_tables(self):
+		with self._lock:
+			for table_name, schema in TABLES.items():
+				full_name = self._table_name(table_name)
+				hash_key, range_key = table_keys(table_name)
+				columns = ', '.join(_quote(name) for name in self._key_names(table_name))
+				self.conn.execute('CREATE TABLE IF NOT EXISTS {} ({}, item TEXT NOT NULL, PRIMARY KEY ({}, {}))'.format(
+							full_name, columns, _quote(hash_key), _quote(range_key)))
+
+				for index in schema['indexes']:
+					idx_hash, idx_range = table_keys(table_name, index)
+					idx_name = _quote('_'.join((self.prefix or '', table_name, index)))
+					self.conn.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({}, {}, {}, {})'.format(
+								idx_name, full_name, _quote(idx_hash), _quote(idx_range), _quote(hash_key), _quote(range_key)))
+			self.conn.commit()
+
+	def _insert(self, table_name, items):
+		key_names = self._key_names(table_name)
+		sql = 'INSERT OR REPLACE INTO {} ({}, item) VALUES ({})'.format(
+					self._table_name(table_name),
+					', '.join(_quote(name) for name in key_names),
+					', '.join('?' * (len(key_names) + 1)))
+		rows = [[item.get(name, None) for name in key_names] + [json.dumps(item)] for item in items]
+
+		with self._lock:
+			try:
+				self.conn.executemany(sql, rows)
+				self.conn.commit()
+			except sqlite3.Error as e:
+				self.conn.rollback()
+				raise StorageError(str(e))
+
+	def put(self, table_name, item):
+		self._insert(table_name, [item])
+		return True
+
+	def batch_put(self, table_name, items):
+		try:
+			self._insert(table_name, items)
+		except StorageError as e:
+			return [e.message] * len(items)
+		return [None] * len(items)
+
+	def put_if_absent(self, table_name, item):
+		key_names = self._key_names(table_name)
+		sql = 'INSERT OR IGNORE INTO {} ({}, item) VALUES ({})'.format(
+					self._table_name(table_name),
+					', '.join(_quote(name) for name in key_names),
+					', '.join('?' * (len(key_names) + 1)))
+
+		with self._lock:
+			try:
+				cursor = self.conn.execute(sql, [item.get(name, None) for name in key_names] + [json.dumps(item)])
+				self.conn.commit()
+			except sqlite3.Error as e:
+				self.conn.rollback()
+				raise StorageError(str(e))
+		return cursor.rowcount == 1
+
+	def delete(self, table_name, key):
+		hash_key, range_key = table_keys(table_name)
+		with self._lock:
+			try:
+				self.conn.execute('DELETE FROM {} WHERE {} = ? AND {} = ?'.format(
+							self._table_name(table_name), _quote(hash_key), _quote(range_key)), (key[hash_key], key[range_key]))
+				self.conn.commit()
+			except sqlite3.Error as e:
+				self.conn.rollback()
+				raise StorageError(str(e))
+		return True
+
+	def increment(self, table_name, key, counters):
+		hash_key, range_key = table_keys(table_name)
+		full_name = self._table_name(table_name)
+		key_names = self._key_names(table_name)
+		with self._lock:
+			try:
+				row = self.conn.execute('SELECT item FROM {} WHERE {} = ? AND {} = ?'.format(
+							full_name, _quote(hash_key), _quote(range_key)), (key[hash_key], key[range_key])).fetchone()
+				item = json.loads(row[0]) if row else dict(key)
+				for name, amount in counters.items():
+					item[name] = item.get(name, 0) + amount
+				self.conn.execute('INSERT OR REPLACE INTO {} ({}, item) VALUES ({})'.format(
+							full_name, ', '.join(_quote(name) for name in key_names), ', '.join('?' * (len(key_names) + 1))),
+							[item.get(name, None) for name in key_names] + [json.dumps(item)])
+				self.conn.commit()
+			except sqlite3.Error as e:
+				self.conn.rollback()
+				raise StorageError(str(e))
+		return True
+
+	def query(self, table_name, hash_value, range_min=None, range_max=None, index=None,
+				descending=False, limit=None, start_key=None):
+		hash_key, range_key = table_keys(table_name)
+		idx_hash, idx_range = table_keys(table_name, index) if index else (hash_key, range_key)
+
+		# Index keys need not be unique, so order by the table keys as well
+		order = [idx_range, hash_key, range_key] if index else [range_key]
+
+		conditions = ['{} = ?'.format(_quote(idx_hash))]
+		params = [hash_value]
+		if range_min is not None:
+			conditions.append('{} >= ?'.format(_quote(idx_range)))
+			params.append(range_min)
+		if range_max is not None:
+			conditions.append('{} <= ?'.format(_quote(idx_range)))
+			params.append(range_max)
+		if start_key:
+			conditions.append('({}) {} ({})'.format(
+						', '.join(_quote(name) for name in order),
+						'<' if descending else '>',
+						', '.join('?' * len(order))))
+			params.extend(start_key[name] for name in order)
+
+		sql = 'SELECT item FROM {} WHERE {} ORDER BY {}'.format(
+					self._table_name(table_name),
+					' AND '.join(conditions),
+					', '.join('{} {}'.format(_quote(name), 'DESC' if descending else 'ASC') for name in order))
+		if limit:
+			# Fetch one extra row to learn whether more are available
+			sql += ' LIMIT {}'.format(int(limit) + 1)
+
+		with self._lock:
+			rows = self.conn.execute(sql, params).fetchall()
+
+		items = [json.loads(row[0]) for row in rows]
+		last_key = None
+		if limit and len(items) > limit:
+			items = items[:limit]
+			last_key = dict((name, items[-1][name]) for name in set(order + [idx_hash]))
+		return (items, last_key)
+
+	def scan(self, table_name, limit=None, start_key=None, segment=None, total_segments=None):
+		order = list(table_keys(table_name))
+
+		conditions = []
+		params = []
+		if start_key:
+			conditions.append('({}) > ({})'.format(', '.join(_quote(name) for name in order), ', '.join('?' * len(order))))
+			params.extend(start_key[name] for name in order)
+		if total_segments:
+			conditions.append('scan_segment({}, ?) = ?'.format(_quote(order[0])))
+			params.extend([total_segments, segment])
+
+		sql = 'SELECT item FROM {}'.format(self._table_name(table_name))
+		if conditions:
+			sql += ' WHERE ' + ' AND '.join(conditions)
+		sql += ' ORDER BY {}'.format(', '.join(_quote(name) for name in order))
+		if limit:
+			# Fetch one extra row to learn whether more are available
+			sql += ' LIMIT {}'.format(int(limit) + 1)
+
+		with self._lock:
+			rows = self.conn.execute(sql, params).fetchall()
+
+		items = [json.loads(row[0]) for row in rows]
+		last_key = None
+		if limit and len(items) > limit:
+			items = items[:limit]
+			last_key = dict((name, items[-1][name]) for name in order)
+		return (items, last_key)
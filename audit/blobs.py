@@ -0,0 +1,132 @@
+"""
+Content-addressed storage of large payloads, held outside the Audit table.
+
+A blob is named by the SHA-256 of its content, so a payload stored many times is held once, and
+an Audit item refers to it by that key.  The local filesystem store keeps each blob in a file
+named by its key, under a subdirectory of the first two characters of the key.  Files are written
+under a temporary name and renamed into place, so readers never see a partial blob, and any number
+of processes may share the directory.
+"""
+import os
+import re
+from hashlib import sha256
+from tempfile import mkstemp
+from threading import Lock
+
+_KEY_PATTERN = re.compile('^[0-9a-f]{64}$')
+
+class BlobStoreError(Exception):
+	"""Raised when a blob cannot be stored or read"""
+	pass
+
+class BlobNotFound(BlobStoreError):
+	"""Raised when no blob has the requested key"""
+	pass
+
+def blob_key(data):
+	"""
+	Returns the key of a blob's content
+	"""
+	return sha256(data).hexdigest()
+
+class BlobStore(object):
+	"""
+	Interface of a content-addressed blob store
+	"""
+	name = None
+
+	def put(self, data):
+		"""
+		Stores a blob, if no blob of the same content is already held, and returns its key
+		"""
+		raise NotImplementedError()
+
+	def get(self, key):
+		"""
+		Returns the content of the blob with the key, raising BlobNotFound if there is none
+		"""
+		raise NotImplementedError()
+
+	def stats(self):
+		"""
+		Returns the counters of the store
+		"""
+		return {}
+
+class FileBlobStore(BlobStore):
+	"""
+	Stores blobs as files beneath a local directory
+	"""
+	name = 'filesystem'
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.puts = 0
+		self.deduplicated = 0
+		self.bytes_written = 0
+		self.reads = 0
+		self._lock = Lock()
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def _path(self, key):
+		if not _KEY_PATTERN.match(key):
+			raise BlobNotFound('Invalid blob key: {}'.format(key))
+		return os.path.join(self.directory, key[:2], key[2:])
+
+	def put(self, data):
+		key = blob_key(data)
+		path = self._path(key)
+		if os.path.exists(path):
+			with self._lock:
+				self.puts += 1
+				self.deduplicated += 1
+			return key
+
+		try:
+			subdirectory = os.path.dirname(path)
+			if not os.path.isdir(subdirectory):
+				try:
+					os.makedirs(subdirectory)
+				except OSError:
+					# Created concurrently
+					if not os.path.isdir(subdirectory):
+						raise
+			fd, temp_path = mkstemp(dir=subdirectory, prefix='.tmp-')
+			try:
+				with os.fdopen(fd, 'wb') as f:
+					f.write(data)
+				os.rename(temp_path, path)
+			except Exception:
+				os.unlink(temp_path)
+				raise
+		except (IOError, OSError) as e:
+			raise BlobStoreError('Unable to store blob: {}'.format(e))
+
+		with self._lock:
+			self.puts += 1
+			self.bytes_written += len(data)
+		return key
+
+	def get(self, key):
+		path = self._path(key)
+		try:
+			with open(path, 'rb') as f:
+				data = f.read()
+		except IOError as e:
+			if not os.path.exists(path):
+				raise BlobNotFound('Blob not found: {}'.format(key))
+			raise BlobStoreError('Unable to read blob: {}'.format(e))
+
+		with self._lock:
+			self.reads += 1
+		return data
+
+	def stats(self):
+		with self._lock:
+			return {
+				'puts': self.puts,
+				'deduplicated': self.deduplicated,
+				'bytes_written': self.bytes_written,
+				'reads': self.reads
+			}
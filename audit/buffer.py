@@ -0,0 +1,238 @@
+"""
+Write-behind buffering, allowing saves to return before their data reaches DynamoDB.
+
+Items are queued in a bounded in-memory buffer and written in batches by a background
+flusher thread, once either enough items are waiting or the oldest has waited long enough.
+
+Items that fail to be written are retried with exponential backoff.  Items still failing are
+reported to stderr and, when a dead letter file is given, appended to it as JSON lines so that
+they can be saved again later; without one, they are lost.
+"""
+import json
+import sys
+from collections import deque
+from threading import Condition, Event, Thread
+from time import sleep, time
+
+class BufferFull(Exception):
+	"""Raised when an item cannot be queued before the put timeout expires"""
+	pass
+
+class Ticket(object):
+	"""
+	Tracks a single queued item until it has been flushed.
+
+	on_done, if given, is called with the outcome by the flusher thread, before waiters are released
+	"""
+	__slots__ = ('_done', 'error', '_on_done')
+
+	def __init__(self, on_done=None):
+		self._done = Event()
+		self.error = None
+		self._on_done = on_done
+
+	def _complete(self, error):
+		self.error = error
+		if self._on_done is not None:
+			try:
+				self._on_done(error)
+			except Exception as e:
+				sys.stderr.write('Write-behind: flush callback failed: {}\n'.format(e))
+		self._done.set()
+
+	def done(self):
+		return self._done.is_set()
+
+	def wait(self, timeout=None):
+		"""
+		Waits for the item to be flushed, returning None if saved or the error message if not
+		"""
+		if not self._done.wait(timeout):
+			return 'Timed out waiting for item to be flushed'
+		return self.error
+
+class WriteBehindBuffer(object):
+	"""
+	Bounded buffer with a background flusher.
+
+	flush_fn is called with a list of items and must return a list of the same length,
+	holding None for each saved item or an error message for each failed item.  Failed items
+	are retried up to retries times, waiting retry_backoff seconds before the first retry and
+	twice as long before each following one, then written to dead_letter_path if given.
+	"""
+	def __init__(self, flush_fn, max_size=10000, batch_size=100, max_age=0.05, put_timeout=1.0,
+					retries=3, retry_backoff=0.1, dead_letter_path=None):
+		if batch_size > max_size:
+			raise ValueError('Batch size cannot exceed buffer size')
+		self.flush_fn = flush_fn
+		self.max_size = max_size
+		self.batch_size = batch_size
+		self.max_age = max_age
+		self.put_timeout = put_timeout
+		self.retries = retries
+		self.retry_backoff = retry_backoff
+		self.dead_letter_path = dead_letter_path
+		self.flushes = 0
+		self.flushed_items = 0
+		self.failed_items = 0
+		self.retried_items = 0
+		self.dead_lettered = 0
+		self.rejected = 0
+		self._queue = deque()			# (enqueue time, item, ticket)
+		self._cond = Condition()
+		self._running = False
+		self._thread = None
+
+	def __len__(self):
+		return len(self._queue)
+
+	def start(self):
+		"""
+		Starts the background flusher
+		"""
+		with self._cond:
+			if self._running:
+				return
+			self._running = True
+		self._thread = Thread(target=self._run, name='audit-write-behind')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		"""
+		Stops the background flusher, once all queued items have been flushed
+		"""
+		with self._cond:
+			if not self._running:
+				return
+			self._running = False
+			self._cond.notify_all()
+		self._thread.join()
+		self._thread = None
+
+	def put(self, item, timeout=None, on_done=None):
+		"""
+		Queues the item, blocking while the buffer is full, and returns its Ticket.
+
+		Raises BufferFull if no space becomes available within the timeout (defaults to put_timeout)
+		"""
+		timeout = self.put_timeout if timeout is None else timeout
+		deadline = time() + timeout
+		ticket = Ticket(on_done)
+		with self._cond:
+			if not self._running:
+				raise BufferFull('Write buffer is not running')
+			while len(self._queue) >= self.max_size:
+				remaining = deadline - time()
+				if remaining <= 0:
+					self.rejected += 1
+					raise BufferFull('Write buffer full')
+				self._cond.wait(remaining)
+			self._queue.append((time(), item, ticket))
+
+			# Wake the flusher to start the age timer, or because a batch is ready
+			if len(self._queue) == 1 or len(self._queue) >= self.batch_size:
+				self._cond.notify_all()
+		return ticket
+
+	def stats(self):
+		"""
+		Returns the counters for this buffer
+		"""
+		with self._cond:
+			return {
+				'size': len(self._queue),
+				'max_size': self.max_size,
+				'flushes': self.flushes,
+				'flushed_items': self.flushed_items,
+				'failed_items': self.failed_items,
+				'retried_items': self.retried_items,
+				'dead_lettered': self.dead_lettered,
+				'rejected': self.rejected
+			}
+
+	def _take_batch(self):
+		"""
+		Waits until a batch is due, and removes it from the queue.
+
+		Returns an empty list once stopped and drained
+		"""
+		with self._cond:
+			while True:
+				if self._queue:
+					age = time() - self._queue[0][0]
+					if not self._running or len(self._queue) >= self.batch_size or age >= self.max_age:
+						break
+					self._cond.wait(self.max_age - age)
+				elif not self._running:
+					return []
+				else:
+					self._cond.wait()
+
+			batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+
+			# Space is now available for blocked producers
+			self._cond.notify_all()
+			return batch
+
+	def _flush(self, items):
+		try:
+			return list(self.flush_fn(items))
+		except Exception as e:
+			return [str(e)] * len(items)
+
+	def _dead_letter(self, failures):
+		"""
+		Reports items that could not be written, appending them to the dead letter file if there is one.
+
+		Returns the number of items written to the file
+		"""
+		written = 0
+		if self.dead_letter_path:
+			try:
+				with open(self.dead_letter_path, 'a') as f:
+					for item, error in failures:
+						f.write(json.dumps({'time': time(), 'error': error, 'item': item}, sort_keys=True) + '\n')
+				written = len(failures)
+			except (IOError, TypeError, ValueError) as e:
+				sys.stderr.write('Write-behind: unable to write dead letter file {}: {}\n'.format(self.dead_letter_path, e))
+
+		sys.stderr.write('Write-behind: {} items failed after {} retries ({}), {}\n'.format(
+					len(failures), self.retries, failures[0][1],
+					'written to {}'.format(self.dead_letter_path) if written else 'dropped'))
+		return written
+
+	def _run(self):
+		"""
+		Flusher thread main loop
+		"""
+		while True:
+			batch = self._take_batch()
+			if not batch:
+				return
+
+			items = [item for _, item, _ in batch]
+			errors = self._flush(items)
+
+			failed = [idx for idx, error in enumerate(errors) if error]
+			retried = 0
+			for attempt in range(self.retries):
+				if not failed:
+					break
+				sleep(self.retry_backoff * (2 ** attempt))
+				retried += len(failed)
+				for idx, error in zip(failed, self._flush([items[idx] for idx in failed])):
+					errors[idx] = error
+				failed = [idx for idx in failed if errors[idx]]
+
+			dead_lettered = self._dead_letter([(items[idx], errors[idx]) for idx in failed]) if failed else 0
+
+			for (_, _, ticket), error in zip(batch, errors):
+				ticket._complete(error)
+
+			with self._cond:
+				self.flushes += 1
+				self.flushed_items += len(batch) - len(failed)
+				self.failed_items += len(failed)
+				self.retried_items += retried
+				self.dead_lettered += dead_lettered
@@ -0,0 +1,313 @@
+"""
+Bulk import of audit records from JSON lines files.
+
+Each line holds one record, with the org and service that supplied it:
+
+	{"org_id": "...", "service_id": "...", "timestamp": 1234, "obo_id": "...", "actor_id": "..."}
+
+The file is read a line at a time, so memory use doesn't depend on its size.  Valid records are
+grouped into batches of BATCH_WRITE_SIZE items, which a pool of writer threads save in parallel.
+Invalid records, and records that fail to save, are written to an optional rejects file.
+
+Progress is kept in a checkpoint file as the byte offset before which every record has been saved
+or rejected, so that an interrupted import resumes from there.  Records after the checkpoint may
+be written again on resume, but as an item's key is derived from the record, a record rewritten
+replaces itself rather than being duplicated.
+"""
+import argparse
+import json
+import os
+import sys
+from audit.aws import Audit, ValidationError
+from audit.backends import BACKENDS, create_backend
+from audit.backends.dynamodb import BATCH_WRITE_SIZE
+from Queue import Queue
+from threading import Lock, Thread
+from time import time
+
+class BulkImportError(Exception):
+	"""Raised when an import cannot start"""
+	pass
+
+class _Batch(object):
+	"""
+	Items to save together, and the end of the input they were read from
+	"""
+	__slots__ = ('seq', 'end_offset', 'items', 'lines')
+
+	def __init__(self, seq):
+		self.seq = seq
+		self.end_offset = None
+		self.items = []
+		self.lines = []			# (offset, line) of each item, for rejects
+
+class BulkImporter(object):
+	"""
+	Imports the records of a JSON lines file through an Audit instance, which must be connected.
+
+	progress is called with the import statistics every progress_interval seconds, and when the import ends
+	"""
+	def __init__(self, audit, path, checkpoint_path=None, rejects_path=None, writers=4, batch_size=BATCH_WRITE_SIZE,
+					checkpoint_interval=5.0, progress=None, progress_interval=5.0):
+		if batch_size < 1 or batch_size > BATCH_WRITE_SIZE:
+			raise ValueError('Batch size must be between 1 and {}'.format(BATCH_WRITE_SIZE))
+		self.audit = audit
+		self.path = path
+		self.checkpoint_path = checkpoint_path
+		self.rejects_path = rejects_path
+		self.writers = writers
+		self.batch_size = batch_size
+		self.checkpoint_interval = checkpoint_interval
+		self.progress = progress
+		self.progress_interval = progress_interval
+
+		self.read = 0
+		self.saved = 0
+		self.failed = 0
+		self.rejected = 0
+		self._lock = Lock()
+		self._rejects = None
+
+		# Batches complete out of order; the checkpoint only advances over contiguous completed batches
+		self._completed = {}
+		self._next_seq = 0
+		self._committed = 0
+
+	def _load_checkpoint(self):
+		"""
+		Returns the offset to resume from
+		"""
+		if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+			return 0
+		with open(self.checkpoint_path) as f:
+			checkpoint = json.load(f)
+		if checkpoint.get('path', None) != os.path.abspath(self.path):
+			raise BulkImportError('Checkpoint {} is for another file: {}'.format(self.checkpoint_path, checkpoint.get('path', None)))
+		return checkpoint['offset']
+
+	def _save_checkpoint(self):
+		"""
+		Records the committed offset, replacing the checkpoint file atomically
+		"""
+		if not self.checkpoint_path:
+			return
+		with self._lock:
+			checkpoint = {'path': os.path.abspath(self.path), 'offset': self._committed, 'updated': time()}
+		temp_path = self.checkpoint_path + '.tmp'
+		with open(temp_path, 'w') as f:
+			json.dump(checkpoint, f)
+		os.rename(temp_path, self.checkpoint_path)
+
+	def _reject(self, offset, line, error):
+		"""
+		Records a record that was not saved; must hold the lock
+		"""
+		if self._rejects is not None:
+			self._rejects.write(json.dumps({'offset': offset, 'error': error, 'line': line.rstrip('\r\n')}) + '\n')
+
+	def _parse(self, line):
+		"""
+		Returns the Audit item for a line, raising ValidationError if it isn't a valid record
+		"""
+		try:
+			data = json.loads(line)
+		except ValueError:
+			raise ValidationError('Invalid JSON')
+		if not isinstance(data, dict):
+			raise ValidationError('Invalid data supplied')
+
+		org_id = data.pop('org_id', None)
+		service_id = data.pop('service_id', None)
+		if not isinstance(org_id, basestring) or not isinstance(service_id, basestring):
+			raise ValidationError('Record must include org_id and service_id')
+
+		self.audit._validate_save_record(data)
+		self.audit._validate_save_org(org_id, service_id)
+		return self.audit._create_audit_item(org_id, service_id, data)
+
+	def _write(self, queue):
+		"""
+		Saves batches from the queue until a None is received; runs on the writer threads
+		"""
+		while True:
+			batch = queue.get()
+			if batch is None:
+				return
+
+			errors = []
+			if batch.items:
+				try:
+					errors = self.audit._batch_save_to_table('Audit', batch.items)
+				except Exception as e:
+					errors = [str(e)] * len(batch.items)
+
+			with self._lock:
+				for (offset, line), error in zip(batch.lines, errors):
+					if error:
+						self.failed += 1
+						self._reject(offset, line, error)
+					else:
+						self.saved += 1
+
+				self._completed[batch.seq] = batch.end_offset
+				while self._next_seq in self._completed:
+					self._committed = self._completed.pop(self._next_seq)
+					self._next_seq += 1
+
+	def stats(self):
+		with self._lock:
+			return {
+				'read': self.read,
+				'saved': self.saved,
+				'failed': self.failed,
+				'rejected': self.rejected,
+				'offset': self._committed
+			}
+
+	def _report(self, start_offset, size, started):
+		if self.progress is None:
+			return
+		stats = self.stats()
+		elapsed = time() - started
+		stats['size'] = size
+		stats['elapsed'] = elapsed
+		stats['records_per_second'] = stats['saved'] / elapsed if elapsed else 0.0
+		stats['bytes_per_second'] = (stats['offset'] - start_offset) / elapsed if elapsed else 0.0
+		self.progress(stats)
+
+	def run(self):
+		"""
+		Imports the file from the checkpoint, if any, to its end.
+
+		Returns the statistics of the import.  The checkpoint is saved even if the import is interrupted
+		"""
+		start_offset = self._load_checkpoint()
+		size = os.path.getsize(self.path)
+		self._committed = start_offset
+		started = time()
+
+		queue = Queue(self.writers * 2)
+		threads = [Thread(target=self._write, args=(queue,), name='import-writer-{}'.format(i)) for i in range(self.writers)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+		self._rejects = open(self.rejects_path, 'a') if self.rejects_path else None
+		try:
+			next_checkpoint = started + self.checkpoint_interval
+			next_report = started + self.progress_interval
+			seq = 0
+			batch = _Batch(seq)
+			offset = start_offset
+
+			with open(self.path, 'rb') as f:
+				f.seek(start_offset)
+				for line in f:
+					line_offset = offset
+					offset += len(line)
+					if line.strip():
+						with self._lock:
+							self.read += 1
+						try:
+							item = self._parse(line)
+						except ValidationError as e:
+							with self._lock:
+								self.rejected += 1
+								self._reject(line_offset, line, e.message)
+						else:
+							batch.items.append(item)
+							batch.lines.append((line_offset, line))
+
+					if len(batch.items) == self.batch_size:
+						batch.end_offset = offset
+						queue.put(batch)
+						seq += 1
+						batch = _Batch(seq)
+
+					now = time()
+					if now >= next_checkpoint:
+						self._save_checkpoint()
+						next_checkpoint = now + self.checkpoint_interval
+					if now >= next_report:
+						self._report(start_offset, size, started)
+						next_report = now + self.progress_interval
+
+			# Submitted even if empty, so that the checkpoint reaches the end of the file
+			batch.end_offset = offset
+			queue.put(batch)
+		finally:
+			for _ in threads:
+				queue.put(None)
+			for thread in threads:
+				thread.join()
+			self._save_checkpoint()
+			if self._rejects is not None:
+				self._rejects.close()
+				self._rejects = None
+
+		self._report(start_offset, size, started)
+		return self.stats()
+
+def print_progress(stats):
+	"""
+	Reports progress to stderr
+	"""
+	sys.stderr.write('{:.1f}% of input: {} saved, {} failed, {} rejected; {:.0f} records/s\n'.format(
+				100.0 * stats['offset'] / stats['size'] if stats['size'] else 100.0,
+				stats['saved'], stats['failed'], stats['rejected'], stats['records_per_second']))
+
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='This imports audit records from a JSON lines file')
+	parser.add_argument('path', help='JSON lines file of records, each with org_id and service_id')
+	parser.add_argument('-c','--checkpoint', help='Checkpoint file, allowing an interrupted import to resume', default=None, required=False)
+	parser.add_argument('-j','--rejects', help='File to which records that are not saved are appended', default=None, required=False)
+	parser.add_argument('-n','--writers', help='Number of writer threads', type=int, default=4, required=False)
+	parser.add_argument('-b','--backend', help='Storage backend', choices=BACKENDS, default='dynamodb', required=False)
+	parser.add_argument('-f','--sqlite_path', help='Database file for the sqlite backend', default=':memory:', required=False)
+	parser.add_argument('-r','--region', help='DynamoDB region', required=False)
+	parser.add_argument('-k','--access_key', help='AWS Access Key', required=False)
+	parser.add_argument('-s','--secret_key', help='AWS Secret Key', required=False)
+	parser.add_argument('-p','--prefix', help='The table prefix in DynamoDB', required=False)
+	parser.add_argument('--hash_version', help='Hash version of new Audit keys; must match the API', type=int, default=1, required=False)
+	parser.add_argument('--item_encoding', help='Encoding of new Audit items; must match the API', choices=['full', 'compact'],
+						default='full', required=False)
+	parser.add_argument('--shard_config', help='JSON file of write shard counts, as given to the API', default=None, required=False)
+	parser.add_argument('--rate_limits', help='JSON object of the initial requests per second of each table, enabling adaptive rate limiting',
+						default=None, required=False)
+	args = parser.parse_args()
+
+	if args.backend == 'dynamodb' and not (args.region and args.access_key and args.secret_key and args.prefix):
+		parser.error('The dynamodb backend requires region, access_key, secret_key and prefix')
+
+	audit = Audit()
+	audit.set_hash_versions(args.hash_version)
+	audit.set_item_encoding(args.item_encoding)
+	if args.shard_config:
+		with open(args.shard_config) as f:
+			for org_id, services in json.load(f).items():
+				for service_id, shards in services.items():
+					audit.set_write_shards(org_id, service_id, shards)
+	audit.set_prefix(args.prefix)
+	if args.backend == 'dynamodb':
+		audit.connect(args.region, args.access_key, args.secret_key)
+	elif args.backend == 'sqlite':
+		audit.set_backend(create_backend('sqlite', path=args.sqlite_path))
+	else:
+		audit.set_backend(create_backend(args.backend))
+	if args.rate_limits:
+		audit.enable_rate_limiting(json.loads(args.rate_limits))
+
+	importer = BulkImporter(audit, args.path,
+				checkpoint_path=args.checkpoint,
+				rejects_path=args.rejects,
+				writers=args.writers,
+				progress=print_progress)
+	try:
+		stats = importer.run()
+	except KeyboardInterrupt:
+		sys.stderr.write('Import interrupted{}\n'.format('; rerun to resume from the checkpoint' if args.checkpoint else ''))
+		sys.exit(130)
+	json.dump(stats, sys.stdout, sort_keys=True)
+	print
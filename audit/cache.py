@@ -0,0 +1,311 @@
+"""
+Bounded in-process caches, used to avoid repeated DynamoDB reads on hot paths
+"""
+from audit import get_tm
+from audit.backends import TABLES, table_keys
+from collections import OrderedDict, deque
+from threading import Lock
+from time import time
+
+class LRUCache(object):
+	"""
+	Thread safe cache, bounded by entry count, with per-entry expiry.
+
+	Once max_size entries are held, the least recently used entry is evicted.
+	A ttl of None means entries only leave the cache through eviction or invalidation.
+	"""
+	def __init__(self, max_size=1024, ttl=None):
+		if max_size < 1:
+			raise ValueError('Cache size must be at least 1')
+		self.max_size = max_size
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._lock = Lock()
+		self._entries = OrderedDict()		# key -> (expiry, value)
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, key, default=None):
+		"""
+		Returns the cached value for the key, or default if absent or expired
+		"""
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None:
+				self.misses += 1
+				return default
+
+			expiry, value = entry
+			if expiry is not None and expiry <= time():
+				self.misses += 1
+				return default
+
+			# Reinsert to mark as most recently used
+			self._entries[key] = entry
+			self.hits += 1
+			return value
+
+	def put(self, key, value, ttl=None):
+		"""
+		Stores the value against the key; ttl overrides the cache default when supplied
+		"""
+		ttl = self.ttl if ttl is None else ttl
+		expiry = None if ttl is None else time() + ttl
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (expiry, value)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+				self.evictions += 1
+
+	def invalidate(self, key):
+		"""
+		Removes the key from the cache, if present
+		"""
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def clear(self):
+		"""
+		Removes all entries, leaving the counters intact
+		"""
+		with self._lock:
+			self._entries.clear()
+
+	def stats(self):
+		"""
+		Returns the counters for this cache
+		"""
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				'size': len(self._entries),
+				'max_size': self.max_size,
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'hit_rate': float(self.hits) / lookups if lookups else 0.0
+			}
+
+def _item_size(item):
+	"""Approximate memory held by a storage item"""
+	size = 64
+	for name, value in item.items():
+		size += 48 + len(name) + (len(value) if isinstance(value, basestring) else 8)
+	return size
+
+class QueryCache(object):
+	"""
+	Thread safe cache of storage query pages, bounded by their approximate size in bytes.
+
+	Entries are keyed by (table, index, hash value, range bounds, order, limit, start key), and indexed
+	by (table, index, hash value), so that a write invalidates only the entries whose hash key and range
+	bounds cover the written item.  Once max_bytes are held, the least recently used entries are evicted.
+	"""
+	def __init__(self, max_bytes=64 * 1024 * 1024, max_log=4096):
+		if max_bytes < 1:
+			raise ValueError('Cache size must be at least 1 byte')
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+		self._lock = Lock()
+		self._entries = OrderedDict()		# key -> (expiry, size, items, last_key)
+		self._by_hash = {}					# (table, index, hash value) -> set of keys
+
+		# Recent invalidations as (sequence, (table, index, hash value)), so that a page read before a write,
+		# and stored after it, is not cached
+		self._seq = 0
+		self._log = deque(maxlen=max_log)
+
+	def __len__(self):
+		return len(self._entries)
+
+	def sequence(self):
+		"""
+		Returns the invalidation sequence number, to pass to put for a page read from now on
+		"""
+		with self._lock:
+			return self._seq
+
+	def get(self, key):
+		"""
+		Returns the cached (items, last_key) for the key, or None if absent or expired
+		"""
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None:
+				self.misses += 1
+				return None
+
+			if entry[0] <= time():
+				self._remove(key, entry)
+				self.misses += 1
+				return None
+
+			# Reinsert to mark as most recently used
+			self._entries[key] = entry
+			self.hits += 1
+			return (list(entry[2]), entry[3])
+
+	def put(self, key, items, last_key, ttl, sequence):
+		"""
+		Stores a page read after sequence was taken, unless its hash key has been written since then
+		"""
+		hash_key = key[:3]
+		size = 256 + sum(_item_size(item) for item in items)
+		with self._lock:
+			if sequence != self._seq:
+				if not self._log or self._log[0][0] > sequence + 1:
+					# The log no longer reaches back to the read
+					return
+				if any(seq > sequence and logged == hash_key for seq, logged in self._log):
+					return
+
+			previous = self._entries.pop(key, None)
+			if previous is not None:
+				self._remove(key, previous)
+			if size > self.max_bytes:
+				return
+			self._entries[key] = (time() + ttl, size, items, last_key)
+			self._by_hash.setdefault(hash_key, set()).add(key)
+			self.bytes += size
+			while self.bytes > self.max_bytes:
+				old_key, old_entry = self._entries.popitem(last=False)
+				self._remove(old_key, old_entry)
+				self.evictions += 1
+
+	def _remove(self, key, entry):
+		"""
+		Accounts for an entry already taken from the entries; must hold the lock
+		"""
+		self.bytes -= entry[1]
+		keys = self._by_hash.get(key[:3], None)
+		if keys is not None:
+			keys.discard(key)
+			if not keys:
+				del self._by_hash[key[:3]]
+
+	def invalidate(self, table_name, index, hash_value, range_value):
+		"""
+		Removes the entries of the hash key whose range bounds include the range key value
+		"""
+		hash_key = (table_name, index, hash_value)
+		with self._lock:
+			self._seq += 1
+			self._log.append((self._seq, hash_key))
+			for key in list(self._by_hash.get(hash_key, ())):
+				range_min, range_max = key[3], key[4]
+				if (range_min is None or range_value >= range_min) and (range_max is None or range_value <= range_max):
+					self._remove(key, self._entries.pop(key))
+					self.invalidations += 1
+
+	def clear(self):
+		"""
+		Removes all entries, leaving the counters intact
+		"""
+		with self._lock:
+			self._entries.clear()
+			self._by_hash.clear()
+			self.bytes = 0
+
+	def stats(self):
+		"""
+		Returns the counters for this cache
+		"""
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				'size': len(self._entries),
+				'bytes': self.bytes,
+				'max_bytes': self.max_bytes,
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'invalidations': self.invalidations,
+				'hit_rate': float(self.hits) / lookups if lookups else 0.0
+			}
+
+class CachedQueryBackend(object):
+	"""
+	View of a storage backend whose queries of the cached tables are read through a QueryCache.
+
+	Writes made through the view invalidate the entries they affect.  Writes made elsewhere, such as by
+	other processes, are seen once entries expire: pages of closed time ranges, ending over closed_after
+	seconds ago, are kept for closed_ttl seconds, and pages of open ranges for open_ttl.  Other attributes
+	are those of the backend
+	"""
+	def __init__(self, backend, cache, tables=('Audit',), open_ttl=5, closed_ttl=3600, closed_after=300):
+		self._backend = backend
+		self._cache = cache
+		self._tables = tables
+		self._open_ttl = open_ttl
+		self._closed_ttl = closed_ttl
+		self._closed_after = closed_after
+
+	def __getattr__(self, name):
+		return getattr(self._backend, name)
+
+	def _invalidate(self, table_name, items):
+		if table_name not in self._tables:
+			return
+		keys = [table_keys(table_name)] + [table_keys(table_name, index) for index in TABLES[table_name]['indexes']]
+		indexes = [None] + list(TABLES[table_name]['indexes'])
+		for item in items:
+			for index, (hash_key, range_key) in zip(indexes, keys):
+				if hash_key in item and range_key in item:
+					self._cache.invalidate(table_name, index, item[hash_key], item[range_key])
+
+	def put(self, table_name, item):
+		try:
+			return self._backend.put(table_name, item)
+		finally:
+			self._invalidate(table_name, [item])
+
+	def batch_put(self, table_name, items):
+		try:
+			return self._backend.batch_put(table_name, items)
+		finally:
+			self._invalidate(table_name, items)
+
+	def put_if_absent(self, table_name, item):
+		try:
+			return self._backend.put_if_absent(table_name, item)
+		finally:
+			self._invalidate(table_name, [item])
+
+	def delete(self, table_name, key):
+		try:
+			return self._backend.delete(table_name, key)
+		finally:
+			self._invalidate(table_name, [key])
+
+	def increment(self, table_name, key, counters):
+		try:
+			return self._backend.increment(table_name, key, counters)
+		finally:
+			self._invalidate(table_name, [key])
+
+	def query(self, table_name, hash_value, range_min=None, range_max=None, index=None,
+				descending=False, limit=None, start_key=None):
+		if table_name not in self._tables:
+			return self._backend.query(table_name, hash_value, range_min=range_min, range_max=range_max, index=index,
+						descending=descending, limit=limit, start_key=start_key)
+
+		key = (table_name, index, hash_value, range_min, range_max, descending, limit,
+				tuple(sorted(start_key.items())) if start_key else None)
+		page = self._cache.get(key)
+		if page is not None:
+			return page
+
+		sequence = self._cache.sequence()
+		items, last_key = self._backend.query(table_name, hash_value, range_min=range_min, range_max=range_max, index=index,
+					descending=descending, limit=limit, start_key=start_key)
+		closed = range_max is not None and range_max < get_tm() - self._closed_after * 1000000
+		self._cache.put(key, items, last_key, self._closed_ttl if closed else self._open_ttl, sequence)
+		return (list(items), last_key)
@@ -0,0 +1,64 @@
+"""
+Change payloads of audit records: the state of the changed data before and after the change.
+
+A payload is stored in its Audit item as a string, in one of three forms:
+
+	j:<JSON>			 - small payloads, which compression would not shrink
+	z:<base64 zlib>		 - compressed payloads up to the inline limit
+	b:<blob key>		 - larger payloads, compressed and offloaded to a blob store
+
+Payloads are held as strings, not binary, so that every storage backend can store them.  They are
+only decoded when a read asks for them, so other queries pay nothing for the compression, and
+offloading keeps the items that are read, and copied to the org-user index, small.
+"""
+import json
+import zlib
+from base64 import b64decode, b64encode
+from audit.blobs import BlobStoreError
+from audit.schema import Field, ValidationError
+
+# Longest change payload accepted, as compact JSON
+MAX_CHANGES_SIZE = 256 * 1024
+
+# Compressed payloads longer than this are offloaded, when a blob store is available
+DEFAULT_INLINE_LIMIT = 4096
+
+# Schema of the change payload of a record: the changed data before and after, omitted on create or delete
+CHANGES_FIELD = Field('changes', 'M', required=False, schema=[
+	Field('before', 'M', required=False),
+	Field('after', 'M', required=False),
+])
+
+def encode_changes(changes, blob_store=None, inline_limit=DEFAULT_INLINE_LIMIT):
+	"""
+	Returns the stored form of a validated change payload, offloading it to the blob store if it is
+	larger than inline_limit once compressed
+	"""
+	data = json.dumps(changes, sort_keys=True, separators=(',', ':'))
+	if len(data) > MAX_CHANGES_SIZE:
+		raise ValidationError('Field changes exceeds the maximum size of {} bytes'.format(MAX_CHANGES_SIZE))
+
+	compressed = zlib.compress(data)
+	if blob_store is not None and len(compressed) > inline_limit:
+		try:
+			return 'b:' + blob_store.put(compressed)
+		except BlobStoreError as e:
+			raise ValidationError('Unable to store changes: {}'.format(e.message))
+
+	encoded = 'z:' + b64encode(compressed)
+	return encoded if len(encoded) < len(data) + 2 else 'j:' + data
+
+def decode_changes(value, blob_store=None):
+	"""
+	Returns the change payload held in its stored form, reading it from the blob store if offloaded
+	"""
+	form, data = value[:2], value[2:]
+	if form == 'j:':
+		return json.loads(data)
+	if form == 'z:':
+		return json.loads(zlib.decompress(b64decode(data)))
+	if form == 'b:':
+		if blob_store is None:
+			raise BlobStoreError('No blob store available to read changes')
+		return json.loads(zlib.decompress(blob_store.get(data)))
+	raise ValueError('Unknown changes form: {}'.format(form))
@@ -0,0 +1,415 @@
+"""
+Export of the Audit table to columnar chunk files, and a reader that answers filters from them.
+
+The table is scanned in disjoint segments (DynamoDB parallel Scan), by a pool of worker processes.
+Each segment's items are written to chunk files of at most chunk_rows rows, sorted by timestamp:
+
+	timestamp                    int64
+	string attributes            int32 codes into a dictionary held in the chunk; -1 if absent.
+	                             obo_id and actor_id share a dictionary, so they compare as codes
+
+Numeric sections are stored uncompressed and 8 byte aligned, so that the reader memory-maps them
+rather than reading them; the dictionaries are zlib compressed.  A manifest lists the chunks with
+their row counts and timestamp ranges, so a reader skips chunks outside a filter's time range.
+
+Chunk file layout: b'AZC1', the header length as a little endian uint32, the JSON header, then the
+sections; section offsets in the header are relative to the first 8 byte boundary after the header.
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from audit import get_tm, np, INT64_TYPECODE
+from audit.backends import BACKENDS, StorageBackend, create_backend
+from audit.query import _plain
+from audit.record import full_item
+from bisect import bisect_left, bisect_right
+from multiprocessing import Pool, cpu_count
+
+CHUNK_MAGIC = b'AZC1'
+MANIFEST_NAME = 'manifest.json'
+
+# Exported attributes of Audit items: (name, type, dictionary)
+EXPORT_COLUMNS = (
+	('timestamp', 'int64', None),
+	('service-org_hash', 'codes', 'service-org_hash'),
+	('org-user_hash', 'codes', 'org-user_hash'),
+	('service_id', 'codes', 'service_id'),
+	('obo_id', 'codes', 'user'),
+	('actor_id', 'codes', 'user'),
+)
+
+# Little endian element formats of the section types
+_SECTION_TYPES = {
+	'int64': (INT64_TYPECODE, '<i8', 8),
+	'codes': ('i', '<i4', 4),
+}
+
+def _align(position):
+	return (position + 7) & ~7
+
+def _to_bytes(values, section_type):
+	"""Serialises a list of integers as a little endian section"""
+	typecode, _, size = _SECTION_TYPES[section_type]
+	data = array(typecode, values)
+	if data.itemsize != size:
+		raise ValueError('No {} byte array type available'.format(size))
+	if sys.byteorder != 'little':
+		data.byteswap()
+	return data.tostring()
+
+class ChunkWriter(object):
+	"""
+	Buffers items and writes them as chunk files of at most chunk_rows rows.
+
+	chunks lists the manifest entries of the files written
+	"""
+	def __init__(self, directory, name, chunk_rows=65536):
+		self.directory = directory
+		self.name = name
+		self.chunk_rows = chunk_rows
+		self.chunks = []
+		self._reset()
+
+	def _reset(self):
+		self._timestamps = []
+		self._codes = dict((column, []) for column, column_type, _ in EXPORT_COLUMNS if column_type == 'codes')
+		self._dictionaries = dict((dictionary, {}) for _, _, dictionary in EXPORT_COLUMNS if dictionary)
+
+	def add(self, item):
+		item = full_item(item)
+		self._timestamps.append(int(item['timestamp']))
+		for column, column_type, dictionary in EXPORT_COLUMNS:
+			if column_type != 'codes':
+				continue
+			value = item.get(column, None)
+			if value is None:
+				code = -1
+			else:
+				codes = self._dictionaries[dictionary]
+				code = codes.get(value, None)
+				if code is None:
+					code = codes[value] = len(codes)
+			self._codes[column].append(code)
+
+		if len(self._timestamps) >= self.chunk_rows:
+			self.flush()
+
+	def flush(self):
+		"""
+		Writes the buffered items as a chunk, if there are any
+		"""
+		rows = len(self._timestamps)
+		if not rows:
+			return
+
+		order = sorted(range(rows), key=self._timestamps.__getitem__)
+		sections = [('timestamp', _to_bytes([self._timestamps[i] for i in order], 'int64'))]
+		for column, column_type, _ in EXPORT_COLUMNS:
+			if column_type == 'codes':
+				codes = self._codes[column]
+				sections.append((column, _to_bytes([codes[i] for i in order], 'codes')))
+		for dictionary, codes in sorted(self._dictionaries.items()):
+			values = [None] * len(codes)
+			for value, code in codes.items():
+				values[code] = value
+			sections.append(('dictionary:' + dictionary, zlib.compress(json.dumps(values))))
+
+		header = {'rows': rows, 'sections': {}}
+		position = 0
+		for section_name, data in sections:
+			header['sections'][section_name] = (position, len(data))
+			position = _align(position + len(data))
+		header_data = json.dumps(header, sort_keys=True)
+
+		file_name = '{}-{:05d}.azc'.format(self.name, len(self.chunks))
+		with open(os.path.join(self.directory, file_name), 'wb') as f:
+			f.write(CHUNK_MAGIC)
+			f.write(struct.pack('<I', len(header_data)))
+			f.write(header_data)
+			f.write('\0' * (_align(8 + len(header_data)) - 8 - len(header_data)))
+			for section_name, data in sections:
+				f.write(data)
+				f.write('\0' * (_align(len(data)) - len(data)))
+
+		self.chunks.append({
+			'file': file_name,
+			'rows': rows,
+			'tm_min': self._timestamps[order[0]],
+			'tm_max': self._timestamps[order[-1]]
+		})
+		self._reset()
+
+def export_segment(backend, directory, segment, total_segments, chunk_rows=65536, page_size=1000):
+	"""
+	Writes the Audit items of one scan segment as chunk files, returning their manifest entries
+	"""
+	writer = ChunkWriter(directory, 'segment-{:04d}'.format(segment), chunk_rows)
+	start_key = None
+	while True:
+		items, start_key = backend.scan('Audit', limit=page_size, start_key=start_key,
+					segment=segment, total_segments=total_segments)
+		for item in items:
+			writer.add(_plain(item))
+		if not start_key:
+			break
+	writer.flush()
+	for chunk in writer.chunks:
+		chunk['segment'] = segment
+	return writer.chunks
+
+def _export_segment(args):
+	"""
+	Runs on a pool process, with its own connection to storage
+	"""
+	backend_spec, directory, segment, total_segments, chunk_rows = args
+	backend = create_backend(backend_spec['name'], **backend_spec.get('args', {}))
+	backend.set_prefix(backend_spec.get('prefix', None))
+	return export_segment(backend, directory, segment, total_segments, chunk_rows)
+
+def export_table(backend, directory, segments=8, processes=None, chunk_rows=65536):
+	"""
+	Exports the Audit table to chunk files and a manifest in the directory, returning the manifest.
+
+	backend is either a StorageBackend, whose segments are exported in this process, or a spec of the form
+	{'name': ..., 'args': {...}, 'prefix': ...} from which each of the worker processes creates its own
+	"""
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+
+	if isinstance(backend, StorageBackend):
+		results = [export_segment(backend, directory, segment, segments, chunk_rows) for segment in range(segments)]
+	else:
+		pool = Pool(processes or min(segments, cpu_count()))
+		try:
+			results = pool.map(_export_segment, [(backend, directory, segment, segments, chunk_rows) for segment in range(segments)])
+		finally:
+			pool.terminate()
+			pool.join()
+
+	chunks = [chunk for result in results for chunk in result]
+	manifest = {
+		'version': 1,
+		'table': 'Audit',
+		'created': get_tm(),
+		'segments': segments,
+		'rows': sum(chunk['rows'] for chunk in chunks),
+		'columns': [{'name': column, 'type': column_type, 'dictionary': dictionary} for column, column_type, dictionary in EXPORT_COLUMNS],
+		'chunks': chunks
+	}
+
+	# Written last, so a directory with a manifest holds a complete export
+	with open(os.path.join(directory, MANIFEST_NAME), 'w') as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	return manifest
+
+class Chunk(object):
+	"""
+	A memory-mapped chunk file.  Columns are NumPy arrays over the mapping if NumPy is available,
+	otherwise arrays copied from it
+	"""
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if self._map[:4] != CHUNK_MAGIC:
+			raise ValueError('{} is not a chunk file'.format(path))
+		header_length = struct.unpack('<I', self._map[4:8])[0]
+		header = json.loads(self._map[8:8 + header_length])
+		self.rows = header['rows']
+		self._sections = header['sections']
+		self._start = _align(8 + header_length)
+		self._dictionaries = {}
+		self._lookups = {}
+
+	def _section(self, name):
+		offset, length = self._sections[name]
+		return (self._start + offset, length)
+
+	def column(self, name, column_type):
+		offset, length = self._section(name)
+		typecode, dtype, size = _SECTION_TYPES[column_type]
+		if np is not None:
+			return np.frombuffer(self._map, dtype=dtype, count=length // size, offset=offset)
+		values = array(typecode)
+		values.fromstring(self._map[offset:offset + length])
+		if sys.byteorder != 'little':
+			values.byteswap()
+		return values
+
+	def dictionary(self, name):
+		"""
+		Returns the list of values of the dictionary, indexed by code
+		"""
+		values = self._dictionaries.get(name, None)
+		if values is None:
+			offset, length = self._section('dictionary:' + name)
+			values = self._dictionaries[name] = json.loads(zlib.decompress(self._map[offset:offset + length]))
+		return values
+
+	def code(self, dictionary, value):
+		"""
+		Returns the code of the value in the dictionary, or None if the chunk doesn't hold it
+		"""
+		lookup = self._lookups.get(dictionary, None)
+		if lookup is None:
+			lookup = self._lookups[dictionary] = dict((v, code) for code, v in enumerate(self.dictionary(dictionary)))
+		return lookup.get(value, None)
+
+	def close(self):
+		self._map.close()
+
+class ExportReader(object):
+	"""
+	Answers filters over an export, reading only the chunks and columns needed
+	"""
+	def __init__(self, directory):
+		self.directory = directory
+		with open(os.path.join(directory, MANIFEST_NAME)) as f:
+			self.manifest = json.load(f)
+		self.columns = [(c['name'], c['type'], c['dictionary']) for c in self.manifest['columns']]
+		self._column_dictionaries = dict((column, dictionary) for column, _, dictionary in self.columns)
+		self._chunks = {}
+
+	def _chunk(self, entry):
+		chunk = self._chunks.get(entry['file'], None)
+		if chunk is None:
+			chunk = self._chunks[entry['file']] = Chunk(os.path.join(self.directory, entry['file']))
+		return chunk
+
+	def _matches(self, chunk, tm_from, tm_to, equals, on_behalf):
+		"""
+		Returns the sorted row numbers of the chunk that match the filters, or None if there are none
+		"""
+		# Rows are sorted by timestamp, so the time range is a slice
+		timestamps = chunk.column('timestamp', 'int64')
+		if np is not None:
+			start = np.searchsorted(timestamps, tm_from, 'left') if tm_from is not None else 0
+			end = np.searchsorted(timestamps, tm_to, 'right') if tm_to is not None else chunk.rows
+		else:
+			start = bisect_left(timestamps, tm_from) if tm_from is not None else 0
+			end = bisect_right(timestamps, tm_to) if tm_to is not None else chunk.rows
+		if start >= end:
+			return None
+
+		conditions = []
+		for column, value in equals:
+			code = chunk.code(self._column_dictionaries[column], value)
+			if code is None:
+				return None
+			conditions.append((chunk.column(column, 'codes'), code))
+
+		if on_behalf is not None:
+			obo = chunk.column('obo_id', 'codes')
+			actor = chunk.column('actor_id', 'codes')
+
+		if np is not None:
+			mask = np.ones(end - start, dtype=bool)
+			for codes, code in conditions:
+				mask &= codes[start:end] == code
+			if on_behalf is not None:
+				mask &= (obo[start:end] != actor[start:end]) == on_behalf
+			rows = np.flatnonzero(mask) + start
+			return rows if len(rows) else None
+
+		rows = [row for row in xrange(start, end)
+					if all(codes[row] == code for codes, code in conditions)
+					and (on_behalf is None or (obo[row] != actor[row]) == on_behalf)]
+		return rows or None
+
+	def _filter(self, tm_from, tm_to, service_id, obo_id, actor_id, on_behalf):
+		"""
+		Yields (chunk, rows) for each chunk with matching rows
+		"""
+		equals = [(column, value) for column, value in
+					(('service_id', service_id), ('obo_id', obo_id), ('actor_id', actor_id)) if value is not None]
+		for entry in self.manifest['chunks']:
+			if (tm_from is not None and entry['tm_max'] < tm_from) or (tm_to is not None and entry['tm_min'] > tm_to):
+				continue
+			chunk = self._chunk(entry)
+			rows = self._matches(chunk, tm_from, tm_to, equals, on_behalf)
+			if rows is not None:
+				yield (chunk, rows)
+
+	def count(self, tm_from=None, tm_to=None, service_id=None, obo_id=None, actor_id=None, on_behalf=None):
+		"""
+		Returns the number of records matching the filters; on_behalf selects records whose actor is,
+		or is not, someone other than the obo user
+		"""
+		return sum(len(rows) for _, rows in self._filter(tm_from, tm_to, service_id, obo_id, actor_id, on_behalf))
+
+	def records(self, tm_from=None, tm_to=None, service_id=None, obo_id=None, actor_id=None, on_behalf=None):
+		"""
+		Yields the items matching the filters, in timestamp order within each chunk
+		"""
+		for chunk, rows in self._filter(tm_from, tm_to, service_id, obo_id, actor_id, on_behalf):
+			columns = [(column, column_type, chunk.column(column, column_type), chunk.dictionary(dictionary) if dictionary else None)
+						for column, column_type, dictionary in self.columns]
+			for row in rows:
+				item = {}
+				for column, column_type, values, dictionary in columns:
+					value = int(values[row])
+					if dictionary is None:
+						item[column] = value
+					elif value >= 0:
+						item[column] = dictionary[value]
+				yield item
+
+	def close(self):
+		for chunk in self._chunks.values():
+			chunk.close()
+		self._chunks = {}
+
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='This exports the Audit table to columnar files, or queries an export')
+	parser.add_argument('directory', help='Directory of the export')
+	parser.add_argument('-q','--query', help='Query the export, rather than creating it', action='store_true', default=False, required=False)
+	parser.add_argument('--segments', help='Number of scan segments', type=int, default=8, required=False)
+	parser.add_argument('--processes', help='Number of export processes, defaults to one per segment up to the number of cores',
+						type=int, default=None, required=False)
+	parser.add_argument('--chunk_rows', help='Maximum rows in each chunk file', type=int, default=65536, required=False)
+	parser.add_argument('-b','--backend', help='Storage backend', choices=BACKENDS, default='dynamodb', required=False)
+	parser.add_argument('-f','--sqlite_path', help='Database file for the sqlite backend', default=None, required=False)
+	parser.add_argument('-r','--region', help='DynamoDB region', required=False)
+	parser.add_argument('-k','--access_key', help='AWS Access Key', required=False)
+	parser.add_argument('-s','--secret_key', help='AWS Secret Key', required=False)
+	parser.add_argument('-p','--prefix', help='The table prefix in DynamoDB', required=False)
+	parser.add_argument('--tm_from', help='Query records from this timestamp', type=int, default=None, required=False)
+	parser.add_argument('--tm_to', help='Query records up to this timestamp', type=int, default=None, required=False)
+	parser.add_argument('--service_id', help='Query records of this service', default=None, required=False)
+	parser.add_argument('--obo_id', help='Query records on behalf of this user', default=None, required=False)
+	parser.add_argument('--actor_id', help='Query records by this actor', default=None, required=False)
+	parser.add_argument('--count', help='Only count the matching records', action='store_true', default=False, required=False)
+	args = parser.parse_args()
+
+	if args.query:
+		reader = ExportReader(args.directory)
+		filters = dict(tm_from=args.tm_from, tm_to=args.tm_to, service_id=args.service_id, obo_id=args.obo_id, actor_id=args.actor_id)
+		if args.count:
+			print reader.count(**filters)
+		else:
+			for item in reader.records(**filters):
+				print json.dumps(item, sort_keys=True)
+		sys.exit(0)
+
+	if args.backend == 'dynamodb':
+		if not (args.region and args.access_key and args.secret_key and args.prefix):
+			parser.error('The dynamodb backend requires region, access_key, secret_key and prefix')
+		backend_args = {'region_name': args.region, 'access_key': args.access_key, 'secret_key': args.secret_key}
+	elif args.backend == 'sqlite':
+		if not args.sqlite_path:
+			parser.error('The sqlite backend requires a database file')
+		backend_args = {'path': args.sqlite_path}
+	else:
+		parser.error('Only persistent backends can be exported')
+
+	manifest = export_table({'name': args.backend, 'args': backend_args, 'prefix': args.prefix}, args.directory,
+				segments=args.segments,
+				processes=args.processes,
+				chunk_rows=args.chunk_rows)
+	print json.dumps({'rows': manifest['rows'], 'chunks': len(manifest['chunks'])})
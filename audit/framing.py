@@ -0,0 +1,107 @@
+"""
+Framing of the streaming ingest protocol, shared by the server (rest_api.stream) and its clients.
+
+A client opens a TCP connection and sends b'AZS1' followed by one byte naming the encoding of the
+frames: 'm' for msgpack, or 'j' for JSON where msgpack is not installed.  Every message after that
+is a frame: its length as a big endian uint32, then the encoded body.
+
+	server -> client	{"window": frames, "max_frame": bytes}, once, in reply to the opening
+	client -> server	[[org_id, service_id, record], ...], with records as for the save API
+	server -> client	{"ack": seq, "saved": count, "failed": [[seq, index, error_message], ...]}
+	server -> client	{"error": error_message}, before closing the connection on a protocol error
+
+Client frames are numbered from 0 in the order sent.  An ack covers every frame up to and including
+seq, with the saved count and failures of the frames since the previous ack.  A client may have up to
+window frames unacknowledged, so that frames are processed while the next are in flight.
+"""
+import json
+import struct
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+STREAM_MAGIC = b'AZS1'
+
+_LENGTH = struct.Struct('>I')
+
+# Default number of unacknowledged frames, and largest frame, in bytes
+DEFAULT_WINDOW = 32
+DEFAULT_MAX_FRAME = 4 * 1024 * 1024
+
+class FrameError(Exception):
+	"""Raised when a stream does not follow the protocol"""
+	pass
+
+class _JSONCodec(object):
+	name = 'json'
+
+	@staticmethod
+	def dumps(value):
+		return json.dumps(value, separators=(',', ':'))
+
+	@staticmethod
+	def loads(data):
+		return json.loads(data)
+
+class _MsgpackCodec(object):
+	name = 'msgpack'
+
+	@staticmethod
+	def dumps(value):
+		return msgpack.packb(value, use_bin_type=True)
+
+	@staticmethod
+	def loads(data):
+		return msgpack.unpackb(data, raw=False)
+
+def codecs():
+	"""
+	Returns the codecs available, by their encoding byte
+	"""
+	available = {b'j': _JSONCodec}
+	if msgpack is not None:
+		available[b'm'] = _MsgpackCodec
+	return available
+
+def encode_frame(codec, value):
+	"""
+	Returns the frame holding the value
+	"""
+	body = codec.dumps(value)
+	return _LENGTH.pack(len(body)) + body
+
+class FrameReader(object):
+	"""
+	Splits the bytes of a stream into frame bodies, as they arrive
+	"""
+	def __init__(self, max_frame=DEFAULT_MAX_FRAME):
+		self.max_frame = max_frame
+		self._buffer = b''
+
+	def feed(self, data):
+		"""
+		Adds received bytes, returning the bodies of the frames they complete
+		"""
+		buf = self._buffer + data if self._buffer else data
+		bodies = []
+		start = 0
+		while len(buf) - start >= 4:
+			(length,) = _LENGTH.unpack_from(buf, start)
+			if length > self.max_frame:
+				raise FrameError('Frame of {} bytes exceeds the maximum of {}'.format(length, self.max_frame))
+			end = start + 4 + length
+			if end > len(buf):
+				break
+			bodies.append(buf[start + 4:end])
+			start = end
+		self._buffer = buf[start:]
+		return bodies
+
+	@property
+	def pending(self):
+		"""
+		Whether a partial frame has been received
+		"""
+		return bool(self._buffer)
@@ -0,0 +1,106 @@
+"""
+Versioned, memoised hashing of the composite keys of the Audit table.
+
+Each hash version is a function of the key items.  Version 1 is the original create_hash
+digest, so that records written before versioning remain queryable.  Later versions prefix
+their digests with '<version>:', so the version of any stored key can be identified.
+
+Key attributes are strings in the table schema, so version 3 stores the raw digest in base64,
+which is 16 characters for 96 bits rather than 24 in hex.
+"""
+from audit import create_hash
+from audit.cache import LRUCache
+from base64 import urlsafe_b64encode
+from zlib import crc32
+
+try:
+	from hashlib import blake2b
+except ImportError:
+	try:
+		from pyblake2 import blake2b
+	except ImportError:
+		blake2b = None
+
+# Hash functions by version; each takes a tuple of key items and returns the key
+HASH_VERSIONS = {}
+
+def register_hash_version(version, fn):
+	"""
+	Adds a hash function, making it available for writes and reads
+	"""
+	if version in HASH_VERSIONS:
+		raise ValueError('Hash version {} already registered'.format(version))
+	HASH_VERSIONS[version] = fn
+
+def _md5_v1(items):
+	"""The original md5 based key"""
+	return create_hash(*items)
+
+def _blake2b_v2(items):
+	"""Shorter 96 bit blake2b key over the '|' separated items"""
+	data = u'|'.join(items).encode('utf-8')
+	return '2:' + blake2b(data, digest_size=12).hexdigest()
+
+def _blake2b_v3(items):
+	"""The version 2 digest, in base64 rather than hex"""
+	data = u'|'.join(items).encode('utf-8')
+	return '3:' + urlsafe_b64encode(blake2b(data, digest_size=12).digest())
+
+register_hash_version(1, _md5_v1)
+if blake2b is not None:
+	register_hash_version(2, _blake2b_v2)
+	register_hash_version(3, _blake2b_v3)
+
+def shard_key(hash_value, shard):
+	"""
+	Returns the key of one write shard of a hash key
+	"""
+	return '{}#{}'.format(hash_value, shard)
+
+def record_shard(obo_id, timestamp, shards):
+	"""
+	Returns the write shard of a record; deterministic, so a record always maps to the same shard
+	"""
+	return (crc32(u'{}|{}'.format(obo_id, timestamp).encode('utf-8')) & 0xffffffff) % shards
+
+class KeyHasher(object):
+	"""
+	Creates keys with the write version, memoising recent results.
+
+	Reads query the keys of read_versions, only the write version unless others are given; while
+	migrating between versions, read_versions must include every version that may have been written.
+	"""
+	def __init__(self, version=1, read_versions=None, cache_size=65536):
+		if version not in HASH_VERSIONS:
+			raise ValueError('Hash version {} is not available'.format(version))
+		read_versions = tuple(read_versions) if read_versions else (version,)
+		for read_version in read_versions:
+			if read_version not in HASH_VERSIONS:
+				raise ValueError('Hash version {} is not available'.format(read_version))
+		if version not in read_versions:
+			raise ValueError('Hash version {} must also be read'.format(version))
+
+		self.version = version
+		self.read_versions = read_versions
+		self.cache = LRUCache(cache_size)
+
+	def hash(self, items, version=None):
+		"""
+		Returns the key for the tuple of items, using the write version unless another is given
+		"""
+		version = self.version if version is None else version
+		cache_key = (version, items)
+		key = self.cache.get(cache_key, None)
+		if key is None:
+			key = HASH_VERSIONS[version](items)
+			self.cache.put(cache_key, key)
+		return key
+
+	def read_hashes(self, items):
+		"""
+		Returns the keys the items may have been stored under, across all read versions
+		"""
+		return [self.hash(items, version) for version in self.read_versions]
+
+	def stats(self):
+		return self.cache.stats()
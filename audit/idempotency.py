@@ -0,0 +1,201 @@
+"""
+Deduplication of saves by client supplied idempotency keys.
+
+A key is scoped to its org/service pair.  Once the record of a key is saved, a marker item is written
+to the Idempotency table, so that a retried save of the same key is acknowledged without writing the
+record again.  Markers expire after a window, through the DynamoDB time to live of their expires
+attribute; other backends keep them.
+
+Checking storage for a marker on every save would cost a request per record, and would keep batches
+from being written with BatchWriteItem, which cannot be conditional.  Instead each process remembers
+the keys it has seen:
+
+	recent	- an exact, bounded set of the keys saved most recently; a key found here is a duplicate
+	filter	- a Bloom filter of the keys seen; a key not found here is new to the process
+
+Only a key that the filter may hold, but that is not recent, is checked against storage, by a
+conditional put of its marker before the record is written.  The markers of new keys are written
+without a condition, once their records are written; with write-behind, that is once the buffer
+has flushed them, not when the save returns.
+
+From its check until its record is written or has failed, a key is in flight, and held exactly: a
+retry arriving meanwhile is PENDING, and is refused rather than saving the record a second time.
+
+A process does not see the keys of other processes, so where several serve the same org/service
+pairs (prefork workers, or several hosts), check_storage makes every key not known to be a
+duplicate take the conditional put.
+"""
+import struct
+from collections import OrderedDict
+from hashlib import md5
+from math import ceil, log
+from threading import Lock
+
+# Results of IdempotencyKeys.check
+NEW = 'new'
+POSSIBLE = 'possible'
+DUPLICATE = 'duplicate'
+PENDING = 'pending'
+
+def key_hash(key):
+	"""
+	Returns the Idempotency table range key value of an idempotency key, a 60 bit integer
+	"""
+	if isinstance(key, unicode):
+		key = key.encode('utf-8')
+	return int(md5(key).hexdigest()[:15], 16)
+
+def marker_item(org_id, service_id, key, timestamp, expires):
+	"""
+	Returns the Idempotency table item recording that the record of the key, with the timestamp, was saved
+	"""
+	return {
+		'org-service_id': '|'.join((org_id, service_id)),
+		'key_hash': key_hash(key),
+		'timestamp': timestamp,
+		'expires': expires
+	}
+
+class BloomFilter(object):
+	"""
+	Set membership with no false negatives, and false positives at about error_rate once capacity keys are held
+	"""
+	def __init__(self, capacity, error_rate):
+		self.capacity = capacity
+		self.size = int(ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+		self.hashes = max(1, int(round(float(self.size) / capacity * log(2))))
+		self.count = 0
+		self._bits = bytearray((self.size + 7) // 8)
+
+	def _positions(self, key):
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		# Double hashing of one digest gives the positions of all hash functions
+		h1, h2 = struct.unpack('<QQ', md5(key).digest())
+		size = self.size
+		return [(h1 + i * h2) % size for i in xrange(self.hashes)]
+
+	def add(self, key):
+		bits = self._bits
+		for position in self._positions(key):
+			bits[position >> 3] |= 1 << (position & 7)
+		self.count += 1
+
+	def __contains__(self, key):
+		bits = self._bits
+		for position in self._positions(key):
+			if not bits[position >> 3] & (1 << (position & 7)):
+				return False
+		return True
+
+class IdempotencyKeys(object):
+	"""
+	The idempotency keys seen by this process.
+
+	The filter is two Bloom filters of capacity keys each: new keys are added to the current one, and
+	when it is full it replaces the previous one, so that memory is bounded and the false positive rate
+	stays near error_rate.  The last recent_size keys saved are also held exactly
+	"""
+	def __init__(self, capacity=100000, error_rate=0.001, recent_size=10000, check_storage=False):
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.recent_size = recent_size
+		self.check_storage = check_storage
+		self.new = 0
+		self.possible = 0
+		self.duplicates = 0
+		self.checked_new = 0
+		self.pending = 0
+		self.marker_failures = 0
+		self._current = BloomFilter(capacity, error_rate)
+		self._previous = None
+		self._recent = OrderedDict()
+		self._in_flight = set()
+		self._lock = Lock()
+
+	def check(self, key):
+		"""
+		Returns DUPLICATE if the key was saved recently, PENDING if a save of it is in flight, POSSIBLE if
+		it may have been seen, otherwise NEW.
+
+		A NEW or POSSIBLE key is in flight until passed to saved, stored_duplicate or released
+		"""
+		with self._lock:
+			if key in self._recent:
+				self.duplicates += 1
+				return DUPLICATE
+
+			if key in self._in_flight:
+				self.pending += 1
+				return PENDING
+			self._in_flight.add(key)
+
+			if key in self._current or (self._previous is not None and key in self._previous):
+				self.possible += 1
+				return POSSIBLE
+
+			if self._current.count >= self.capacity:
+				self._previous, self._current = self._current, BloomFilter(self.capacity, self.error_rate)
+			self._current.add(key)
+			if self.check_storage:
+				self.possible += 1
+				return POSSIBLE
+			self.new += 1
+			return NEW
+
+	def saved(self, key):
+		"""
+		Records that the record of the key has been saved
+		"""
+		with self._lock:
+			self._in_flight.discard(key)
+			self._recent.pop(key, None)
+			self._recent[key] = True
+			if len(self._recent) > self.recent_size:
+				self._recent.popitem(last=False)
+
+	def stored_duplicate(self, key):
+		"""
+		Records that storage held the key of a save that was POSSIBLE
+		"""
+		with self._lock:
+			self.duplicates += 1
+		self.saved(key)
+
+	def released(self, key):
+		"""
+		Records that the record of a key in flight was not saved, so that it may be saved again
+		"""
+		with self._lock:
+			self._in_flight.discard(key)
+
+	def stored_new(self):
+		"""
+		Records that storage did not hold the key of a save that was POSSIBLE
+		"""
+		with self._lock:
+			self.checked_new += 1
+
+	def marker_failed(self, count=1):
+		"""
+		Records markers that could not be written or removed
+		"""
+		with self._lock:
+			self.marker_failures += count
+
+	def stats(self):
+		"""
+		Returns the counters of the keys
+		"""
+		with self._lock:
+			return {
+				'new': self.new,
+				'possible': self.possible,
+				'duplicates': self.duplicates,
+				'checked_new': self.checked_new,
+				'pending': self.pending,
+				'in_flight': len(self._in_flight),
+				'marker_failures': self.marker_failures,
+				'recent': len(self._recent),
+				'filter_bytes': len(self._current._bits) * (2 if self._previous is not None else 1)
+			}
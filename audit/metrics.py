@@ -0,0 +1,224 @@
+"""
+Low overhead in-process metrics, exposed in the Prometheus text format.
+
+Metrics carry at most one label, and a child is created for each label value on first use.
+The module level REGISTRY holds the metrics of the save path and of the storage backends.
+"""
+from bisect import bisect_left
+from threading import Lock
+from time import time
+
+# Default histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+					0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def _format_value(value):
+	if isinstance(value, float):
+		return repr(value)
+	return str(value)
+
+def _format_labels(pairs):
+	if not pairs:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+class _Timer(object):
+	"""
+	Context manager recording its elapsed time into a histogram
+	"""
+	__slots__ = ('_histogram', '_start')
+
+	def __init__(self, histogram):
+		self._histogram = histogram
+
+	def __enter__(self):
+		self._start = time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._histogram.observe(time() - self._start)
+
+class _HistogramValue(object):
+	"""
+	Bucket counts, sum and count of the observations for one label value
+	"""
+	def __init__(self, bounds):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self._lock = Lock()
+
+	def observe(self, value):
+		idx = bisect_left(self.bounds, value)
+		with self._lock:
+			self.counts[idx] += 1
+			self.sum += value
+			self.count += 1
+
+	def snapshot(self):
+		with self._lock:
+			return (list(self.counts), self.sum, self.count)
+
+class _CounterValue(object):
+	"""
+	Monotonic count for one label value
+	"""
+	def __init__(self):
+		self.value = 0
+		self._lock = Lock()
+
+	def inc(self, amount=1):
+		with self._lock:
+			self.value += amount
+
+class _Metric(object):
+	"""
+	Base of the labelled metric families
+	"""
+	kind = None
+
+	def __init__(self, name, help_text, label=None):
+		self.name = name
+		self.help_text = help_text
+		self.label = label
+		self._children = {}
+		self._lock = Lock()
+
+	def _new_child(self):
+		raise NotImplementedError()
+
+	def labels(self, value=None):
+		"""
+		Returns the child for the label value
+		"""
+		child = self._children.get(value, None)
+		if child is None:
+			with self._lock:
+				child = self._children.setdefault(value, self._new_child())
+		return child
+
+	def _label_pairs(self, value):
+		return [(self.label, value)] if self.label else []
+
+	def render(self):
+		lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} {}'.format(self.name, self.kind)]
+		for value in sorted(self._children.keys()):
+			lines.extend(self._render_child(value, self._children[value]))
+		return lines
+
+class Histogram(_Metric):
+	kind = 'histogram'
+
+	def __init__(self, name, help_text, label=None, buckets=DEFAULT_BUCKETS):
+		super(Histogram, self).__init__(name, help_text, label)
+		self.bounds = tuple(sorted(buckets))
+
+	def _new_child(self):
+		return _HistogramValue(self.bounds)
+
+	def observe(self, value, label_value=None):
+		self.labels(label_value).observe(value)
+
+	def time(self, label_value=None):
+		"""
+		Returns a context manager that records the time spent inside it
+		"""
+		return _Timer(self.labels(label_value))
+
+	def _render_child(self, value, child):
+		counts, total, count = child.snapshot()
+		pairs = self._label_pairs(value)
+		lines = []
+		cumulative = 0
+		for bound, bucket_count in zip(self.bounds, counts):
+			cumulative += bucket_count
+			lines.append('{}_bucket{} {}'.format(self.name, _format_labels(pairs + [('le', repr(bound))]), cumulative))
+		lines.append('{}_bucket{} {}'.format(self.name, _format_labels(pairs + [('le', '+Inf')]), count))
+		lines.append('{}_sum{} {}'.format(self.name, _format_labels(pairs), _format_value(total)))
+		lines.append('{}_count{} {}'.format(self.name, _format_labels(pairs), count))
+		return lines
+
+class Counter(_Metric):
+	kind = 'counter'
+
+	def _new_child(self):
+		return _CounterValue()
+
+	def inc(self, amount=1, label_value=None):
+		self.labels(label_value).inc(amount)
+
+	def _render_child(self, value, child):
+		return ['{}{} {}'.format(self.name, _format_labels(self._label_pairs(value)), child.value)]
+
+class CallbackMetric(object):
+	"""
+	Metric whose values are read from a callback when rendered.
+
+	The callback returns a dict of label value to metric value.
+	"""
+	def __init__(self, name, help_text, kind, label, callback):
+		self.name = name
+		self.help_text = help_text
+		self.kind = kind
+		self.label = label
+		self.callback = callback
+
+	def render(self):
+		lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} {}'.format(self.name, self.kind)]
+		for value, metric_value in sorted(self.callback().items()):
+			pairs = [(self.label, value)] if self.label else []
+			lines.append('{}{} {}'.format(self.name, _format_labels(pairs), _format_value(metric_value)))
+		return lines
+
+class Registry(object):
+	"""
+	Holds a set of metrics and renders them together
+	"""
+	def __init__(self):
+		self._metrics = []
+		self._names = set()
+		self._lock = Lock()
+
+	def _register(self, metric):
+		with self._lock:
+			if metric.name in self._names:
+				raise ValueError('Metric {} already registered'.format(metric.name))
+			self._names.add(metric.name)
+			self._metrics.append(metric)
+		return metric
+
+	def histogram(self, name, help_text, label=None, buckets=DEFAULT_BUCKETS):
+		return self._register(Histogram(name, help_text, label, buckets))
+
+	def counter(self, name, help_text, label=None):
+		return self._register(Counter(name, help_text, label))
+
+	def callback(self, name, help_text, kind, label, callback):
+		return self._register(CallbackMetric(name, help_text, kind, label, callback))
+
+	def render(self):
+		"""
+		Returns all metrics in the Prometheus text exposition format
+		"""
+		with self._lock:
+			metrics = list(self._metrics)
+		lines = []
+		for metric in metrics:
+			lines.extend(metric.render())
+		return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+SAVE_STAGE_SECONDS = REGISTRY.histogram('audit_save_stage_seconds',
+				'Time spent in each stage of saving a single record', 'stage')
+BATCH_STAGE_SECONDS = REGISTRY.histogram('audit_batch_stage_seconds',
+				'Time spent in each stage of saving a batch of records', 'stage')
+STORAGE_THROTTLES = REGISTRY.counter('audit_storage_throttles_total',
+				'Storage requests rejected for exceeding provisioned throughput', 'table')
+STORAGE_RETRIES = REGISTRY.counter('audit_storage_retries_total',
+				'Items resent to storage after being throttled or left unprocessed', 'table')
+STREAM_FRAMES = REGISTRY.counter('audit_stream_frames_total',
+				'Frames received on ingest streams')
+STREAM_RECORDS = REGISTRY.counter('audit_stream_records_total',
+				'Records received on ingest streams, by result', 'result')
@@ -0,0 +1,203 @@
+"""
+Paginated reads of audit records.
+
+Records are fetched from the backend a page at a time and yielded one by one, so that a
+result set is never held in memory in full.  A query can be resumed from an opaque cursor,
+which encodes the key of the last record returned (per hash key, for merged queries).
+"""
+import heapq
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from decimal import Decimal
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from audit.backends import table_keys
+from audit.record import AuditRecord
+
+class CursorError(Exception):
+	"""Raised when a supplied cursor cannot be decoded"""
+	pass
+
+def _plain(value):
+	"""Converts numbers returned by DynamoDB to int, so they can be serialised"""
+	if isinstance(value, Decimal):
+		return int(value)
+	if isinstance(value, dict):
+		return dict((k, _plain(v)) for k, v in value.items())
+	return value
+
+def encode_cursor(key):
+	"""
+	Encodes a backend key (or a dict of them, keyed by hash value) as an opaque cursor
+	"""
+	return urlsafe_b64encode(json.dumps(_plain(key), sort_keys=True))
+
+def decode_cursor(cursor):
+	"""
+	Decodes an opaque cursor to the backend key it holds
+	"""
+	try:
+		key = json.loads(urlsafe_b64decode(str(cursor)))
+	except (TypeError, ValueError):
+		raise CursorError('Invalid cursor supplied')
+	if not isinstance(key, dict):
+		raise CursorError('Invalid cursor supplied')
+	return key
+
+def record_from_item(item, load_changes=None):
+	"""
+	Returns the public form of an Audit table item, of either encoding.
+
+	If load_changes is given, the record includes its change payload, decoded by load_changes (or None)
+	"""
+	record = AuditRecord.from_item(item)
+	record.timestamp = _plain(record.timestamp)
+	public = record.to_dict()
+	if load_changes is not None:
+		public['changes'] = load_changes(record.changes) if record.changes is not None else None
+	return public
+
+def _item_changes(item):
+	"""Returns the stored change payload of an Audit item, of either encoding"""
+	return item.get('changes', item.get('c', None))
+
+class RecordStream(object):
+	"""
+	Iterates the records of one hash key of the Audit table, or of one of its indexes.
+
+	Once iteration ends, next_cursor holds the cursor to resume from, or None if all
+	records within the range have been returned.
+	"""
+	def __init__(self, backend, hash_value, index=None, tm_from=None, tm_to=None,
+					descending=False, limit=None, cursor=None, page_size=100, load_changes=None):
+		self.backend = backend
+		self.hash_value = hash_value
+		self.index = index
+		self.tm_from = tm_from
+		self.tm_to = tm_to
+		self.descending = descending
+		self.limit = limit
+		self.start_key = decode_cursor(cursor) if cursor else None
+		self.page_size = page_size
+		self.load_changes = load_changes
+		self.next_cursor = None
+
+		self.key_names = set(table_keys('Audit'))
+		if index:
+			self.key_names.update(table_keys('Audit', index))
+
+	def key(self, item):
+		return dict((k, item[k]) for k in self.key_names)
+
+	def items(self):
+		"""
+		Generator of the raw Audit table items
+		"""
+		start_key = self.start_key
+		remaining = self.limit
+		while True:
+			page_size = self.page_size if remaining is None else min(self.page_size, remaining)
+			items, last_key = self.backend.query('Audit', self.hash_value,
+						range_min=self.tm_from,
+						range_max=self.tm_to,
+						index=self.index,
+						descending=self.descending,
+						limit=page_size,
+						start_key=start_key)
+
+			for item in items:
+				yield item
+
+			if remaining is not None:
+				remaining -= len(items)
+				if remaining <= 0:
+					# Stopped by the limit; more may follow the last item returned
+					if last_key and items:
+						self.next_cursor = encode_cursor(self.key(items[-1]))
+					return
+
+			if not last_key:
+				return
+			start_key = last_key
+
+	def __iter__(self):
+		for item in self.items():
+			yield record_from_item(item, self.load_changes)
+
+class MergedRecordStream(object):
+	"""
+	Iterates the records of several RecordStreams as one stream in timestamp order.
+
+	Pages are fetched concurrently by a pool of at most concurrency threads, with each stream
+	reading one page ahead of the merge.  Records can be filtered after they are fetched; change
+	payloads are only decoded, by load_changes, for the records that pass the filter.
+
+	Once iteration ends, next_cursor holds the cursor to resume from, or None if all
+	records have been returned.
+	"""
+	def __init__(self, streams, descending=False, limit=None, cursor=None, concurrency=8, record_filter=None,
+					load_changes=None):
+		self.streams = streams
+		self.descending = descending
+		self.limit = limit
+		self.concurrency = concurrency
+		self.record_filter = record_filter
+		self.load_changes = load_changes
+		self.next_cursor = None
+
+		# Resume each stream after the last record it contributed
+		if cursor:
+			keys = decode_cursor(cursor)
+			for stream in streams:
+				key = keys.get(stream.hash_value, None)
+				if key:
+					stream.start_key = key
+
+	def _fetch(self, stream, source):
+		"""Reads the next page of a stream's items; runs on a pool thread"""
+		return list(islice(source, stream.page_size))
+
+	def __iter__(self):
+		if not self.streams:
+			return
+
+		pool = ThreadPool(min(self.concurrency, len(self.streams)))
+		try:
+			sources = [stream.items() for stream in self.streams]
+			pending = [pool.apply_async(self._fetch, (stream, source)) for stream, source in zip(self.streams, sources)]
+
+			def drain(idx):
+				"""Yields the sort tuples of one stream, prefetching its next page while the current one is merged"""
+				seq = 0
+				while True:
+					page = pending[idx].get()
+					if not page:
+						return
+					pending[idx] = pool.apply_async(self._fetch, (self.streams[idx], sources[idx]))
+					for item in page:
+						timestamp = _plain(item['timestamp'])
+						yield (-timestamp if self.descending else timestamp, idx, seq, item)
+						seq += 1
+
+			last_keys = {}
+			returned = 0
+			for _, idx, _, item in heapq.merge(*[drain(idx) for idx in range(len(sources))]):
+				stream = self.streams[idx]
+				last_keys[stream.hash_value] = stream.key(item)
+				record = record_from_item(item)
+				if self.record_filter and not self.record_filter(record):
+					continue
+				if self.load_changes is not None:
+					changes = _item_changes(item)
+					record['changes'] = self.load_changes(changes) if changes is not None else None
+
+				yield record
+				returned += 1
+				if self.limit and returned >= self.limit:
+					keys = dict((s.hash_value, s.start_key) for s in self.streams if s.start_key)
+					keys.update(last_keys)
+					self.next_cursor = encode_cursor(keys)
+					return
+		finally:
+			pool.terminate()
+
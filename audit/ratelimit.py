@@ -0,0 +1,193 @@
+"""
+Client-side rate limiting of storage requests.
+
+Each table has a token bucket, refilled at a rate that adapts to the throttles reported by
+the backend: additive increase while requests succeed, multiplicative decrease on a throttle.
+Throttled requests are retried with jittered exponential backoff, until a deadline passes.
+The rate then settles just below the provisioned capacity, rather than bursts failing.
+"""
+import random
+from audit.backends import StorageThrottled
+from audit.metrics import STORAGE_RETRIES
+from threading import Lock
+from time import time, sleep
+
+class AdaptiveTokenBucket(object):
+	"""
+	Token bucket whose refill rate (tokens per second) is adapted by AIMD.
+
+	Requests costing more than the burst size are admitted once the bucket is full, leaving it in debt
+	"""
+	def __init__(self, rate, burst=None, min_rate=1.0, max_rate=None, increase=None, decrease=0.5, interval=1.0):
+		self.rate = float(rate)
+		self.burst = float(burst or max(rate, 1))
+		self.min_rate = float(min_rate)
+		self.max_rate = float(max_rate or rate * 4)
+		self.increase = float(increase or max(rate * 0.05, 1))
+		self.decrease = decrease
+		self.interval = interval
+		self.tokens = self.burst
+		self.throttles = 0
+
+		now = time()
+		self._updated = now
+		self._last_increase = now
+		self._last_decrease = 0
+		self._lock = Lock()
+
+	def _refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+		self._updated = now
+
+	def acquire(self, tokens=1, deadline=None):
+		"""
+		Waits until the tokens are available and takes them.
+
+		Returns False, taking nothing, if they won't be available before the deadline
+		"""
+		needed = min(tokens, self.burst)
+		while True:
+			with self._lock:
+				now = time()
+				self._refill(now)
+				if self.tokens >= needed:
+					self.tokens -= tokens
+					return True
+				wait = (needed - self.tokens) / self.rate
+			if deadline is not None and now + wait > deadline:
+				return False
+			sleep(wait)
+
+	def on_success(self):
+		"""
+		Additive increase, at most once per interval
+		"""
+		with self._lock:
+			now = time()
+			if now - self._last_increase >= self.interval:
+				self.rate = min(self.max_rate, self.rate + self.increase)
+				self._last_increase = now
+
+	def on_throttle(self):
+		"""
+		Multiplicative decrease, at most once per interval so that concurrent throttles count once
+		"""
+		with self._lock:
+			now = time()
+			self.throttles += 1
+			if now - self._last_decrease >= self.interval:
+				self._refill(now)
+				self.rate = max(self.min_rate, self.rate * self.decrease)
+				self.tokens = min(self.tokens, 0)
+				self._last_decrease = now
+				self._last_increase = now
+
+class RateLimiter(object):
+	"""
+	Adaptive token buckets by table, and throttle-aware retries of the requests they admit.
+
+	rates gives the initial rate of each table; other tables start at default_rate.  Any other keyword
+	arguments are passed to each AdaptiveTokenBucket
+	"""
+	def __init__(self, rates=None, default_rate=10, deadline=5.0, base_backoff=0.05, max_backoff=2.0, **bucket_args):
+		self.rates = dict(rates or {})
+		self.default_rate = default_rate
+		self.deadline = deadline
+		self.base_backoff = base_backoff
+		self.max_backoff = max_backoff
+		self.bucket_args = bucket_args
+		self.buckets = {}
+		self.retries = {}
+		self._lock = Lock()
+
+	def bucket(self, table_name):
+		"""
+		Returns the bucket of the table, creating it on first use
+		"""
+		bucket = self.buckets.get(table_name, None)
+		if bucket is None:
+			with self._lock:
+				bucket = self.buckets.get(table_name, None)
+				if bucket is None:
+					bucket = AdaptiveTokenBucket(self.rates.get(table_name, self.default_rate), **self.bucket_args)
+					self.buckets[table_name] = bucket
+		return bucket
+
+	def throttled(self, table_name):
+		"""
+		Records a throttle reported by the backend
+		"""
+		self.bucket(table_name).on_throttle()
+
+	def call(self, table_name, cost, fn):
+		"""
+		Calls fn once cost tokens are available, retrying while it is throttled.
+
+		Raises StorageThrottled if the request cannot complete before the deadline
+		"""
+		bucket = self.bucket(table_name)
+		deadline = time() + self.deadline
+		attempt = 0
+		while True:
+			if not bucket.acquire(cost, deadline):
+				raise StorageThrottled('Rate limit of table {} exceeded'.format(table_name))
+			try:
+				result = fn()
+			except StorageThrottled:
+				# Full jitter, so that throttled clients don't retry in step
+				delay = random.uniform(0, min(self.max_backoff, self.base_backoff * (2 ** attempt)))
+				if time() + delay >= deadline:
+					raise
+				attempt += 1
+				with self._lock:
+					self.retries[table_name] = self.retries.get(table_name, 0) + 1
+				STORAGE_RETRIES.inc(label_value=table_name)
+				sleep(delay)
+				continue
+
+			bucket.on_success()
+			return result
+
+	def stats(self):
+		"""
+		Returns the current rate, throttle and retry counts of each table
+		"""
+		return dict((table_name, {
+				'rate': bucket.rate,
+				'throttles': bucket.throttles,
+				'retries': self.retries.get(table_name, 0)
+			}) for table_name, bucket in self.buckets.items())
+
+class RateLimitedBackend(object):
+	"""
+	View of a storage backend whose requests pass through a RateLimiter.
+
+	Writes cost a token per item, and queries and scans a token per page; other attributes are those of the backend
+	"""
+	def __init__(self, backend, limiter):
+		self._backend = backend
+		self._limiter = limiter
+
+	def __getattr__(self, name):
+		return getattr(self._backend, name)
+
+	def put(self, table_name, item):
+		return self._limiter.call(table_name, 1, lambda: self._backend.put(table_name, item))
+
+	def batch_put(self, table_name, items):
+		return self._limiter.call(table_name, len(items), lambda: self._backend.batch_put(table_name, items))
+
+	def put_if_absent(self, table_name, item):
+		return self._limiter.call(table_name, 1, lambda: self._backend.put_if_absent(table_name, item))
+
+	def delete(self, table_name, key):
+		return self._limiter.call(table_name, 1, lambda: self._backend.delete(table_name, key))
+
+	def increment(self, table_name, key, counters):
+		return self._limiter.call(table_name, 1, lambda: self._backend.increment(table_name, key, counters))
+
+	def query(self, table_name, hash_value, **kwargs):
+		return self._limiter.call(table_name, 1, lambda: self._backend.query(table_name, hash_value, **kwargs))
+
+	def scan(self, table_name, **kwargs):
+		return self._limiter.call(table_name, 1, lambda: self._backend.scan(table_name, **kwargs))
@@ -0,0 +1,88 @@
+"""
+Audit records, and their encoding as Audit table items.
+
+Items are written in one of two encodings:
+
+	full	 - service_id, obo_id and actor_id under their own names (the original form)
+	compact	 - the same attributes as s, o and a, with a left out when the actor is the obo user
+
+A record's change payload, if it has one, is held as changes or c respectively, in the stored form
+of audit.changes; it is not decoded here.
+
+Item size determines the capacity units consumed by writes, queries and the org-user index, so the
+compact encoding saves on every record.  Key attributes keep their names, as the table schema fixes
+them.  Reads accept either encoding, so both may be present in a table.
+"""
+
+# Item encodings that may be written
+ITEM_ENCODINGS = ('full', 'compact')
+
+class AuditRecord(object):
+	"""
+	A single audit record: who (actor_id) changed what, in which service, on behalf of whom (obo_id)
+	"""
+	__slots__ = ('timestamp', 'service_id', 'obo_id', 'actor_id', 'changes')
+
+	def __init__(self, timestamp, service_id, obo_id, actor_id, changes=None):
+		self.timestamp = timestamp
+		self.service_id = service_id
+		self.obo_id = obo_id
+		self.actor_id = actor_id
+		self.changes = changes
+
+	@classmethod
+	def from_item(cls, item):
+		"""
+		Decodes an Audit table item of either encoding
+		"""
+		obo_id = item.get('o', None)
+		if obo_id is None:
+			return cls(item['timestamp'], item.get('service_id', None), item.get('obo_id', None), item.get('actor_id', None),
+						item.get('changes', None))
+		return cls(item['timestamp'], item.get('s', None), obo_id, item.get('a', obo_id), item.get('c', None))
+
+	def to_item(self, service_hash, user_hash, encoding='full'):
+		"""
+		Returns the Audit table item of the record, stored under the hash keys
+		"""
+		item = {'service-org_hash': service_hash, 'org-user_hash': user_hash, 'timestamp': self.timestamp}
+		if encoding == 'compact':
+			item['s'] = self.service_id
+			item['o'] = self.obo_id
+			if self.actor_id != self.obo_id:
+				item['a'] = self.actor_id
+			if self.changes is not None:
+				item['c'] = self.changes
+		else:
+			item['service_id'] = self.service_id
+			item['obo_id'] = self.obo_id
+			item['actor_id'] = self.actor_id
+			if self.changes is not None:
+				item['changes'] = self.changes
+		return item
+
+	def to_dict(self):
+		"""
+		Returns the public form of the record, without its change payload
+		"""
+		return {
+			'timestamp': self.timestamp,
+			'obo_id': self.obo_id,
+			'actor_id': self.actor_id,
+			'service_id': self.service_id
+		}
+
+def full_item(item):
+	"""
+	Returns the item in the full encoding, for readers of raw items
+	"""
+	if 'o' not in item:
+		return item
+	full = dict((name, value) for name, value in item.items() if name not in ('s', 'o', 'a', 'c'))
+	record = AuditRecord.from_item(item)
+	full['service_id'] = record.service_id
+	full['obo_id'] = record.obo_id
+	full['actor_id'] = record.actor_id
+	if record.changes is not None:
+		full['changes'] = record.changes
+	return full
@@ -0,0 +1,220 @@
+"""
+Hourly rollup counters of the records saved by each org/service pair.
+
+Each Rollup table item counts the records of one org/service pair with timestamps in one hour, and
+how many of them were made on behalf of another user (actor_id differs from obo_id).  Saves add
+their records to in-memory counters, which are flushed periodically as atomic ADD updates, so that
+storage sees one write per active bucket per interval however many records are saved.  A dashboard
+then reads one item per hour, rather than every record.
+
+Rollups can also be rebuilt from an export of the Audit table, with the same aggregation.
+"""
+import argparse
+import json
+import sys
+from audit.query import _plain
+from threading import Condition, Thread
+from time import time
+
+# Length of a bucket in timestamp units (microseconds)
+HOUR = 3600 * 1000000
+
+def hour_of(timestamp):
+	"""
+	Returns the timestamp of the start of the hour holding the timestamp
+	"""
+	return timestamp - timestamp % HOUR
+
+def rollup_hash(org_id, service_id):
+	"""
+	Returns the Rollup table hash key value of the org/service pair
+	"""
+	return '|'.join((org_id, service_id))
+
+def aggregate(counts, org_id, service_id, records):
+	"""
+	Adds the records (or Audit items) of the org/service pair to counts, a dict of
+	[count, obo_count] by (org_id, service_id, hour)
+	"""
+	for record in records:
+		key = (org_id, service_id, hour_of(record['timestamp']))
+		bucket = counts.get(key, None)
+		if bucket is None:
+			bucket = counts[key] = [0, 0]
+		bucket[0] += 1
+		if record.get('actor_id', None) != record.get('obo_id', None):
+			bucket[1] += 1
+
+def rollup_item(org_id, service_id, hour, count, obo_count):
+	"""
+	Returns the Rollup table item of a bucket
+	"""
+	return {'org-service_id': rollup_hash(org_id, service_id), 'hour': hour, 'count': count, 'obo_count': obo_count}
+
+def rollup_from_item(item):
+	"""
+	Returns the public form of a Rollup table item
+	"""
+	return {
+		'hour': _plain(item['hour']),
+		'count': _plain(item.get('count', 0)),
+		'obo_count': _plain(item.get('obo_count', 0))
+	}
+
+class RollupCounters(object):
+	"""
+	Counts saved records in memory, flushing them every interval seconds from a background thread.
+
+	flush_fn is called with (org_id, service_id, hour, count, obo_count) for each bucket, and must add the
+	counts to the stored bucket atomically.  A bucket whose flush raises is kept, and retried at the next
+	flush; a flush that was applied although it raised is then counted twice
+	"""
+	def __init__(self, flush_fn, interval=10.0):
+		self.flush_fn = flush_fn
+		self.interval = interval
+		self.flushes = 0
+		self.flushed_buckets = 0
+		self.failed_buckets = 0
+		self._counts = {}
+		self._cond = Condition()
+		self._running = False
+		self._thread = None
+
+	def add(self, org_id, service_id, records):
+		"""
+		Counts saved records of the org/service pair
+		"""
+		with self._cond:
+			aggregate(self._counts, org_id, service_id, records)
+
+	def pending(self, org_id, service_id, hour_from=None, hour_to=None):
+		"""
+		Returns the unflushed counts of the pair as a dict of [count, obo_count] by hour, within the inclusive bounds
+		"""
+		with self._cond:
+			return dict((hour, list(bucket)) for (org, service, hour), bucket in self._counts.items()
+						if org == org_id and service == service_id
+						and (hour_from is None or hour >= hour_from) and (hour_to is None or hour <= hour_to))
+
+	def flush(self):
+		"""
+		Writes the counts accumulated since the last flush, returning the number of buckets that failed
+		"""
+		with self._cond:
+			counts, self._counts = self._counts, {}
+
+		failed = {}
+		for (org_id, service_id, hour), (count, obo_count) in counts.items():
+			try:
+				self.flush_fn(org_id, service_id, hour, count, obo_count)
+			except Exception:
+				failed[(org_id, service_id, hour)] = [count, obo_count]
+
+		with self._cond:
+			self.flushes += 1
+			self.flushed_buckets += len(counts) - len(failed)
+			self.failed_buckets += len(failed)
+			for key, (count, obo_count) in failed.items():
+				bucket = self._counts.setdefault(key, [0, 0])
+				bucket[0] += count
+				bucket[1] += obo_count
+		return len(failed)
+
+	def start(self):
+		"""
+		Starts the background flusher
+		"""
+		with self._cond:
+			if self._running:
+				return
+			self._running = True
+		self._thread = Thread(target=self._run, name='audit-rollups')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		"""
+		Stops the background flusher, flushing the counts accumulated so far
+		"""
+		with self._cond:
+			if not self._running:
+				return
+			self._running = False
+			self._cond.notify_all()
+		self._thread.join()
+		self._thread = None
+		self.flush()
+
+	def stats(self):
+		"""
+		Returns the counters of the rollups
+		"""
+		with self._cond:
+			return {
+				'buckets': len(self._counts),
+				'flushes': self.flushes,
+				'flushed_buckets': self.flushed_buckets,
+				'failed_buckets': self.failed_buckets
+			}
+
+	def _run(self):
+		while True:
+			deadline = time() + self.interval
+			with self._cond:
+				while self._running and time() < deadline:
+					self._cond.wait(deadline - time())
+				if not self._running:
+					return
+			self.flush()
+
+if __name__ == "__main__":
+
+	from audit.aws import Audit
+	from audit.backends import BACKENDS, create_backend
+	from audit.export import ExportReader
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='This rebuilds the hourly rollups from an export of the Audit table')
+	parser.add_argument('directory', help='Directory of the export')
+	parser.add_argument('-o','--org_id', help='Rebuild the rollups of this org; defaults to every registered org',
+						action='append', default=None, required=False)
+	parser.add_argument('--tm_from', help='Rebuild the rollups of records from this timestamp', type=int, default=None, required=False)
+	parser.add_argument('--tm_to', help='Rebuild the rollups of records up to this timestamp', type=int, default=None, required=False)
+	parser.add_argument('-b','--backend', help='Storage backend', choices=BACKENDS, default='dynamodb', required=False)
+	parser.add_argument('-f','--sqlite_path', help='Database file for the sqlite backend', default=':memory:', required=False)
+	parser.add_argument('-r','--region', help='DynamoDB region', required=False)
+	parser.add_argument('-k','--access_key', help='AWS Access Key', required=False)
+	parser.add_argument('-s','--secret_key', help='AWS Secret Key', required=False)
+	parser.add_argument('-p','--prefix', help='The table prefix in DynamoDB', required=False)
+	parser.add_argument('--read_hash_versions', help='Comma separated hash versions the export may hold, defaults to version 1',
+						default=None, required=False)
+	parser.add_argument('--shard_config', help='JSON file of write shard counts, as given to the API', default=None, required=False)
+	args = parser.parse_args()
+
+	if args.backend == 'dynamodb' and not (args.region and args.access_key and args.secret_key and args.prefix):
+		parser.error('The dynamodb backend requires region, access_key, secret_key and prefix')
+
+	audit = Audit()
+	if args.read_hash_versions:
+		read_versions = [int(v) for v in args.read_hash_versions.split(',')]
+		audit.set_hash_versions(max(read_versions), read_versions)
+	if args.shard_config:
+		with open(args.shard_config) as f:
+			for org_id, services in json.load(f).items():
+				for service_id, shards in services.items():
+					audit.set_write_shards(org_id, service_id, shards)
+	audit.set_prefix(args.prefix)
+	if args.backend == 'dynamodb':
+		audit.connect(args.region, args.access_key, args.secret_key)
+	elif args.backend == 'sqlite':
+		audit.set_backend(create_backend('sqlite', path=args.sqlite_path))
+	else:
+		parser.error('Only persistent backends can be rebuilt')
+
+	reader = ExportReader(args.directory)
+	try:
+		stats = audit.rebuild_rollups(reader, org_ids=args.org_id, tm_from=args.tm_from, tm_to=args.tm_to)
+	finally:
+		reader.close()
+	json.dump(stats, sys.stdout, sort_keys=True)
+	print
@@ -0,0 +1,230 @@
+"""
+Schemas of request payloads, compiled once into validator functions.
+
+A schema is a list of Fields.  compile_schema generates the source of a validator with the field
+names, types and limits inlined, so validating a payload is a single call with no walk over the
+specification.  Types are checked by exact class, as decoded from JSON, which avoids a function call
+per field.  Field names are looked up as unicode, the type of keys decoded from JSON, so that each
+lookup compares like with like.  Nested payloads are maps with their own schema, or lists.
+
+Field types:
+
+	N	integer
+	S	string
+	B	boolean
+	M	map, validated against the field's schema if it has one
+	L	list, each element validated against the field's items Field
+"""
+
+class ValidationError(Exception):
+	"""Allows identification of validation errors"""
+	pass
+
+_MISSING = object()
+
+# Python classes accepted for each field type
+_TYPES = {
+	'N': frozenset((int, long)),
+	'S': frozenset((str, unicode)),
+	'B': frozenset((bool,)),
+	'M': frozenset((dict,)),
+	'L': frozenset((list,)),
+}
+
+# The same classes, most common first, with the names the validator binds them to
+_CLASSES = {
+	'N': (('_int', int), ('_long', long)),
+	'S': (('_unicode', unicode), ('_str', str)),
+	'B': (('_bool', bool),),
+	'M': (('_dict', dict),),
+	'L': (('_list', list),),
+}
+
+class Field(object):
+	"""
+	Specification of one payload field.
+
+	max_length limits the length of strings and lists.  schema gives the fields of a map, or None to
+	accept any map, and items the specification of each list element (its name is only used in errors)
+	"""
+	__slots__ = ('name', 'type', 'required', 'max_length', 'schema', 'items')
+
+	def __init__(self, name, field_type, required=True, max_length=None, schema=None, items=None):
+		if field_type not in _TYPES:
+			raise ValueError('Unknown field type: {}'.format(field_type))
+		if field_type == 'L' and items is None:
+			raise ValueError('List field {} requires an items specification'.format(name))
+		self.name = name
+		self.type = field_type
+		self.required = required
+		self.max_length = max_length
+		self.schema = schema
+		self.items = items
+
+def _value_checks(field, value, namespace, indent):
+	"""
+	Returns the source lines checking a value against the field's type and limits, raising the error found
+	"""
+	pad = '\t' * indent
+	lines = []
+	lines.append('{}if {}.__class__ not in {}:'.format(pad, value, _types_name(field, namespace)))
+	lines.append("{}\traise ValidationError('Invalid data type supplied')".format(pad))
+
+	if field.max_length is not None:
+		lines.append('{}if _len({}) > {}:'.format(pad, value, int(field.max_length)))
+		lines.append('{}\traise ValidationError({!r})'.format(pad, 'Field {} exceeds the maximum length of {}'.format(field.name, field.max_length)))
+
+	lines.extend(_nested_checks(field, value, namespace, indent))
+	return lines
+
+def _nested_checks(field, value, namespace, indent):
+	"""
+	Returns the source lines checking the fields of a map, or the elements of a list, once its own type is checked
+	"""
+	pad = '\t' * indent
+	lines = []
+	if field.type == 'M' and field.schema is not None:
+		nested = '_schema_{}'.format(id(field.schema))
+		if nested not in namespace:
+			namespace[nested] = compile_schema(field.schema)
+		lines.append('{}{}({})'.format(pad, nested, value))
+	elif field.type == 'L':
+		element = '_e{}'.format(indent)
+		lines.append('{}for {} in {}:'.format(pad, element, value))
+		lines.extend(_value_checks(field.items, element, namespace, indent + 1))
+	return lines
+
+def _types_name(field, namespace):
+	"""
+	Returns the name of the classes accepted for the field's type, binding them in the namespace
+	"""
+	name = '_types_{}'.format(field.type)
+	namespace[name] = _TYPES[field.type]
+	return name
+
+def _value_test(field, value, namespace):
+	"""
+	Returns an expression that is true if the value has the wrong type, or exceeds the field's limit.
+
+	Classes are compared by identity, which is cheaper than a set lookup
+	"""
+	for name, cls in _CLASSES[field.type]:
+		namespace[name] = cls
+	test = ' and '.join('{}.__class__ is not {}'.format(value, name) for name, _ in _CLASSES[field.type])
+	if len(_CLASSES[field.type]) > 1:
+		test = '({})'.format(test)
+	if field.max_length is not None:
+		test += ' or _len({}) > {}'.format(value, int(field.max_length))
+	return test
+
+def compile_schema(fields):
+	"""
+	Returns a function validating a payload against the fields, raising ValidationError if it is invalid.
+
+	Payloads may hold no fields other than those given.  Fields may be Field instances, or (name, type)
+	tuples of required fields.
+
+	Two functions are generated.  The validator reads every field, then tests the types and limits of all
+	of them in a single condition, comparing classes by identity; only if that fails does it call the
+	checker, which tests the fields one by one to raise the error of the first invalid field.  Both are
+	closures over the names they use, so each is a fast local lookup rather than a search of globals
+	"""
+	fields = [field if isinstance(field, Field) else Field(*field) for field in fields]
+	required = sum(1 for field in fields if field.required)
+	optional = required != len(fields)
+	namespace = {'ValidationError': ValidationError, '_MISSING': _MISSING, '_isinstance': isinstance, '_len': len, '_dict': dict}
+	length_test = 'count < {} or count > {}'.format(required, len(fields)) if optional else 'count != {}'.format(required)
+
+	# The checker, raising the error of the first invalid field
+	checker = [
+		'def _check(data):',
+		'\tif not _isinstance(data, _dict):',
+		"\t\traise ValidationError('Invalid data supplied')",
+		'\tcount = _len(data)',
+		'\tif {}:'.format(length_test),
+		"\t\traise ValidationError('Incorrect data length supplied')",
+	]
+	# Required fields are read by subscript, and a missing one is reported from the KeyError
+	if required:
+		checker.append('\ttry:')
+		for idx, field in enumerate(fields):
+			if field.required:
+				checker.append('\t\t_v{} = data[{!r}]'.format(idx, unicode(field.name)))
+		checker.append('\texcept KeyError:')
+		checker.append("\t\traise ValidationError('Invalid data supplied')")
+	if optional:
+		checker.append('\tpresent = {}'.format(required))
+	for idx, field in enumerate(fields):
+		value = '_v{}'.format(idx)
+		if field.required:
+			checker.extend(_value_checks(field, value, namespace, 1))
+		else:
+			checker.append('\t{} = data.get({!r}, _MISSING)'.format(value, unicode(field.name)))
+			checker.append('\tif {} is not _MISSING:'.format(value))
+			checker.append('\t\tpresent += 1')
+			checker.extend(_value_checks(field, value, namespace, 2))
+	# With every field required, the length check has already excluded unknown fields
+	if optional:
+		checker.append('\tif present != count:')
+		checker.append("\t\traise ValidationError('Invalid data supplied')")
+
+	# The validator, deferring to the checker on any failure; a dict subclass is also left to the checker
+	validator = ['def validate(data):']
+	if optional:
+		validator.append('\tif data.__class__ is not _dict:')
+		validator.append('\t\treturn _check(data)')
+		validator.append('\tcount = _len(data)')
+		validator.append('\tif {}:'.format(length_test))
+	else:
+		validator.append('\tif data.__class__ is not _dict or _len(data) != {}:'.format(required))
+	validator.append('\t\treturn _check(data)')
+	if required:
+		validator.append('\ttry:')
+		for idx, field in enumerate(fields):
+			if field.required:
+				validator.append('\t\t_v{} = data[{!r}]'.format(idx, unicode(field.name)))
+		validator.append('\texcept KeyError:')
+		validator.append('\t\treturn _check(data)')
+	tests = []
+	present = []
+	for idx, field in enumerate(fields):
+		value = '_v{}'.format(idx)
+		if field.required:
+			tests.append(_value_test(field, value, namespace))
+		else:
+			validator.append('\t{} = data.get({!r}, _MISSING)'.format(value, unicode(field.name)))
+			tests.append('({} is not _MISSING and ({}))'.format(value, _value_test(field, value, namespace)))
+			present.append('({} is not _MISSING)'.format(value))
+	if optional:
+		tests.append('count != {} + {}'.format(required, ' + '.join(present)))
+	if tests:
+		validator.append('\tif {}:'.format(' or '.join(tests)))
+		validator.append('\t\treturn _check(data)')
+	# Every type is now known to be valid, so the first error of a nested map or list is the first error
+	for idx, field in enumerate(fields):
+		nested = _nested_checks(field, '_v{}'.format(idx), namespace, 1 if field.required else 2)
+		if nested:
+			if not field.required:
+				validator.append('\tif _v{} is not _MISSING:'.format(idx))
+			validator.extend(nested)
+
+	names = sorted(namespace)
+	source = ['def _bind({}):'.format(', '.join(names))]
+	source.extend('\t' + line for line in checker + validator)
+	source.append('\treturn validate')
+	scope = {}
+	exec compile('\n'.join(source) + '\n', '<schema>', 'exec') in scope
+	return scope['_bind'](*[namespace[name] for name in names])
+
+def validate_batch(validate, payloads):
+	"""
+	Validates many payloads, returning a list holding None for each valid payload or the error message
+	"""
+	errors = []
+	for payload in payloads:
+		try:
+			validate(payload)
+			errors.append(None)
+		except ValidationError as e:
+			errors.append(e.message)
+	return errors
@@ -0,0 +1,118 @@
+"""
+In-process feed of newly saved records, for following an org/service pair as records are saved.
+
+Saves publish their records to the feed, which buffers the most recent records of each pair that is
+being tailed.  A tail names the last timestamp it has seen, and is answered from the buffer once the
+buffer is known to hold every record after that timestamp; otherwise storage is read once, and the
+buffer is complete from there on.  When nothing is new, a tail waits for a save to notify it.
+
+Only saves made by this process are published.  Where other processes also save records for a pair,
+check_storage makes a tail that times out read storage once, so that their records are not missed.
+"""
+from bisect import insort
+from collections import OrderedDict
+from threading import Condition, Lock
+from time import time
+
+class _Key(object):
+	"""
+	Buffered records of one org/service pair, sorted by timestamp.
+
+	complete_from is the timestamp after which every record saved since the feed started is buffered,
+	or None until storage has been read
+	"""
+	def __init__(self, lock):
+		self.records = []			# (timestamp, seq, record)
+		self.complete_from = None
+		self.changed = Condition(lock)
+
+class TailFeed(object):
+	"""
+	Buffers up to buffer_size records of each of at most max_keys org/service pairs
+	"""
+	def __init__(self, buffer_size=1024, max_keys=4096, check_storage=False):
+		self.buffer_size = buffer_size
+		self.max_keys = max_keys
+		self.check_storage = check_storage
+		self._keys = OrderedDict()
+		self._lock = Lock()
+		self._seq = 0
+
+	def _key(self, key):
+		"""
+		Returns the state of the pair, creating it if needed; must hold the lock
+		"""
+		state = self._keys.pop(key, None)
+		if state is None:
+			state = _Key(self._lock)
+			if len(self._keys) >= self.max_keys:
+				self._keys.popitem(last=False)
+		self._keys[key] = state
+		return state
+
+	def publish(self, org_id, service_id, records):
+		"""
+		Adds saved records, waking any tails of the pair; ignored unless the pair is being tailed
+		"""
+		with self._lock:
+			state = self._keys.get((org_id, service_id), None)
+			if state is None:
+				return
+			for record in records:
+				self._seq += 1
+				insort(state.records, (record['timestamp'], self._seq, record))
+			if len(state.records) > self.buffer_size:
+				# Records up to the last one dropped may no longer all be buffered
+				dropped = state.records[:len(state.records) - self.buffer_size]
+				del state.records[:len(dropped)]
+				if state.complete_from is not None:
+					state.complete_from = max(state.complete_from, dropped[-1][0])
+			state.changed.notify_all()
+
+	def _buffered(self, state, after, limit):
+		"""
+		Returns the buffered records after the timestamp, or None if the buffer may be missing some
+		"""
+		if state.complete_from is None or after < state.complete_from:
+			return None
+		return [record for timestamp, _, record in state.records if timestamp > after][:limit]
+
+	def tail(self, org_id, service_id, after, timeout, limit, read_storage):
+		"""
+		Returns up to limit records of the pair with timestamps after the given one, in timestamp order,
+		waiting up to timeout seconds for one to be saved if there are none.
+
+		read_storage(after, limit) returns the stored records after the timestamp, in timestamp order
+		"""
+		key = (org_id, service_id)
+		with self._lock:
+			state = self._key(key)
+			records = self._buffered(state, after, limit)
+
+		if records is None:
+			# The pair is now buffered, so records saved while storage is read are not missed
+			records = read_storage(after, limit)
+			with self._lock:
+				state = self._key(key)
+				if len(records) < limit and (state.complete_from is None or after < state.complete_from):
+					state.complete_from = after
+				if records:
+					return records
+				records = self._buffered(state, after, limit)
+
+		if records:
+			return records
+
+		deadline = time() + timeout
+		with self._lock:
+			while True:
+				state = self._key(key)
+				records = self._buffered(state, after, limit)
+				remaining = deadline - time()
+				if records or records is None or remaining <= 0:
+					break
+				state.changed.wait(remaining)
+
+		if records is None or (not records and self.check_storage):
+			records = read_storage(after, limit)
+		return records
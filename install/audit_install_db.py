@@ -4,102 +4,214 @@ This script creates an environment of the audit-zen DynamoDB tables, which compr
 	Audit table - this holds the details of the action that was performed
 	Org table - this holds the details of the organisations using this service
 	OrgService table - this holds the details of the services for which an org is using this service
+	Rollup table - this holds hourly counts of the records of each org and service
+	Idempotency table - this holds the idempotency keys of saved records, until they expire
 
 The tables will have an optional prefix that allows multiple installs side by side.
 
+Capacity is taken from a named provisioning profile (see PROFILES), optionally overridden per table,
+for instance with the capacity sized by size_audit_capacity for an expected load.  The tables are
+created together, and create_tables returns once all of them and their indexes are ACTIVE, and
+time to live has been enabled on those tables with expiring items.
+
 It is expected that the AWS account used has sufficient access to create the tables, and associated alarms
 
 """
 
 import argparse
+import json
+from math import ceil
 from boto.dynamodb2 import regions as db2_regions
+from boto.exception import JSONResponseError
 import boto.dynamodb2.layer1 as db2
+from time import time, sleep
+
+# Capacity of each table and its indexes as (ReadCapacity, WriteCapacity), or None for on-demand billing.
+# Each write to the Audit table is also a write to its org-user index, which projects all attributes,
+# so the index needs at least the table's write capacity; reads are split between service queries
+# (the table) and user queries (the index)
+PROFILES = {
+	'dev': {
+		'Audit': {'table': (2, 5), 'org-user': (1, 5)},
+		'Org': {'table': (1, 1)},
+		'OrgService': {'table': (1, 1)},
+		'Rollup': {'table': (1, 1)},
+		'Idempotency': {'table': (1, 1)}
+	},
+	'staging': {
+		'Audit': {'table': (10, 25), 'org-user': (5, 25)},
+		'Org': {'table': (5, 2)},
+		'OrgService': {'table': (5, 2)},
+		'Rollup': {'table': (5, 5)},
+		'Idempotency': {'table': (5, 10)}
+	},
+	'high-volume': {
+		'Audit': {'table': (200, 1000), 'org-user': (100, 1000)},
+		'Org': {'table': (50, 5)},
+		'OrgService': {'table': (50, 10)},
+		'Rollup': {'table': (50, 50)},
+		'Idempotency': {'table': (50, 500)}
+	},
+	'on-demand': {
+		'Audit': None,
+		'Org': None,
+		'OrgService': None,
+		'Rollup': None,
+		'Idempotency': None
+	}
+}
+
+DEFAULT_PROFILE = 'dev'
+
+# Size of a write capacity unit, and of a strongly consistent read capacity unit, in bytes
+WRITE_UNIT_SIZE = 1024
+READ_UNIT_SIZE = 4096
+
+# Attribute definitions, key schema and indexes of each table
+TABLE_DEFINITIONS = {
+	'Audit': {
+		'attributes': [('service-org_hash', 'S'), ('org-user_hash', 'S'), ('timestamp', 'N')],
+		'key': [('service-org_hash', 'HASH'), ('timestamp', 'RANGE')],
+		# Project all attributes, so user queries are answered from the index alone
+		'indexes': [{'name':'org-user', 'schema':[('org-user_hash', 'HASH'), ('timestamp', 'RANGE')], 'projection':'ALL'}]
+	},
+	'Org': {
+		'attributes': [('org_id', 'S'), ('timestamp', 'N')],
+		'key': [('org_id', 'HASH'), ('timestamp', 'RANGE')]
+	},
+	'OrgService': {
+		'attributes': [('org-service_id', 'S'), ('timestamp', 'N')],
+		'key': [('org-service_id', 'HASH'), ('timestamp', 'RANGE')]
+	},
+	'Rollup': {
+		'attributes': [('org-service_id', 'S'), ('hour', 'N')],
+		'key': [('org-service_id', 'HASH'), ('hour', 'RANGE')]
+	},
+	'Idempotency': {
+		'attributes': [('org-service_id', 'S'), ('key_hash', 'N')],
+		'key': [('org-service_id', 'HASH'), ('key_hash', 'RANGE')],
+		# Items are deleted once the epoch seconds of this attribute have passed
+		'ttl': 'expires'
+	}
+}
 
 class CreateAuditError(Exception):
 	"""Allows identification of creation specific errors"""
 	pass
 
-def create_tables(region_name, access_key, secret_key, prefix=None):
+def _units(units, headroom):
+	"""Helper to round capacity up to whole units, of at least 1"""
+	return max(1, int(ceil(units * headroom)))
+
+def size_audit_capacity(records_per_second, item_size, service_reads_per_second=0, user_reads_per_second=0,
+						consistent_reads=False, headroom=1.25):
+	"""
+	Returns the Audit provisioning for an expected load, for use as a capacity override of create_tables.
+
+	records_per_second is the rate of saves, and item_size the average size of an item in bytes.  Reads are
+	given in records read per second, by service queries (the table) and user queries (the org-user index).
+	Writes are charged per item, rounded up to whole WCUs; query reads are charged on the total size read,
+	with eventually consistent reads costing half.  headroom allows for peaks above the expected rates
+	"""
+	if records_per_second < 0 or item_size <= 0 or service_reads_per_second < 0 or user_reads_per_second < 0:
+		raise ValueError('Rates must not be negative, and the item size must be positive')
+
+	wcu = _units(records_per_second * ceil(float(item_size) / WRITE_UNIT_SIZE), headroom)
+	read_unit_size = float(READ_UNIT_SIZE if consistent_reads else READ_UNIT_SIZE * 2)
+
+	# The index is written with every save, so has the same write capacity as the table
+	return {
+		'table': (_units(service_reads_per_second * item_size / read_unit_size, headroom), wcu),
+		'org-user': (_units(user_reads_per_second * item_size / read_unit_size, headroom), wcu)
+	}
+
+def create_full_table_name(prefix, table_name):
+	"""Helper to create table name"""
+	return table_name if not prefix else '_'.join((prefix, table_name))
+
+def _create_arg(set_tags, attr_def):
+	"""Helper to build JSON for attributes"""
+	attrs = []
+	for attr_name, attr_type in attr_def:
+		attr_set = {}
+		attr_set[set_tags[0]] = attr_name
+		attr_set[set_tags[1]] = attr_type
+		attrs.append(attr_set)
+	return attrs
+
+def _create_throughput((read, write)):
+	"""Helper to build JSON for provisioning"""
+	throughput = {}
+	throughput['ReadCapacityUnits'] = read
+	throughput['WriteCapacityUnits'] = write
+	return throughput
+
+def _create_table_params(full_name, definition, provisioning):
 	"""
-	Create the tables for the audit service, in the region
+	Builds the CreateTable request of a table; provisioning is None for on-demand billing
 	"""
-	def create_arg(set_tags, attr_def):
-		"""Helper to build JSON for attributes"""
-		attrs = []
-		for attr_name, attr_type in attr_def:
-			attr_set = {}
-			attr_set[set_tags[0]] = attr_name
-			attr_set[set_tags[1]] = attr_type
-			attrs.append(attr_set)
-		return attrs
-
-	def create_throughput((read, write)):
-		"""Helper to build JSON for provisioning"""
-		throughput = {}
-		throughput['ReadCapacityUnits'] = read
-		throughput['WriteCapacityUnits'] = write
-		return throughput
-
-	def create_idx(idx_name, schema, projection, throughput):
-		"""Helper for index creation"""
+	params = {
+		'TableName': full_name,
+		'AttributeDefinitions': _create_arg(['AttributeName', 'AttributeType'], definition['attributes']),
+		'KeySchema': _create_arg(['AttributeName', 'KeyType'], definition['key'])
+	}
+	if provisioning is None:
+		params['BillingMode'] = 'PAY_PER_REQUEST'
+	else:
+		params['ProvisionedThroughput'] = _create_throughput(provisioning['table'])
+
+	gsi = []
+	for idx_def in definition.get('indexes', []):
 		idx = {}
-		idx['IndexName'] = idx_name
-		idx['KeySchema'] = create_arg(['AttributeName', 'KeyType'], schema)
-		idx['Projection'] = projection
-		idx['ProvisionedThroughput'] = create_throughput(throughput)
-		return idx
-
-	def create_table(conn, prefix, table_name, attr_def, key_def, provisioning, idx_set=[]):
-		"""Creates the table using the specified connection"""
-		gsi = []
-		for idx_def in idx_set:
-			gsi.append(create_idx(
-				idx_def['name'],
-				idx_def['schema'],
-				{'ProjectionType':'KEYS_ONLY'},
-				idx_def['provisioning']
-				))
-	
-		full_name = create_full_table_name(prefix, table_name)
-
-		if len(gsi):
-			return (full_name, conn.create_table(
-						table_name=full_name,
-						attribute_definitions= create_arg(['AttributeName', 'AttributeType'], attr_def),
-						key_schema=create_arg(['AttributeName', 'KeyType'], key_def),
-						global_secondary_indexes=gsi,
-						provisioned_throughput = create_throughput(provisioning)))
-		else:
-			return (full_name, conn.create_table(
-						table_name=full_name,
-						attribute_definitions= create_arg(['AttributeName', 'AttributeType'], attr_def),
-						key_schema=create_arg(['AttributeName', 'KeyType'], key_def),
-						provisioned_throughput = create_throughput(provisioning)))			
-
-	def create_full_table_name(prefix, table_name):
-		"""Helper to create table name"""
-		return table_name if not prefix else '_'.join((prefix, table_name))
-
-	def create_audit(conn, prefix, provisioning):
-		"""Creates the Audit table"""
-		attr_def = [('service-org_hash', 'S'), ('org-user_hash', 'S'), ('timestamp', 'N')]
-		key_def = [('service-org_hash', 'HASH'), ('timestamp', 'RANGE')]
-		idx1_schema = [('org-user_hash', 'HASH'), ('timestamp', 'RANGE')]
-		idx1 = {'name':'org-user', 'schema':idx1_schema, 'provisioning':provisioning}
-
-		return create_table(conn, prefix, 'Audit', attr_def, key_def, provisioning, [idx1])
-
-	def create_org(conn, prefix, provisioning):
-		"""Creates the Org table"""
-		attr_def = [('org_id', 'S'), ('timestamp', 'N')]
-		key_def = [('org_id', 'HASH'), ('timestamp', 'RANGE')]
-		return create_table(conn, prefix, 'Org', attr_def, key_def, provisioning)
-
-	def create_org_services(conn, prefix, provisioning):
-		"""Creates the OrgService table"""
-		attr_def = [('org-service_id', 'S'), ('timestamp', 'N')]
-		key_def = [('org-service_id', 'HASH'), ('timestamp', 'RANGE')]
-		return create_table(conn, prefix, 'OrgService', attr_def, key_def, provisioning)
+		idx['IndexName'] = idx_def['name']
+		idx['KeySchema'] = _create_arg(['AttributeName', 'KeyType'], idx_def['schema'])
+		idx['Projection'] = {'ProjectionType':idx_def.get('projection', 'KEYS_ONLY')}
+		if provisioning is not None:
+			idx['ProvisionedThroughput'] = _create_throughput(provisioning.get(idx_def['name'], provisioning['table']))
+		gsi.append(idx)
+	if gsi:
+		params['GlobalSecondaryIndexes'] = gsi
+	return params
+
+def _limit_exceeded(error):
+	"""
+	Whether a request failed for exceeding an account limit; boto raises such errors as a plain JSONResponseError
+	"""
+	body = error.body if isinstance(error.body, dict) else {}
+	error_type = error.error_code or body.get('__type', None) or ''
+	return error_type.endswith('LimitExceededException')
+
+def _is_active(description):
+	"""Helper to check that a table and all its indexes are ACTIVE"""
+	table = description['Table']
+	return table['TableStatus'] == 'ACTIVE' and \
+			all(idx['IndexStatus'] == 'ACTIVE' for idx in table.get('GlobalSecondaryIndexes', []))
+
+def provisioning_for(profile=DEFAULT_PROFILE, capacity=None):
+	"""
+	Returns the provisioning of each table from the named profile, with any per-table overrides in capacity
+	"""
+	if profile not in PROFILES:
+		raise CreateAuditError('{} not a known provisioning profile; choose from {}'.format(profile, ', '.join(sorted(PROFILES))))
+	provisioning = dict(PROFILES[profile])
+	for table_name, table_capacity in (capacity or {}).items():
+		if table_name not in TABLE_DEFINITIONS:
+			raise CreateAuditError('{} not a known table'.format(table_name))
+		provisioning[table_name] = table_capacity
+	return provisioning
+
+def create_tables(region_name, access_key, secret_key, prefix=None, profile=DEFAULT_PROFILE, capacity=None,
+					wait=True, timeout=600, poll_interval=2.0):
+	"""
+	Create the tables for the audit service, in the region.
+
+	The tables are provisioned from the profile, with capacity overriding the provisioning of any table,
+	e.g. {'Audit': size_audit_capacity(...)}.  All tables are requested at once and build in parallel;
+	a request refused because too many tables are being created is retried as others complete.  Unless
+	wait is False, returns once every table and index is ACTIVE, or raises if that takes over timeout seconds.
+	Time to live can only be enabled on an ACTIVE table, so is not enabled without waiting
+	"""
+	provisioning = provisioning_for(profile, capacity)
 
 	def _regions():
 		"""Generator for returning dynamodb2 regions"""
@@ -118,26 +230,53 @@ def create_tables(region_name, access_key, secret_key, prefix=None):
 			break
 
 	try:
-		conn = db2.DynamoDBConnection(region=region, 
+		conn = db2.DynamoDBConnection(region=region,
 					aws_access_key_id=access_key,
 					aws_secret_access_key=secret_key)
 	except Exception as e:
 		raise CreateAuditError('Failed to connect to AWS')
 
 	resp = {}
+	pending = sorted(TABLE_DEFINITIONS)
+	creating = set()
+	deadline = time() + timeout
 	try:
-		# Create Audit table - tuple is (ReadCapacity, WriteCapacity)
-		status = create_audit(conn, prefix, (2,5))
-		resp['Audit'] = {'name':status[0], 'status':status[1]}
+		while pending or (wait and creating):
+			for table_name in list(pending):
+				full_name = create_full_table_name(prefix, table_name)
+				params = _create_table_params(full_name, TABLE_DEFINITIONS[table_name], provisioning[table_name])
+				try:
+					status = conn.make_request(action='CreateTable', body=json.dumps(params))
+				except JSONResponseError as e:
+					if not _limit_exceeded(e):
+						raise
+					# Too many tables are being created at once in the account
+					break
+				resp[table_name] = {'name':full_name, 'status':status}
+				pending.remove(table_name)
+				creating.add(table_name)
 
-		# Create Org table
-		status = create_org(conn, prefix, (1,1))
-		resp['Org'] = {'name':status[0], 'status':status[1]}
+			if wait:
+				for table_name in list(creating):
+					status = conn.describe_table(resp[table_name]['name'])
+					if _is_active(status):
+						ttl_attribute = TABLE_DEFINITIONS[table_name].get('ttl', None)
+						if ttl_attribute:
+							conn.make_request(action='UpdateTimeToLive', body=json.dumps({
+										'TableName': resp[table_name]['name'],
+										'TimeToLiveSpecification': {'AttributeName': ttl_attribute, 'Enabled': True}
+									}))
+						resp[table_name]['status'] = status
+						creating.remove(table_name)
 
-		# Create OrgService table
-		status = create_org_services(conn, prefix, (1,1))
-		resp['OrgService'] = {'name':status[0], 'status':status[1]}
+			if pending or (wait and creating):
+				if time() >= deadline:
+					raise CreateAuditError('Tables not ACTIVE after {} seconds: {}'.format(
+								timeout, ', '.join(sorted(set(pending) | creating))))
+				sleep(poll_interval)
 
+	except CreateAuditError:
+		raise
 	except Exception as e:
 		raise CreateAuditError('Failed to create Audit table: {}'.format(e))
 
@@ -151,8 +290,23 @@ if __name__ == "__main__":
 	parser.add_argument('-r','--region', help='DynamoDB region', required=True)
 	parser.add_argument('-k','--access_key', help='AWS Access Key', required=True)
 	parser.add_argument('-s','--secret_key', help='AWS Secret Key', required=True)
+	parser.add_argument('-p','--prefix', help='The table prefix; defaults to a new uuid', required=False)
+	parser.add_argument('--profile', help='Provisioning profile', choices=sorted(PROFILES), default=DEFAULT_PROFILE, required=False)
+	parser.add_argument('--records_per_second', help='Expected saves per second, to size the Audit table instead of using the profile',
+						type=float, default=None, required=False)
+	parser.add_argument('--item_size', help='Expected average Audit item size in bytes, when sizing', type=int, default=512, required=False)
+	parser.add_argument('--service_reads', help='Expected records read per second by service queries, when sizing',
+						type=float, default=0, required=False)
+	parser.add_argument('--user_reads', help='Expected records read per second by user queries, when sizing',
+						type=float, default=0, required=False)
+	parser.add_argument('--no_wait', help='Return without waiting for the tables to be ACTIVE', action='store_true')
 	args = parser.parse_args()
 
+	capacity = None
+	if args.records_per_second is not None:
+		capacity = {'Audit': size_audit_capacity(args.records_per_second, args.item_size, args.service_reads, args.user_reads)}
+
 	# Prefix with unique uuid
 	from uuid import uuid4 as uuid
-	print create_tables(args.region, args.access_key, args.secret_key, str(uuid()))
+	print create_tables(args.region, args.access_key, args.secret_key, args.prefix or str(uuid()),
+						profile=args.profile, capacity=capacity, wait=not args.no_wait)
@@ -0,0 +1,325 @@
+"""
+Prefork launcher for serving the API in production.
+
+The master process binds the listening socket and forks the workers, which all accept from it.
+Each worker initialises itself and its pool of request threads after the fork (so that no
+connections are shared), starts accepting, warms up, and then reports that it is ready.  The
+master publishes whether enough workers are ready, for a readiness endpoint.
+
+Signals to the master:
+	SIGHUP           graceful reload: new workers are started, and the old ones stopped once the new are ready
+	SIGTERM, SIGINT  graceful stop
+
+A stopping worker accepts no more connections, completes the requests it has accepted, and runs
+its exit function (e.g. to flush buffered saves) before exiting.
+"""
+import errno
+import os
+import select
+import signal
+import socket
+import sys
+import traceback
+from multiprocessing import cpu_count, Value
+from Queue import Queue
+from threading import Condition, Event, Thread
+from time import time
+from werkzeug.serving import BaseWSGIServer
+
+# Seconds to wait before replacing a worker that failed before becoming ready
+RESPAWN_DELAY = 1.0
+
+class PooledWSGIServer(BaseWSGIServer):
+	"""
+	WSGI server handling requests on a fixed pool of threads.
+
+	Unlike a thread per request, per-thread state such as storage connections is reused from one request
+	to the next.  init_thread is called on each pool thread before it handles any requests.
+	"""
+	multithread = True
+	multiprocess = True
+
+	def __init__(self, host, port, app, threads=8, init_thread=None, fd=None):
+		BaseWSGIServer.__init__(self, host, port, app, fd=fd)
+		self.init_thread = init_thread
+		self.active = 0
+		self._requests = Queue()
+		self._idle = Condition()
+		self._initialised = Queue()
+		self._threads = [Thread(target=self._work, name='request-{}'.format(i)) for i in range(threads)]
+		for thread in self._threads:
+			thread.daemon = True
+
+	def start_threads(self):
+		"""
+		Starts the pool, returning once every thread has been initialised
+		"""
+		for thread in self._threads:
+			thread.start()
+		errors = [self._initialised.get() for _ in self._threads]
+		errors = [error for error in errors if error]
+		if errors:
+			raise Exception('Request thread initialisation failed: {}'.format(errors[0]))
+
+	def _work(self):
+		error = None
+		if self.init_thread is not None:
+			try:
+				self.init_thread()
+			except Exception as e:
+				error = str(e) or e.__class__.__name__
+		self._initialised.put(error)
+
+		while True:
+			job = self._requests.get()
+			if job is None:
+				return
+			request, client_address = job
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+				with self._idle:
+					self.active -= 1
+					if not self.active:
+						self._idle.notify_all()
+
+	def process_request(self, request, client_address):
+		with self._idle:
+			self.active += 1
+		self._requests.put((request, client_address))
+
+	def wait_idle(self, timeout):
+		"""
+		Waits until all accepted requests have completed, returning False if they don't within the timeout
+		"""
+		deadline = time() + timeout
+		with self._idle:
+			while self.active:
+				remaining = deadline - time()
+				if remaining <= 0:
+					return False
+				self._idle.wait(remaining)
+		return True
+
+	def stop_threads(self):
+		for _ in self._threads:
+			self._requests.put(None)
+
+class _Worker(object):
+	"""
+	The master's record of a worker process
+	"""
+	def __init__(self, pid, generation, ready_fd):
+		self.pid = pid
+		self.generation = generation
+		self.ready_fd = ready_fd
+		self.ready = False
+		self.stopping = False
+
+class PreforkServer(object):
+	"""
+	Serves a WSGI app from workers forked by a master process.
+
+	init_worker is called by each worker after the fork, before any request threads start, and init_thread
+	on each request thread before the worker accepts requests.  warm_up is called once the worker is
+	accepting, and the worker is ready when it returns.  on_exit is called by a worker after its last
+	request completes.  workers defaults to the number of cores.
+	"""
+	def __init__(self, app, host='127.0.0.1', port=5000, workers=None, threads=8,
+					init_worker=None, init_thread=None, warm_up=None, on_exit=None, graceful_timeout=30):
+		self.app = app
+		self.host = host
+		self.port = port
+		self.workers = workers or cpu_count()
+		self.threads = threads
+		self.init_worker = init_worker
+		self.init_thread = init_thread
+		self.warm_up = warm_up
+		self.on_exit = on_exit
+		self.graceful_timeout = graceful_timeout
+
+		# Set by the master whenever at least the configured number of workers are ready to serve
+		self._ready = Value('b', 0, lock=False)
+		self._socket = None
+		self._children = {}
+		self._generation = 0
+		self._respawn_at = 0
+		self._reload = False
+		self._stop = False
+
+	def is_ready(self):
+		"""
+		Returns whether enough workers have warmed up to serve requests; may be called from any worker
+		"""
+		return bool(self._ready.value)
+
+	def _log(self, message):
+		sys.stderr.write('[{}] {}\n'.format(os.getpid(), message))
+
+	def serve_forever(self):
+		"""
+		Runs the master until it is stopped; returns once all workers have exited
+		"""
+		self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self._socket.bind((self.host, self.port))
+		self._socket.listen(BaseWSGIServer.request_queue_size)
+
+		signal.signal(signal.SIGHUP, self._on_reload)
+		signal.signal(signal.SIGTERM, self._on_stop)
+		signal.signal(signal.SIGINT, self._on_stop)
+
+		self._log('Serving on {}:{} with {} workers'.format(self.host, self.port, self.workers))
+		try:
+			while not self._stop:
+				if self._reload:
+					self._reload = False
+					self._generation += 1
+					self._log('Reloading workers')
+				self._manage()
+				self._wait_events(0.5)
+				self._reap()
+
+			self._log('Stopping workers')
+			for worker in self._children.values():
+				self._stop_worker(worker)
+			while self._children:
+				self._wait_events(0.5)
+				self._reap()
+		finally:
+			self._socket.close()
+
+	def _on_reload(self, signum, frame):
+		self._reload = True
+
+	def _on_stop(self, signum, frame):
+		self._stop = True
+
+	def _manage(self):
+		"""
+		Starts workers of the current generation as needed, and stops those of older generations once
+		the current generation is ready
+		"""
+		current = [w for w in self._children.values() if w.generation == self._generation]
+		missing = self.workers - len(current)
+		if missing > 0 and time() >= self._respawn_at:
+			for _ in range(missing):
+				self._spawn()
+
+		if all(w.ready for w in current) and len(current) >= self.workers:
+			for worker in self._children.values():
+				if worker.generation != self._generation and not worker.stopping:
+					self._stop_worker(worker)
+
+		ready = [w for w in self._children.values() if w.ready and not w.stopping]
+		self._ready.value = 1 if len(ready) >= self.workers else 0
+
+	def _wait_events(self, timeout):
+		"""
+		Waits for workers to report that they are ready
+		"""
+		fds = dict((w.ready_fd, w) for w in self._children.values() if not w.ready)
+		try:
+			readable, _, _ = select.select(list(fds), [], [], timeout)
+		except select.error as e:
+			if e.args[0] != errno.EINTR:
+				raise
+			return
+		for fd in readable:
+			if os.read(fd, 1):
+				fds[fd].ready = True
+
+	def _reap(self):
+		"""
+		Collects exited workers
+		"""
+		while True:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except OSError as e:
+				if e.errno == errno.EINTR:
+					continue
+				if e.errno == errno.ECHILD:
+					return
+				raise
+			if not pid:
+				return
+
+			worker = self._children.pop(pid, None)
+			if worker is None:
+				continue
+			os.close(worker.ready_fd)
+			if not worker.stopping:
+				self._log('Worker {} exited unexpectedly with status {}'.format(pid, status))
+				if not worker.ready:
+					self._respawn_at = time() + RESPAWN_DELAY
+
+	def _stop_worker(self, worker):
+		worker.stopping = True
+		try:
+			os.kill(worker.pid, signal.SIGTERM)
+		except OSError:
+			pass
+
+	def _spawn(self):
+		read_fd, write_fd = os.pipe()
+		pid = os.fork()
+		if pid:
+			os.close(write_fd)
+			self._children[pid] = _Worker(pid, self._generation, read_fd)
+			return
+
+		# Child
+		os.close(read_fd)
+		status = 1
+		try:
+			self._run_worker(write_fd)
+			status = 0
+		except Exception:
+			traceback.print_exc()
+		finally:
+			os._exit(status)
+
+	def _run_worker(self, ready_fd):
+		"""
+		Runs in the worker process after the fork
+		"""
+		stop = Event()
+		signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		signal.signal(signal.SIGHUP, signal.SIG_IGN)
+		for fd in [w.ready_fd for w in self._children.values()]:
+			os.close(fd)
+		self._children = {}
+
+		if self.init_worker is not None:
+			self.init_worker()
+
+		server = PooledWSGIServer(self.host, self.port, self.app, self.threads, self.init_thread, fd=self._socket.fileno())
+		server.start_threads()
+		accepting = Thread(target=server.serve_forever, name='accept')
+		accepting.daemon = True
+		accepting.start()
+
+		# Requests are served while warming up, and readiness checks fail until every worker is ready
+		if self.warm_up is not None:
+			self.warm_up()
+		os.write(ready_fd, 'r')
+		os.close(ready_fd)
+		self._log('Worker ready')
+
+		# Event.wait without a timeout would not be interrupted by signals
+		while not stop.is_set():
+			stop.wait(1.0)
+
+		# Stop accepting, then let accepted requests complete
+		server.shutdown()
+		if not server.wait_idle(self.graceful_timeout):
+			self._log('Worker stopping with {} requests incomplete'.format(server.active))
+		server.stop_threads()
+		if self.on_exit is not None:
+			self.on_exit()
+		self._log('Worker stopped')
@@ -0,0 +1,197 @@
+"""
+Streaming ingest server: saves records sent as length-prefixed frames over persistent TCP connections.
+
+For the highest volume services, a JSON request per record costs more than the save itself.  Over a
+stream, records are sent many to a frame, frames are pipelined within the acknowledgement window, and
+the connection is kept, so only the records themselves are decoded.  The protocol is described in
+audit.framing.
+
+Each frame's records are grouped by org/service pair and saved with Audit.save_batch, so they are
+validated, deduplicated by idempotency key, written and published exactly as through the batch API.
+Acks are sent once ack_every frames are unacknowledged, or when no more data is waiting, so that a
+client streaming steadily receives an ack per ack_every frames rather than per frame.
+
+Records of unacknowledged frames may or may not have been saved when a connection fails, so clients
+resending them should give records idempotency keys.
+"""
+import select
+import socket
+from audit.framing import STREAM_MAGIC, DEFAULT_MAX_FRAME, DEFAULT_WINDOW, FrameError, FrameReader, codecs, encode_frame
+from audit.metrics import STREAM_FRAMES, STREAM_RECORDS
+from SocketServer import BaseRequestHandler, ThreadingTCPServer
+from threading import Lock, Thread
+
+# Bytes read from a connection at a time
+RECV_SIZE = 65536
+
+def ingest(audit, records):
+	"""
+	Saves the [org_id, service_id, record] entries of a frame, returning (saved, failures) where
+	failures lists (index, error_message) pairs
+	"""
+	if not isinstance(records, list):
+		raise FrameError('Frames must hold a list of records')
+
+	failures = []
+	groups = {}
+	for idx, entry in enumerate(records):
+		if not isinstance(entry, (list, tuple)) or len(entry) != 3:
+			failures.append((idx, 'Invalid data supplied'))
+			continue
+		org_id, service_id, record = entry
+		groups.setdefault((org_id, service_id), ([], []))
+		indexes, group = groups[(org_id, service_id)]
+		indexes.append(idx)
+		group.append(record)
+
+	saved = 0
+	for (org_id, service_id), (indexes, group) in groups.items():
+		try:
+			results = audit.save_batch(org_id, service_id, group)
+		except Exception as e:
+			# The org/service pair is invalid, so none of its records were saved
+			failures.extend((idx, e.message or str(e)) for idx in indexes)
+			continue
+		for idx, result in zip(indexes, results):
+			if result['status'] == 'saved':
+				saved += 1
+			else:
+				failures.append((idx, result['error_message']))
+
+	failures.sort()
+	STREAM_RECORDS.inc(saved, 'saved')
+	if failures:
+		STREAM_RECORDS.inc(len(failures), 'failed')
+	return (saved, failures)
+
+class _StreamHandler(BaseRequestHandler):
+	"""
+	Serves one ingest connection
+	"""
+	def _read_exact(self, size):
+		data = b''
+		while len(data) < size:
+			chunk = self.request.recv(size - len(data))
+			if not chunk:
+				return None
+			data += chunk
+		return data
+
+	def handle(self):
+		server = self.server
+		conn = self.request
+		conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		with server.lock:
+			server.connections += 1
+		try:
+			opening = self._read_exact(len(STREAM_MAGIC) + 1)
+			if opening is None or opening[:len(STREAM_MAGIC)] != STREAM_MAGIC:
+				return
+			codec = codecs().get(opening[len(STREAM_MAGIC):], None)
+			if codec is None:
+				# Without a codec, the error cannot be encoded, so the connection is just closed
+				return
+			conn.sendall(encode_frame(codec, {'window': server.window, 'max_frame': server.max_frame}))
+
+			try:
+				self._serve(codec)
+			except FrameError as e:
+				conn.sendall(encode_frame(codec, {'error': e.message}))
+		except socket.error:
+			# The client has gone; its unacknowledged frames may be resent
+			pass
+		finally:
+			with server.lock:
+				server.connections -= 1
+
+	def _serve(self, codec):
+		server = self.server
+		conn = self.request
+		reader = FrameReader(server.max_frame)
+		seq = -1
+		unacked = 0
+		saved = 0
+		failed = []
+
+		def ack():
+			conn.sendall(encode_frame(codec, {'ack': seq, 'saved': saved, 'failed': failed}))
+
+		while True:
+			data = conn.recv(RECV_SIZE)
+			if not data:
+				if reader.pending:
+					raise FrameError('Connection closed within a frame')
+				if unacked:
+					ack()
+				return
+
+			for body in reader.feed(data):
+				try:
+					records = codec.loads(body)
+				except Exception:
+					raise FrameError('Frame {} could not be decoded'.format(seq + 1))
+				seq += 1
+				STREAM_FRAMES.inc()
+				frame_saved, frame_failures = ingest(server.audit, records)
+				saved += frame_saved
+				failed.extend([seq, idx, error] for idx, error in frame_failures)
+				unacked += 1
+				if unacked >= server.ack_every:
+					ack()
+					unacked, saved, failed = 0, 0, []
+
+			# Hold the ack back while more frames are already waiting, to cover them too
+			if unacked and not select.select([conn], [], [], 0)[0]:
+				ack()
+				unacked, saved, failed = 0, 0, []
+
+class StreamIngestServer(ThreadingTCPServer):
+	"""
+	Accepts ingest connections, serving each on its own thread.
+
+	With fd, accepts from an already bound and listening socket, such as one shared by forked workers
+	"""
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, audit, host='127.0.0.1', port=5001, window=DEFAULT_WINDOW, max_frame=DEFAULT_MAX_FRAME, fd=None):
+		ThreadingTCPServer.__init__(self, (host, port), _StreamHandler, bind_and_activate=fd is None)
+		if fd is not None:
+			self.socket.close()
+			self.socket = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+			self.server_address = self.socket.getsockname()
+		self.audit = audit
+		self.window = window
+		self.ack_every = max(1, window // 2)
+		self.max_frame = max_frame
+		self.connections = 0
+		self.lock = Lock()
+		self._thread = None
+
+	def start(self):
+		"""
+		Serves connections from a background thread
+		"""
+		self._thread = Thread(target=self.serve_forever, name='audit-stream')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		"""
+		Stops accepting connections; connections already accepted are served until they close
+		"""
+		if self._thread is not None:
+			self.shutdown()
+			self._thread.join()
+			self._thread = None
+		self.server_close()
+
+def bind_stream_socket(host, port):
+	"""
+	Returns a listening socket for a StreamIngestServer, to be shared by forked workers
+	"""
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind((host, port))
+	sock.listen(ThreadingTCPServer.request_queue_size)
+	return sock
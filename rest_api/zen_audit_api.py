@@ -5,16 +5,119 @@ The AWS credentials must be able to write data to the Audit service tables in AW
 
 """
 import argparse
-from audit import get_tm, create_hash
-from audit.aws import Audit
+import json
+from audit import get_tm
+from audit.aws import Audit, SaveInProgress, ValidationError
+from audit.backends import BACKENDS, create_backend
+from audit.blobs import FileBlobStore
+from audit.changes import DEFAULT_INLINE_LIMIT
+from audit.framing import DEFAULT_WINDOW
 from datetime import datetime as dt
-from flask import Flask, abort, request, jsonify, make_response
+from audit.metrics import REGISTRY, SAVE_STAGE_SECONDS, BATCH_STAGE_SECONDS
+from flask import Flask, Response, abort, request, jsonify, make_response, stream_with_context
+from rest_api.prefork import PooledWSGIServer, PreforkServer
+from rest_api.stream import StreamIngestServer, bind_stream_socket
 
 # Provides all audit functionality
 audit = Audit()
 
 app = Flask(__name__)
 
+# Reports whether the service has warmed up and may be sent requests; assigned by serve()
+ready_check = lambda: False
+
+# The streaming ingest server of this process, when enabled; assigned by serve()
+stream_server = None
+
+def _cache_stat(field):
+	"""Returns a callback reading one counter of each in-process cache"""
+	return lambda: dict((name, stats[field]) for name, stats in audit.cache_stats().items())
+
+def _write_buffer_stat(field):
+	"""Returns a callback reading one counter of the write-behind buffer, when enabled"""
+	def stat():
+		write_buffer = audit.write_buffer
+		return {None: write_buffer.stats()[field]} if write_buffer is not None else {}
+	return stat
+
+def _rate_limit_stat(field):
+	"""Returns a callback reading one value of each table's rate limiter, when enabled"""
+	return lambda: dict((table_name, stats[field]) for table_name, stats in audit.rate_limit_stats().items())
+
+def _rollup_stat(field):
+	"""Returns a callback reading one counter of the rollups, when enabled"""
+	def stat():
+		rollups = audit.rollups
+		return {None: rollups.stats()[field]} if rollups is not None else {}
+	return stat
+
+def _query_cache_bytes():
+	"""Returns the approximate memory held by the query cache, when enabled"""
+	query_cache = audit.query_cache
+	return {None: query_cache.stats()['bytes']} if query_cache is not None else {}
+
+def _blob_stat(field):
+	"""Returns a callback reading one counter of the blob store, when configured"""
+	def stat():
+		blob_store = audit.blob_store
+		return {None: blob_store.stats()[field]} if blob_store is not None else {}
+	return stat
+
+def _idempotency_stat():
+	"""Returns the idempotency keys checked, by result, when deduplication is enabled"""
+	idempotency = audit.idempotency
+	if idempotency is None:
+		return {}
+	stats = idempotency.stats()
+	return dict((result, stats[result]) for result in ('new', 'possible', 'duplicates', 'pending'))
+
+def _stream_connections():
+	"""Returns the number of open ingest streams, when streaming ingest is enabled"""
+	return {None: stream_server.connections} if stream_server is not None else {}
+
+def _connection_count():
+	"""Returns the number of storage connections, for backends that open one per thread"""
+	connection_count = getattr(audit.backend, 'connection_count', None)
+	return {None: connection_count()} if connection_count is not None else {}
+
+REGISTRY.callback('audit_cache_hits_total', 'Lookups answered by an in-process cache', 'counter', 'cache', _cache_stat('hits'))
+REGISTRY.callback('audit_cache_misses_total', 'Lookups not answered by an in-process cache', 'counter', 'cache', _cache_stat('misses'))
+REGISTRY.callback('audit_cache_hit_ratio', 'Fraction of lookups answered by an in-process cache', 'gauge', 'cache', _cache_stat('hit_rate'))
+REGISTRY.callback('audit_cache_entries', 'Entries held by an in-process cache', 'gauge', 'cache', _cache_stat('size'))
+REGISTRY.callback('audit_write_buffer_items', 'Items waiting in the write-behind buffer', 'gauge', None, _write_buffer_stat('size'))
+REGISTRY.callback('audit_write_buffer_rejected_total', 'Saves rejected because the write-behind buffer was full', 'counter', None, _write_buffer_stat('rejected'))
+REGISTRY.callback('audit_write_buffer_flushed_total', 'Items written from the write-behind buffer', 'counter', None, _write_buffer_stat('flushed_items'))
+REGISTRY.callback('audit_write_buffer_retried_total', 'Writes of items from the write-behind buffer retried after failing', 'counter', None, _write_buffer_stat('retried_items'))
+REGISTRY.callback('audit_write_buffer_failed_total', 'Items from the write-behind buffer that could not be written once retried', 'counter', None, _write_buffer_stat('failed_items'))
+REGISTRY.callback('audit_write_buffer_dead_lettered_total', 'Failed items from the write-behind buffer written to the dead letter file', 'counter', None, _write_buffer_stat('dead_lettered'))
+REGISTRY.callback('audit_rate_limit_per_second', 'Current adaptive request rate limit of a table', 'gauge', 'table', _rate_limit_stat('rate'))
+REGISTRY.callback('audit_rollup_pending_buckets', 'Hourly rollup buckets with counts waiting to be flushed', 'gauge', None, _rollup_stat('buckets'))
+REGISTRY.callback('audit_rollup_failed_buckets_total', 'Rollup bucket flushes that failed, and were retried', 'counter', None, _rollup_stat('failed_buckets'))
+REGISTRY.callback('audit_query_cache_bytes', 'Approximate memory held by cached query results', 'gauge', None, _query_cache_bytes)
+REGISTRY.callback('audit_blob_puts_total', 'Change payloads offloaded to the blob store', 'counter', None, _blob_stat('puts'))
+REGISTRY.callback('audit_blob_deduplicated_total', 'Offloaded change payloads already held by the blob store', 'counter', None, _blob_stat('deduplicated'))
+REGISTRY.callback('audit_blob_written_bytes_total', 'Bytes written to the blob store', 'counter', None, _blob_stat('bytes_written'))
+REGISTRY.callback('audit_idempotency_keys_total', 'Idempotency keys checked: new to this process, possibly seen (checked in storage), duplicates or pending (refused while in flight)',
+				'counter', 'result', _idempotency_stat)
+REGISTRY.callback('audit_stream_connections', 'Open streaming ingest connections', 'gauge', None, _stream_connections)
+REGISTRY.callback('audit_storage_connections', 'Storage connections open in this process, one per thread that has used storage', 'gauge', None, _connection_count)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+	"""
+	Returns the service metrics in the Prometheus text exposition format
+	"""
+	return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/ready', methods=['GET'])
+def ready():
+	"""
+	Readiness check, failing until the service has warmed up
+	"""
+	if not ready_check():
+		return make_response(jsonify({'status':503, 'error_message':'Service is warming up'}), 503)
+	return make_response(jsonify({'status':200, 'error_message':''}), 200)
+
 @app.route('/1.0/audit/org/', methods=['GET'])
 def get_org_info():
 	"""
@@ -195,12 +298,38 @@ def save_audit(org_id, service_id):
 
 	The structure of the supplied data must also be complete for the save to occur.  
 
-	Saves are not idempotent, so that repeated calls will add additional records in the service.
+	Body should contain JSON of the form:
+
+	{
+		"timestamp":"The timestamp of the change",
+		"obo_id":"The identifier of the user on whose behalf the change was made",
+		"actor_id":"The identifier of the user who made the change",
+		"changes":{
+			"before":"The changed data before the change, as an object (optional)",
+			"after":"The changed data after the change, as an object (optional)"
+		},
+		"idempotency_key":"A key unique to this record within the service, of up to 256 characters"
+	}
+
+	where changes and idempotency_key are optional.  Large change payloads are held outside the record,
+	when the service has a blob store.
+
+	Saves without an idempotency key are not idempotent, so that repeated calls will add additional
+	records in the service.  A save repeating the idempotency key of a record already saved, within the
+	last day, is acknowledged as saved without adding a record, so that retries are safe, when the
+	service is started with --idempotency_keys.
+
+	A save repeating the key of a save still in progress returns a status code of 409, with JSON of the
+	form {"status":409, "error_message":"..."}; the original save may yet succeed or fail, so the save
+	should be retried after a short delay, when it will be acknowledged or saved.  Other errors return
+	a status code of 404.
 	"""
 
 	try:
 		tm_start = dt.utcnow()
-		save_status = audit.save_data(org_id, service_id, request.get_json())
+		with SAVE_STAGE_SECONDS.time('parse'):
+			data = request.get_json()
+		save_status = audit.save_data(org_id, service_id, data)
 		tm_end = dt.utcnow()
 
 		resp_data = {
@@ -208,7 +337,322 @@ def save_audit(org_id, service_id):
 				"total_time": get_tm(tm_end) - get_tm(tm_start)
 			}
 
-		return jsonify(resp_data)
+		with SAVE_STAGE_SECONDS.time('serialise'):
+			return jsonify(resp_data)
+
+	except SaveInProgress as e:
+		return make_response((jsonify({'status':409, 'error_message':e.message}), 409))
+
+	except Exception as e:
+		return make_response((jsonify({'status':404, 'error_message':e.message}), 404))
+
+@app.route('/1.0/audit/org/<org_id>/services/<service_id>/save/batch/', methods=['POST'])
+def save_audit_batch(org_id, service_id):
+	"""
+	Saves a list of audit records against the specified organisation and service identifiers.
+
+	The organisation and service identifiers are validated once for the whole batch, and an
+	error is returned if they are invalid.  Each record is then validated and saved individually,
+	so that a bad record does not prevent the others from being saved.
+
+	Body should contain a JSON list of records, each of the same form as for a single save.
+
+	A successful request will return a status code of 200 and returns JSON of the form:
+
+	{
+		"saved":"The number of records saved",
+		"failed":"The number of records that could not be saved",
+		"results":[
+			{"status":"saved"},
+			{"status":"failed", "error_message":"A description of why the record was not saved"},
+			{"status":"in_progress", "error_message":"A save with this idempotency key is in progress"}
+			...
+		],
+		"total_time":"The time taken to process the request, in microseconds"
+	}
+
+	with one result per supplied record, in the order supplied.
+
+	As for a single save, records with an idempotency key are only saved once; a record repeating the
+	key of one already saved, or of an earlier record in the batch, is given the same result.  A record
+	repeating the key of a save still in progress has the status in_progress, and should be retried as
+	for a single save; it is counted as failed.  Records without one are added each time they are saved.
+	"""
+	try:
+		tm_start = dt.utcnow()
+		with BATCH_STAGE_SECONDS.time('parse'):
+			records = request.get_json()
+		results = audit.save_batch(org_id, service_id, records)
+		tm_end = dt.utcnow()
+
+		saved = len([r for r in results if r['status'] == 'saved'])
+		resp_data = {
+				"saved": saved,
+				"failed": len(results) - saved,
+				"results": results,
+				"total_time": get_tm(tm_end) - get_tm(tm_start)
+			}
+
+		with BATCH_STAGE_SECONDS.time('serialise'):
+			return jsonify(resp_data)
+
+	except Exception as e:
+		return make_response((jsonify({'status':404, 'error_message':e.message}), 404))
+
+def _query_args():
+	"""
+	Extracts the record query arguments from the request query string
+	"""
+	args = {}
+	for name, key in (('from', 'tm_from'), ('to', 'tm_to'), ('limit', 'limit')):
+		value = request.args.get(name, None)
+		if value is not None:
+			try:
+				args[key] = int(value)
+			except ValueError:
+				raise ValidationError('Invalid {} supplied'.format(name))
+
+	order = request.args.get('order', 'asc')
+	if order not in ('asc', 'desc'):
+		raise ValidationError('Invalid order supplied')
+	args['descending'] = order == 'desc'
+	args['cursor'] = request.args.get('cursor', None)
+
+	changes = request.args.get('changes', '0')
+	if changes not in ('0', '1'):
+		raise ValidationError('Invalid changes supplied')
+	args['changes'] = changes == '1'
+	return args
+
+def _stream_records(stream):
+	"""
+	Streams the records as newline delimited JSON, ending with the continuation cursor
+	"""
+	def generate():
+		try:
+			for record in stream:
+				yield json.dumps(record) + '\n'
+			yield json.dumps({'next_cursor': stream.next_cursor}) + '\n'
+		except Exception as e:
+			# Too late to change the status code, so report the failure in the stream
+			yield json.dumps({'error_message': e.message or str(e)}) + '\n'
+
+	return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/1.0/audit/org/<org_id>/services/<service_id>/records/', methods=['GET'])
+def query_service_records(org_id, service_id):
+	"""
+	Returns the audit records saved by the specified organisation and service, in timestamp order.
+
+	Optional query string parameters:
+
+		from	- earliest timestamp to return (inclusive)
+		to		- latest timestamp to return (inclusive)
+		order	- 'asc' (the default) or 'desc'
+		limit	- maximum number of records to return
+		cursor	- continues a previous query from where its limit was reached
+		changes	- 1 to include the change payload of each record; defaults to 0
+
+	A successful request will return a status code of 200, and a stream of newline delimited JSON
+	with one line per record, of the form:
+
+	{
+		"timestamp":"The timestamp of the change",
+		"obo_id":"The identifier of the user on whose behalf the change was made",
+		"actor_id":"The identifier of the user who made the change",
+		"service_id":"The identifier of the service",
+		"changes":"The change payload as saved, or null if there was none; only with changes=1"
+	}
+
+	followed by a final line of the form:
+
+	{
+		"next_cursor":"The cursor to continue the query from, or null if no more records are available"
+	}
+
+	If the query fails after the stream has started, the final line instead has an "error_message".
+
+	A failure before the stream starts will return the relevant status code and JSON of the form:
+
+	{
+		"status":"The status code returned by the service",
+		"message":"A description of the error that occurred"
+	}
+	"""
+	try:
+		stream = audit.query_service_records(org_id, service_id, **_query_args())
+		return _stream_records(stream)
+
+	except Exception as e:
+		return make_response((jsonify({'status':404, 'error_message':e.message}), 404))
+
+@app.route('/1.0/audit/org/<org_id>/services/<service_id>/tail/', methods=['GET'])
+def tail_service_records(org_id, service_id):
+	"""
+	Returns the audit records saved by the specified organisation and service after a timestamp,
+	waiting for new records to be saved if there are none yet.
+
+	Optional query string parameters:
+
+		after	- the last timestamp already seen; defaults to the latest record saved
+		timeout	- seconds to wait for a new record, up to 60; defaults to 20
+		limit	- maximum number of records to return; defaults to 100
+
+	A successful request will return a status code of 200, and JSON of the form:
+
+	{
+		"records":[The records, in the form returned by the service records query],
+		"cursor":"The timestamp to pass as 'after' to continue the tail"
+	}
+
+	The records are empty if none were saved before the timeout.
+	"""
+	try:
+		args = {}
+		for name, convert in (('after', int), ('timeout', float), ('limit', int)):
+			value = request.args.get(name, None)
+			if value is not None:
+				try:
+					args[name] = convert(value)
+				except ValueError:
+					raise ValidationError('Invalid {} supplied'.format(name))
+
+		records, cursor = audit.tail_service_records(org_id, service_id, **args)
+		return make_response(jsonify({'records':records, 'cursor':cursor}), 200)
+
+	except Exception as e:
+		return make_response((jsonify({'status':404, 'error_message':e.message}), 404))
+
+def _rollup_args():
+	"""
+	Extracts the rollup query bounds from the request query string
+	"""
+	args = {}
+	for name, key in (('from', 'tm_from'), ('to', 'tm_to')):
+		value = request.args.get(name, None)
+		if value is not None:
+			try:
+				args[key] = int(value)
+			except ValueError:
+				raise ValidationError('Invalid {} supplied'.format(name))
+	return args
+
+@app.route('/1.0/audit/org/<org_id>/services/<service_id>/rollups/', methods=['GET'])
+def query_service_rollups(org_id, service_id):
+	"""
+	Returns the hourly counts of the audit records saved by the specified organisation and service.
+
+	Optional query string parameters:
+
+		from	- timestamp within the earliest hour to return
+		to		- timestamp within the latest hour to return
+
+	A successful request will return a status code of 200, and JSON of the form:
+
+	{
+		"rollups":[
+			{
+				"hour":"The timestamp of the start of the hour",
+				"count":"The number of records with timestamps in the hour",
+				"obo_count":"How many of those were made on behalf of another user"
+			}
+		]
+	}
+
+	Hours without records are omitted.  Records are only counted while the service is started with
+	--rollup_interval; earlier hours can be rebuilt from an export with audit.rollup.
+	"""
+	try:
+		return jsonify({'rollups':audit.query_service_rollups(org_id, service_id, **_rollup_args())})
+
+	except Exception as e:
+		return make_response((jsonify({'status':404, 'error_message':e.message}), 404))
+
+@app.route('/1.0/audit/org/<org_id>/rollups/', methods=['GET'])
+def query_org_rollups(org_id):
+	"""
+	Returns the hourly counts of the audit records saved by the specified organisation, summed across
+	a set of its services.
+
+	Query string parameters:
+
+		services	- comma separated identifiers of the services (required)
+		from		- timestamp within the earliest hour to return
+		to			- timestamp within the latest hour to return
+
+	Returns the same JSON as the service rollups query.
+	"""
+	try:
+		services = [service_id for service_id in request.args.get('services', '').split(',') if service_id]
+		return jsonify({'rollups':audit.query_org_rollups(org_id, services, **_rollup_args())})
+
+	except Exception as e:
+		return make_response((jsonify({'status':404, 'error_message':e.message}), 404))
+
+@app.route('/1.0/audit/org/<org_id>/users/<user_id>/records/', methods=['GET'])
+def query_user_records(org_id, user_id):
+	"""
+	Returns the audit records, across all services, of changes made on behalf of the specified user
+	of the organisation, in timestamp order.
+
+	Accepts the same query string parameters, and returns the same stream of records, as the
+	service records query.
+	"""
+	try:
+		stream = audit.query_user_records(org_id, user_id, **_query_args())
+		return _stream_records(stream)
+
+	except Exception as e:
+		return make_response((jsonify({'status':404, 'error_message':e.message}), 404))
+
+@app.route('/1.0/audit/org/<org_id>/investigate/', methods=['POST'])
+def investigate_records(org_id):
+	"""
+	Returns the audit records of the organisation for a set of users and/or services, merged
+	into a single stream in timestamp order.
+
+	The per user and per service queries are made concurrently by the service.
+
+	Body should contain JSON of the form:
+
+	{
+		"users":["Identifiers of the users on whose behalf changes were made"],
+		"services":["Identifiers of the services"],
+		"from":"Earliest timestamp to return (inclusive, optional)",
+		"to":"Latest timestamp to return (inclusive, optional)",
+		"order":"'asc' (the default) or 'desc'",
+		"limit":"Maximum number of records to return (optional)",
+		"cursor":"Continues a previous investigation from where its limit was reached (optional)",
+		"changes":"true to include the change payload of each record (optional)"
+	}
+
+	At least one of users and services must be supplied; if both are, only records matching
+	one of the users and one of the services are returned.
+
+	Returns the same stream of records as the service records query.
+	"""
+	try:
+		body = request.get_json()
+		if not isinstance(body, dict):
+			raise ValidationError('Invalid data supplied')
+
+		order = body.get('order', 'asc')
+		if order not in ('asc', 'desc'):
+			raise ValidationError('Invalid order supplied')
+		changes = body.get('changes', False)
+		if not isinstance(changes, bool):
+			raise ValidationError('Invalid changes supplied')
+
+		stream = audit.investigate_records(org_id,
+					users=body.get('users', None),
+					services=body.get('services', None),
+					tm_from=body.get('from', None),
+					tm_to=body.get('to', None),
+					descending=order == 'desc',
+					limit=body.get('limit', None),
+					cursor=body.get('cursor', None),
+					changes=changes)
+		return _stream_records(stream)
 
 	except Exception as e:
 		return make_response((jsonify({'status':404, 'error_message':e.message}), 404))
@@ -219,20 +663,141 @@ def save_audit(org_id, service_id):
 def bad_routing_start(varargs = None):
 	abort(404)
 
+def add_server_arguments(parser):
+	"""
+	Adds the arguments of serve() to the parser
+	"""
+	parser.add_argument('-d','--debug', help='Run in debug', default=False, required=False)
+	parser.add_argument('--host', help='Interface to listen on', default='127.0.0.1', required=False)
+	parser.add_argument('--port', help='Port to listen on', type=int, default=5000, required=False)
+	parser.add_argument('--prefork', help='Serve from forked worker processes, rather than the development server',
+						action='store_true', default=False, required=False)
+	parser.add_argument('--workers', help='Number of worker processes, defaults to the number of cores', type=int, default=None, required=False)
+	parser.add_argument('--threads', help='Number of request threads, of each worker with --prefork', type=int, default=8, required=False)
+	parser.add_argument('--stream_port', help='Port to accept streaming ingest connections on; 0 disables streaming ingest',
+						type=int, default=0, required=False)
+	parser.add_argument('--stream_window', help='Frames a streaming ingest client may send before waiting for an ack',
+						type=int, default=DEFAULT_WINDOW, required=False)
+
+def serve(args, init_worker):
+	"""
+	Serves the API until stopped.
+
+	init_worker connects audit to storage; with --prefork it is called in each worker after the fork.
+	With --stream_port, each worker also serves streaming ingest connections, accepted from a shared socket.
+
+	Without --prefork, requests are served by a fixed pool of threads, as in each worker, so that the storage
+	connection of each thread is reused rather than one opened per request
+	"""
+	global ready_check
+
+	stream_socket = bind_stream_socket(args.host, args.stream_port) if args.stream_port else None
+
+	def init():
+		global stream_server
+		init_worker()
+		if stream_socket is not None:
+			stream_server = StreamIngestServer(audit, window=args.stream_window, fd=stream_socket.fileno())
+			stream_server.start()
+
+	if args.prefork:
+		# Saves made by other workers are not published to this worker's tails
+		audit.tail_feed.check_storage = True
+		server = PreforkServer(app, args.host, args.port,
+					workers=args.workers,
+					threads=args.threads,
+					init_worker=init,
+					init_thread=lambda: audit.warm_up(load_orgs=False),
+					warm_up=audit.warm_up,
+					on_exit=audit.flush_and_stop)
+		ready_check = server.is_ready
+		server.serve_forever()
+	else:
+		init()
+		app.debug = bool(args.debug)
+		server = PooledWSGIServer(args.host, args.port, app, threads=args.threads,
+					init_thread=lambda: audit.warm_up(load_orgs=False))
+		server.start_threads()
+		audit.warm_up()
+		ready_check = lambda: True
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
+			server.stop_threads()
+
 if __name__ == "__main__":
 
 	# Process arguments
 	parser = argparse.ArgumentParser(description='This runs the flask based web-server providing the API')
-	parser.add_argument('-d','--debug', help='Run in debug', default=False, required=False)
-	parser.add_argument('-r','--region', help='DynamoDB region', required=True)
-	parser.add_argument('-k','--access_key', help='AWS Access Key', required=True)
-	parser.add_argument('-s','--secret_key', help='AWS Secret Key', required=True)
-	parser.add_argument('-p','--prefix', help='The table prefix in DynamoDB', required=True)
+	add_server_arguments(parser)
+	parser.add_argument('-b','--backend', help='Storage backend', choices=BACKENDS, default='dynamodb', required=False)
+	parser.add_argument('-f','--sqlite_path', help='Database file for the sqlite backend', default=':memory:', required=False)
+	parser.add_argument('-r','--region', help='DynamoDB region', required=False)
+	parser.add_argument('-k','--access_key', help='AWS Access Key', required=False)
+	parser.add_argument('-s','--secret_key', help='AWS Secret Key', required=False)
+	parser.add_argument('-p','--prefix', help='The table prefix in DynamoDB', required=False)
+	parser.add_argument('--hash_version', help='Hash version of new Audit keys', type=int, default=1, required=False)
+	parser.add_argument('--item_encoding', help='Encoding of new Audit items; switch to compact once every reader supports it',
+						choices=['full', 'compact'], default='full', required=False)
+	parser.add_argument('--read_hash_versions', help='Comma separated hash versions to query, defaults to the hash version; list every version written while migrating',
+						default=None, required=False)
+	parser.add_argument('--shard_config', help='JSON file of write shard counts, of the form {"org_id": {"service_id": shards}}',
+						default=None, required=False)
+	parser.add_argument('-w','--write_behind', help='Buffer saves and write them in the background, acknowledging on enqueue or flush',
+						choices=['enqueue', 'flush'], default=None, required=False)
+	parser.add_argument('--dead_letter', help='File to append write-behind items that cannot be written to, as JSON lines',
+						default=None, required=False)
+	parser.add_argument('--query_cache_mb', help='Megabytes of memory for caching Audit query results; 0 disables the cache',
+						type=int, default=0, required=False)
+	parser.add_argument('--rollup_interval', help='Seconds between flushes of the hourly rollup counters, e.g. 10, enabling rollups; '
+						'requires the Rollup table', type=float, default=0, required=False)
+	parser.add_argument('--blob_dir', help='Directory of the blob store for large change payloads; without it, all are held inline',
+						default=None, required=False)
+	parser.add_argument('--inline_changes_bytes', help='Compressed size above which change payloads are offloaded to the blob store',
+						type=int, default=DEFAULT_INLINE_LIMIT, required=False)
+	parser.add_argument('--idempotency_keys', help='Idempotency keys remembered by each process, per Bloom filter generation, e.g. 100000, '
+						'enabling deduplication; requires the Idempotency table', type=int, default=0, required=False)
+	parser.add_argument('--rate_limits', help='JSON object of the initial requests per second of each table, e.g. {"Audit": 5}, enabling adaptive rate limiting',
+						default=None, required=False)
 	args = parser.parse_args()
 
+	if args.backend == 'dynamodb' and not (args.region and args.access_key and args.secret_key and args.prefix):
+		parser.error('The dynamodb backend requires region, access_key, secret_key and prefix')
+
 	# Let's connect and make ourselves available
+	read_versions = [int(v) for v in args.read_hash_versions.split(',')] if args.read_hash_versions else None
+	audit.set_hash_versions(args.hash_version, read_versions)
+	audit.set_item_encoding(args.item_encoding)
+	if args.shard_config:
+		with open(args.shard_config) as f:
+			for org_id, services in json.load(f).items():
+				for service_id, shards in services.items():
+					audit.set_write_shards(org_id, service_id, shards)
 	audit.set_prefix(args.prefix)
-	audit.connect(args.region, args.access_key, args.secret_key)
 
-	# Start flask
-	app.run(debug=arg.debug)
+	def connect():
+		"""Connections and background threads don't survive a fork, so are made by each worker"""
+		if args.backend == 'dynamodb':
+			audit.connect(args.region, args.access_key, args.secret_key)
+		elif args.backend == 'sqlite':
+			audit.set_backend(create_backend('sqlite', path=args.sqlite_path))
+		else:
+			audit.set_backend(create_backend(args.backend))
+		if args.rate_limits:
+			audit.enable_rate_limiting(json.loads(args.rate_limits))
+		if args.write_behind:
+			audit.enable_write_behind(args.write_behind, dead_letter_path=args.dead_letter)
+		if args.query_cache_mb > 0:
+			audit.enable_query_cache(args.query_cache_mb * 1024 * 1024)
+		if args.rollup_interval > 0:
+			audit.enable_rollups(args.rollup_interval)
+		if args.blob_dir:
+			audit.set_blob_store(FileBlobStore(args.blob_dir), args.inline_changes_bytes)
+		if args.idempotency_keys > 0:
+			# Forked workers don't see each other's keys, so must check storage for any they haven't saved
+			audit.enable_idempotency(args.idempotency_keys, check_storage=args.prefork)
+
+	serve(args, connect)
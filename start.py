@@ -1,23 +1,45 @@
 import argparse
-from rest_api.zen_audit_api import audit
-from install.audit_install_db import create_tables
+from rest_api.zen_audit_api import audit, add_server_arguments, serve
+from audit.backends import BACKENDS, create_backend
+from install.audit_install_db import create_tables, DEFAULT_PROFILE, PROFILES
 from uuid import uuid4 as uuid
 
 if __name__ == "__main__":
 
     # Process arguments
     parser = argparse.ArgumentParser(description='This installs the DynamoDB tables required for the Audit servce')
-    parser.add_argument('-r','--region', help='DynamoDB region', required=True)
-    parser.add_argument('-k','--access_key', help='AWS Access Key', required=True)
-    parser.add_argument('-s','--secret_key', help='AWS Secret Key', required=True)
+    parser.add_argument('-b','--backend', help='Storage backend', choices=BACKENDS, default='dynamodb', required=False)
+    parser.add_argument('-f','--sqlite_path', help='Database file for the sqlite backend', default=':memory:', required=False)
+    parser.add_argument('-r','--region', help='DynamoDB region', required=False)
+    parser.add_argument('-k','--access_key', help='AWS Access Key', required=False)
+    parser.add_argument('-s','--secret_key', help='AWS Secret Key', required=False)
+    parser.add_argument('--profile', help='Provisioning profile of the DynamoDB tables', choices=sorted(PROFILES), default=DEFAULT_PROFILE, required=False)
+    add_server_arguments(parser)
     args = parser.parse_args()
 
+    if args.backend == 'dynamodb' and not (args.region and args.access_key and args.secret_key):
+        parser.error('The dynamodb backend requires region, access_key and secret_key')
+
     # New prefix each start
     prefix = str(uuid())
 
-    ret = create_tables(args.region, args.access_key, args.secret_key, prefix)
-
     audit.set_prefix(prefix)
-    audit.connect(args.region, args.access_key, args.secret_key)
+    if args.backend == 'dynamodb':
+        ret = create_tables(args.region, args.access_key, args.secret_key, prefix, profile=args.profile)
+
+    def connect():
+        # Called by each worker when serving with --prefork; the memory backend and in-memory
+        # sqlite databases are then private to each worker
+        if args.backend == 'dynamodb':
+            audit.connect(args.region, args.access_key, args.secret_key)
+        else:
+            if args.backend == 'sqlite':
+                backend = create_backend('sqlite', path=args.sqlite_path)
+            else:
+                backend = create_backend(args.backend)
+            audit.set_backend(backend)
+            backend.create_tables()
+
+    serve(args, connect)
 
 
@@ -0,0 +1,367 @@
+"""
+Load generator and latency benchmark for the audit API.
+
+Runs a number of concurrent clients against a running server, either closed-loop (each client
+sends its next request as soon as the previous one completes) or open-loop (requests are
+scheduled at a fixed arrival rate, and latency is measured from the scheduled time so that
+a slow server cannot hide its queueing delay).
+
+Organisations, services and users are drawn from Zipf distributions, so that a few of each
+receive most of the traffic.  Requests started during the warm-up period are not recorded.
+
+The results are written as JSON, one entry per operation, for comparison between runs.
+"""
+import argparse
+import json
+import math
+import random
+import requests
+import sys
+import threading
+from bisect import bisect_left
+from datetime import datetime as dt
+from time import sleep, time
+from uuid import uuid4 as uuid
+
+def get_tm(d=None):
+	if not d:
+		d = dt.utcnow()
+	return (d.toordinal() * 86400 + d.hour * 3600 + d.minute * 60 + d.second) * 1000000 + d.microsecond
+
+def get_id():
+	return str(uuid())
+
+class ZipfSelector(object):
+	"""
+	Selects items with probability proportional to 1 / rank ** skew
+	"""
+	def __init__(self, items, skew=1.1):
+		self.items = items
+		self.cumulative = []
+		total = 0.0
+		for rank in range(1, len(items) + 1):
+			total += 1.0 / rank ** skew
+			self.cumulative.append(total)
+		self.total = total
+
+	def __call__(self, rnd=random):
+		return self.items[bisect_left(self.cumulative, rnd.random() * self.total)]
+
+class LatencyHistogram(object):
+	"""
+	Log-bucketed latency histogram, in microseconds, with a relative precision of (GROWTH - 1)
+	"""
+	GROWTH = 1.02
+
+	def __init__(self):
+		self.counts = {}
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def record(self, latency):
+		latency = max(int(latency), 1)
+		bucket = int(math.log(latency) / math.log(self.GROWTH))
+		self.counts[bucket] = self.counts.get(bucket, 0) + 1
+		self.count += 1
+		self.total += latency
+		self.max = max(self.max, latency)
+
+	def merge(self, other):
+		for bucket, count in other.counts.items():
+			self.counts[bucket] = self.counts.get(bucket, 0) + count
+		self.count += other.count
+		self.total += other.total
+		self.max = max(self.max, other.max)
+
+	def _upper(self, bucket):
+		return int(math.ceil(self.GROWTH ** (bucket + 1)))
+
+	def percentile(self, pct):
+		"""
+		Returns the upper bound of the bucket holding the percentile
+		"""
+		if not self.count:
+			return None
+		threshold = self.count * pct / 100.0
+		seen = 0
+		for bucket in sorted(self.counts):
+			seen += self.counts[bucket]
+			if seen >= threshold:
+				return min(self._upper(bucket), self.max)
+		return self.max
+
+	def buckets(self):
+		"""
+		Returns [upper bound, count] pairs for the non-empty buckets
+		"""
+		return [[self._upper(bucket), self.counts[bucket]] for bucket in sorted(self.counts)]
+
+class OperationStats(object):
+	"""
+	Outcome counters and latency histogram for one operation
+	"""
+	def __init__(self):
+		self.latency = LatencyHistogram()
+		self.errors = 0
+		self.records = 0
+
+	def merge(self, other):
+		self.latency.merge(other.latency)
+		self.errors += other.errors
+		self.records += other.records
+
+	def summary(self, elapsed):
+		requests_made = self.latency.count
+		return {
+			'requests': requests_made,
+			'records': self.records,
+			'errors': self.errors,
+			'error_rate': float(self.errors) / requests_made if requests_made else 0.0,
+			'throughput': requests_made / elapsed if elapsed else 0.0,
+			'record_throughput': self.records / elapsed if elapsed else 0.0,
+			'latency_us': {
+				'mean': self.latency.total / requests_made if requests_made else None,
+				'p50': self.latency.percentile(50),
+				'p90': self.latency.percentile(90),
+				'p99': self.latency.percentile(99),
+				'p999': self.latency.percentile(99.9),
+				'max': self.latency.max,
+				'histogram': self.latency.buckets()
+			}
+		}
+
+class Workload(object):
+	"""
+	The organisations, services and users that requests are generated for
+	"""
+	def __init__(self, url_base, num_services, num_users, skew, batch_size, query_limit=100):
+		self.url_base = url_base
+		self.batch_size = batch_size
+		self.query_limit = query_limit
+		self.skew = skew
+		self.services = ZipfSelector([get_id() for _ in range(num_services)], skew)
+		self.num_users = num_users
+		self.orgs = None
+
+	def register_orgs(self, session, num_orgs):
+		"""
+		Registers the organisations that save requests are made against
+		"""
+		orgs = []
+		for _ in range(num_orgs):
+			resp = session.post(self.url('1.0/audit/org/register/'),
+						data=json.dumps(self.org_details()),
+						headers={'content-type': 'application/json'})
+			if resp.status_code != 200:
+				raise Exception('Failed to register organisation: {}'.format(resp.content))
+			org = {'id': json.loads(resp.content)['id']}
+			org['users'] = ZipfSelector([get_id() for _ in range(self.num_users)], self.skew)
+			orgs.append(org)
+		self.orgs = ZipfSelector(orgs, self.skew)
+
+	def url(self, path):
+		return '/'.join([self.url_base, path])
+
+	def org_details(self):
+		name = get_id()
+		return {
+			'name': name,
+			'contact': 'admin@{}.com'.format(name),
+			'website': 'www.{}.com'.format(name)
+		}
+
+	def record(self, org, rnd):
+		obo = org['users'](rnd)
+		actor = obo
+		if rnd.randint(0, 70) == 40:
+			# Sometimes not on own behalf
+			actor = org['users'](rnd)
+		return {
+			'timestamp': get_tm(),
+			'obo_id': obo,
+			'actor_id': actor
+		}
+
+	def request(self, op, rnd):
+		"""
+		Returns (method, url, body, record count) for a request of the operation
+		"""
+		if op == 'register':
+			return ('POST', self.url('1.0/audit/org/register/'), self.org_details(), 0)
+
+		org = self.orgs(rnd)
+		service = self.services(rnd)
+		if op == 'save':
+			return ('POST', self.url('1.0/audit/org/{}/services/{}/save/'.format(org['id'], service)),
+					self.record(org, rnd), 1)
+		elif op == 'batch':
+			return ('POST', self.url('1.0/audit/org/{}/services/{}/save/batch/'.format(org['id'], service)),
+					[self.record(org, rnd) for _ in range(self.batch_size)], self.batch_size)
+		elif op == 'query':
+			return ('GET', self.url('1.0/audit/org/{}/services/{}/records/?order=desc&limit={}'.format(
+					org['id'], service, self.query_limit)), None, 0)
+		elif op == 'user_query':
+			return ('GET', self.url('1.0/audit/org/{}/users/{}/records/?order=desc&limit={}'.format(
+					org['id'], org['users'](rnd), self.query_limit)), None, 0)
+
+		raise Exception('Unknown operation: {}'.format(op))
+
+class Client(threading.Thread):
+	"""
+	Sends requests until the benchmark ends, recording outcomes per operation.
+
+	Closed-loop clients generate their own requests; open-loop clients take scheduled
+	start times from the shared schedule.
+	"""
+	def __init__(self, bench, seed):
+		super(Client, self).__init__()
+		self.daemon = True
+		self.bench = bench
+		self.rnd = random.Random(seed)
+		self.session = requests.Session()
+		self.stats = {}
+
+	def run(self):
+		bench = self.bench
+		while True:
+			if bench.schedule is not None:
+				scheduled = bench.next_scheduled()
+				if scheduled is None:
+					return
+				delay = scheduled - time()
+				if delay > 0:
+					sleep(delay)
+			else:
+				scheduled = time()
+				if scheduled >= bench.end_time:
+					return
+
+			op = bench.mix(self.rnd)
+			method, url, body, records = bench.workload.request(op, self.rnd)
+			failed = False
+			try:
+				if body is None:
+					resp = self.session.request(method, url, timeout=bench.timeout)
+				else:
+					resp = self.session.request(method, url, data=json.dumps(body),
+								headers={'content-type': 'application/json'}, timeout=bench.timeout)
+				failed = resp.status_code != 200 or '"error_message"' in resp.content
+			except requests.RequestException:
+				failed = True
+			completed = time()
+
+			if scheduled < bench.record_from:
+				continue
+
+			stats = self.stats.setdefault(op, OperationStats())
+			stats.latency.record((completed - scheduled) * 1000000)
+			if failed:
+				stats.errors += 1
+			else:
+				stats.records += records
+
+class Benchmark(object):
+	"""
+	Runs the clients for the configured duration and collates their results
+	"""
+	def __init__(self, workload, mix, clients, duration, warmup, rate=None, timeout=10):
+		self.workload = workload
+		self.mix = mix
+		self.num_clients = clients
+		self.duration = duration
+		self.warmup = warmup
+		self.rate = rate
+		self.timeout = timeout
+		self.schedule = None
+		self._schedule_lock = threading.Lock()
+
+	def next_scheduled(self):
+		"""
+		Returns the next open-loop start time, or None once the benchmark has ended
+		"""
+		with self._schedule_lock:
+			scheduled = self.schedule
+			if scheduled >= self.end_time:
+				return None
+			self.schedule += 1.0 / self.rate
+			return scheduled
+
+	def run(self):
+		start = time()
+		self.record_from = start + self.warmup
+		self.end_time = self.record_from + self.duration
+		if self.rate:
+			self.schedule = start
+
+		clients = [Client(self, seed) for seed in range(self.num_clients)]
+		for client in clients:
+			client.start()
+		for client in clients:
+			client.join()
+
+		totals = {}
+		for client in clients:
+			for op, stats in client.stats.items():
+				totals.setdefault(op, OperationStats()).merge(stats)
+
+		return {
+			'mode': 'open' if self.rate else 'closed',
+			'clients': self.num_clients,
+			'rate': self.rate,
+			'duration': self.duration,
+			'warmup': self.warmup,
+			'operations': dict((op, stats.summary(self.duration)) for op, stats in totals.items())
+		}
+
+class OperationMix(object):
+	"""
+	Selects operations according to their relative weights, given as 'op=weight,...'
+	"""
+	def __init__(self, spec):
+		self.ops = []
+		self.cumulative = []
+		total = 0.0
+		for part in spec.split(','):
+			op, weight = part.split('=')
+			total += float(weight)
+			self.ops.append(op.strip())
+			self.cumulative.append(total)
+		self.total = total
+
+	def __call__(self, rnd):
+		return self.ops[bisect_left(self.cumulative, rnd.random() * self.total)]
+
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='This runs a load benchmark against the audit API')
+	parser.add_argument('-u','--url', help='Base URL of the API', default='http://localhost:5000', required=False)
+	parser.add_argument('-c','--clients', help='Number of concurrent clients', type=int, default=8, required=False)
+	parser.add_argument('-m','--mode', help='Closed-loop, or open-loop at a fixed arrival rate', choices=['closed', 'open'], default='closed', required=False)
+	parser.add_argument('-r','--rate', help='Requests per second, for open-loop', type=float, default=100.0, required=False)
+	parser.add_argument('-d','--duration', help='Seconds to record for', type=float, default=30.0, required=False)
+	parser.add_argument('-w','--warmup', help='Seconds to run before recording', type=float, default=5.0, required=False)
+	parser.add_argument('-x','--mix', help='Operation weights', default='save=90,batch=5,register=5', required=False)
+	parser.add_argument('--orgs', help='Number of organisations', type=int, default=50, required=False)
+	parser.add_argument('--services', help='Number of services', type=int, default=10, required=False)
+	parser.add_argument('--users', help='Number of users per organisation', type=int, default=200, required=False)
+	parser.add_argument('--skew', help='Zipf skew of org, service and user selection', type=float, default=1.1, required=False)
+	parser.add_argument('--batch_size', help='Records per batch request', type=int, default=25, required=False)
+	parser.add_argument('--query_limit', help='Records per query request', type=int, default=100, required=False)
+	parser.add_argument('-o','--output', help='File to write the JSON results to, otherwise stdout', default=None, required=False)
+	args = parser.parse_args()
+
+	workload = Workload(args.url, args.services, args.users, args.skew, args.batch_size, args.query_limit)
+	workload.register_orgs(requests.Session(), args.orgs)
+
+	bench = Benchmark(workload, OperationMix(args.mix), args.clients, args.duration, args.warmup,
+				rate=args.rate if args.mode == 'open' else None)
+	results = bench.run()
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
+	else:
+		json.dump(results, sys.stdout, indent=2, sort_keys=True)
+		print
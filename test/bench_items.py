@@ -0,0 +1,113 @@
+"""
+Size benchmark of Audit item encodings.
+
+Builds the items of the same generated records with each hash version and item encoding, and reports
+the DynamoDB item size and the capacity units that size costs: write units per record (the table and
+its org-user index, which projects every attribute), read units per thousand records queried, and
+storage.  Also reports the process memory of a record held as a dict and as an AuditRecord.  Run from
+the repository root with PYTHONPATH=. so that the audit package can be imported.
+"""
+import argparse
+import json
+import math
+import random
+import sys
+from audit.hashing import HASH_VERSIONS, KeyHasher
+from audit.record import AuditRecord
+from uuid import uuid4 as uuid
+
+# Capacity unit sizes, and the storage overhead of each index entry, in bytes
+WRITE_UNIT_SIZE = 1024
+READ_UNIT_SIZE = 4096
+INDEX_OVERHEAD = 100
+
+def attribute_size(name, value):
+	"""Returns the DynamoDB size of an attribute, following the published sizing rules"""
+	if isinstance(value, (int, long)):
+		# Roughly one byte per two significant digits, plus one
+		return len(name) + 1 + (len(str(abs(value)).rstrip('0')) + 1) // 2
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	return len(name) + len(value)
+
+def item_size(item):
+	return sum(attribute_size(name, value) for name, value in item.items())
+
+def object_size(obj):
+	"""Returns the memory of an object and of the values it holds"""
+	if isinstance(obj, dict):
+		return sys.getsizeof(obj) + sum(sys.getsizeof(name) + sys.getsizeof(value) for name, value in obj.items())
+	return sys.getsizeof(obj) + sum(sys.getsizeof(getattr(obj, name)) for name in obj.__slots__)
+
+def generate(count, users, services, other_actor):
+	"""Returns (org_id, service_id, record) tuples, with other_actor of the records made on behalf of another user"""
+	orgs = [str(uuid()) for _ in range(10)]
+	org_users = dict((org_id, [str(uuid()) for _ in range(users)]) for org_id in orgs)
+	service_ids = [str(uuid()) for _ in range(services)]
+	records = []
+	for i in range(count):
+		org_id = random.choice(orgs)
+		obo_id = random.choice(org_users[org_id])
+		actor_id = random.choice(org_users[org_id]) if random.random() < other_actor else obo_id
+		records.append((org_id, random.choice(service_ids), {
+			'timestamp': 63500000000000000 + i * 1000 + random.randint(0, 999),
+			'obo_id': obo_id,
+			'actor_id': actor_id
+		}))
+	return records
+
+def measure(records, version, encoding):
+	hasher = KeyHasher(version, [version])
+	sizes = []
+	for org_id, service_id, data in records:
+		record = AuditRecord(data['timestamp'], service_id, data['obo_id'], data['actor_id'])
+		item = record.to_item(hasher.hash((service_id, org_id)), hasher.hash((org_id, data['obo_id'])), encoding)
+		assert AuditRecord.from_item(item).to_dict() == record.to_dict()
+		sizes.append(item_size(item))
+
+	count = len(sizes)
+	total = sum(sizes)
+	write_units = sum(2 * int(math.ceil(float(size) / WRITE_UNIT_SIZE)) for size in sizes)
+	return {
+		'bytes_per_item': float(total) / count,
+		'write_units_per_record': float(write_units) / count,
+		# Queries are charged on the total size read; eventually consistent reads cost half
+		'read_units_per_1000_records': 1000.0 * total / count / (READ_UNIT_SIZE * 2),
+		'storage_mb_per_million_records': (2 * total + count * INDEX_OVERHEAD) * 1e6 / count / 1024 / 1024
+	}
+
+def run(count, users, services, other_actor):
+	records = generate(count, users, services, other_actor)
+	configurations = [('v{}-{}'.format(version, encoding), version, encoding)
+				for version, encoding in ((1, 'full'), (2, 'full'), (3, 'full'), (3, 'compact'))
+				if version in HASH_VERSIONS]
+
+	results = {'count': count, 'other_actor': other_actor, 'encodings': {}}
+	for name, version, encoding in configurations:
+		results['encodings'][name] = measure(records, version, encoding)
+
+	baseline = results['encodings']['v1-full']
+	for stats in results['encodings'].values():
+		stats['bytes_saved_per_item'] = baseline['bytes_per_item'] - stats['bytes_per_item']
+		stats['read_units_saved_pct'] = 100.0 * (1 - stats['read_units_per_1000_records'] / baseline['read_units_per_1000_records'])
+
+	org_id, service_id, data = records[0]
+	item = dict(data, service_id=service_id)
+	results['memory_bytes_per_record'] = {
+		'dict': object_size(item),
+		'AuditRecord': object_size(AuditRecord(data['timestamp'], service_id, data['obo_id'], data['actor_id']))
+	}
+	return results
+
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='This compares the sizes and capacity costs of Audit item encodings')
+	parser.add_argument('-n','--count', help='Number of records', type=int, default=100000, required=False)
+	parser.add_argument('--users', help='Number of users per organisation', type=int, default=200, required=False)
+	parser.add_argument('--services', help='Number of services', type=int, default=10, required=False)
+	parser.add_argument('--other_actor', help='Fraction of records made on behalf of another user', type=float, default=0.015, required=False)
+	args = parser.parse_args()
+
+	json.dump(run(args.count, args.users, args.services, args.other_actor), sys.stdout, indent=2, sort_keys=True)
+	print
@@ -0,0 +1,63 @@
+"""
+Microbenchmark comparing per-item and batched timestamp conversion.
+
+Converts the same values with get_tm/from_tm in a loop, and with get_tm_batch/from_tm_batch,
+and reports the time per value and the speedup.  Run from the repository root with
+PYTHONPATH=. so that the audit package can be imported.
+"""
+import argparse
+import json
+import random
+import sys
+from datetime import datetime as dt, timedelta
+from timeit import default_timer as timer
+from audit import get_tm, from_tm, get_tm_batch, from_tm_batch, np
+
+def best_of(repeat, fn):
+	"""Returns the fastest of repeat runs of fn, in seconds"""
+	best = None
+	for _ in range(repeat):
+		start = timer()
+		fn()
+		elapsed = timer() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def run(count, repeat):
+	base = dt(2015, 1, 1)
+	datetimes = [base + timedelta(microseconds=random.randint(0, 10 ** 14)) for _ in range(count)]
+	tms = [get_tm(d) for d in datetimes]
+
+	# Batched inputs are prepared outside the timings, as they would arrive from a query or export
+	batch_datetimes = np.array(datetimes, dtype='datetime64[us]') if np is not None else datetimes
+	batch_tms = np.array(tms, dtype=np.int64) if np is not None else tms
+
+	# Both paths must agree exactly before timing them
+	assert list(get_tm_batch(batch_datetimes)) == tms
+	assert [from_tm(t) for t in tms] == datetimes
+	if np is not None:
+		assert list(from_tm_batch(batch_tms).astype(dt)) == datetimes
+
+	results = {'count': count, 'numpy': np is not None}
+	for name, loop, batch in (
+			('get_tm', lambda: [get_tm(d) for d in datetimes], lambda: get_tm_batch(batch_datetimes)),
+			('from_tm', lambda: [from_tm(t) for t in tms], lambda: from_tm_batch(batch_tms))):
+		loop_time = best_of(repeat, loop)
+		batch_time = best_of(repeat, batch)
+		results[name] = {
+			'loop_ns_per_value': loop_time * 1e9 / count,
+			'batch_ns_per_value': batch_time * 1e9 / count,
+			'speedup': loop_time / batch_time if batch_time else None
+		}
+	return results
+
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='This benchmarks per-item against batched timestamp conversion')
+	parser.add_argument('-n','--count', help='Number of values to convert', type=int, default=1000000, required=False)
+	parser.add_argument('-r','--repeat', help='Runs of each conversion; the fastest is reported', type=int, default=3, required=False)
+	args = parser.parse_args()
+
+	json.dump(run(args.count, args.repeat), sys.stdout, indent=2, sort_keys=True)
+	print
@@ -0,0 +1,132 @@
+"""
+Microbenchmark comparing compiled schema validators with the original field loop.
+
+The original validation walked a list of (name, type) pairs for every payload.  This times that loop
+against the validator compiled from the same fields, for the current audit record and for a larger
+record of the kind the save payload is expected to grow into, one payload at a time and as batches.
+The compiled validator also checks string types and length limits, which the loop never did; it is
+timed with the limits the API applies, and without them for a like for like comparison.
+Payloads are decoded from JSON, as the API receives them, so their keys and strings are unicode.
+Run from the repository root with PYTHONPATH=. so that the audit package can be imported.
+"""
+import argparse
+import json
+import sys
+from timeit import default_timer as timer
+from audit.schema import Field, ValidationError, compile_schema, validate_batch
+
+def loop_validate(required_data, data):
+	"""The original _validate_data"""
+	if len(data) != len(required_data):
+		raise ValidationError('Incorrect data length supplied')
+	for field, field_type in required_data:
+		if not field in data:
+			raise ValidationError('Invalid data supplied')
+		else:
+			if field_type == 'N' and not isinstance(data[field], int):
+				raise ValidationError('Invalid data type supplied')
+
+def loop_batch(required_data, payloads):
+	"""The original per-record loop of save_batch"""
+	errors = []
+	for data in payloads:
+		try:
+			if not isinstance(data, dict):
+				raise ValidationError('Invalid data supplied')
+			loop_validate(required_data, data)
+			errors.append(None)
+		except ValidationError as e:
+			errors.append(e.message)
+	return errors
+
+RECORD_FIELDS = [('timestamp', 'N'), ('obo_id', 'S'), ('actor_id', 'S')]
+
+RECORD = {'timestamp': 63500000000000000, 'obo_id': 'f4f8c8a2-8d3e-4c1a-9a55-0d6c3e2f9b11', 'actor_id': 'f4f8c8a2-8d3e-4c1a-9a55-0d6c3e2f9b11'}
+
+# A record grown with request context; the loop checks only presence and integer types
+LARGE_FIELDS = RECORD_FIELDS + [('action', 'S'), ('resource_type', 'S'), ('resource_id', 'S'), ('client_ip', 'S'),
+				('user_agent', 'S'), ('request_id', 'S'), ('session_id', 'S'), ('sequence', 'N'), ('duration_us', 'N')]
+
+LARGE = dict(RECORD, action='update', resource_type='document', resource_id='d-1234567', client_ip='10.1.2.3',
+				user_agent='Mozilla/5.0', request_id='r-89abcdef', session_id='s-01234567', sequence=42, duration_us=1830)
+
+def best_of(repeat, fn):
+	"""Returns the fastest of repeat runs of fn, in seconds"""
+	best = None
+	for _ in range(repeat):
+		start = timer()
+		fn()
+		elapsed = timer() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def compare(name, fields, payload, count, batch_size, repeat):
+	validate = compile_schema([Field(field, field_type, max_length=1024 if field_type == 'S' else None)
+				for field, field_type in fields])
+	unlimited = compile_schema(fields)
+	payload = json.loads(json.dumps(payload))
+
+	# Invalid payloads of each kind the loop detects, so batches include the error paths
+	missing = dict(payload)
+	missing.pop(fields[-1][0])
+	renamed = dict(missing, unknown=1)
+	wrong_type = dict(payload, timestamp='x')
+	batch = ([payload] * (batch_size - 3) + [missing, renamed, wrong_type])[:batch_size]
+
+	# Both must reach the same verdicts before timing them
+	assert loop_batch(fields, batch) == validate_batch(validate, batch) == validate_batch(unlimited, batch)
+
+	def loop_single():
+		for _ in xrange(count):
+			loop_validate(fields, payload)
+
+	def compiled_single(fn):
+		def run():
+			for _ in xrange(count):
+				fn(payload)
+		return run
+
+	batches = max(count // batch_size, 1)
+
+	def loop_batches():
+		for _ in xrange(batches):
+			loop_batch(fields, batch)
+
+	def compiled_batches(fn):
+		def run():
+			for _ in xrange(batches):
+				validate_batch(fn, batch)
+		return run
+
+	results = {'fields': len(fields)}
+	for mode, loop, compiled, values in (('single', loop_single, compiled_single, count),
+				('batch', loop_batches, compiled_batches, batches * batch_size)):
+		loop_time = best_of(repeat, loop)
+		compiled_time = best_of(repeat, compiled(validate))
+		unlimited_time = best_of(repeat, compiled(unlimited))
+		results[mode] = {
+			'loop_ns_per_payload': loop_time * 1e9 / values,
+			'compiled_ns_per_payload': compiled_time * 1e9 / values,
+			'compiled_no_limits_ns_per_payload': unlimited_time * 1e9 / values,
+			'speedup': loop_time / compiled_time if compiled_time else None,
+			'speedup_no_limits': loop_time / unlimited_time if unlimited_time else None
+		}
+	return (name, results)
+
+def run(count, batch_size, repeat):
+	return dict([
+		compare('record', RECORD_FIELDS, RECORD, count, batch_size, repeat),
+		compare('large_record', LARGE_FIELDS, LARGE, count, batch_size, repeat)
+	])
+
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='This benchmarks compiled schema validators against the original field loop')
+	parser.add_argument('-n','--count', help='Number of payloads to validate', type=int, default=200000, required=False)
+	parser.add_argument('-b','--batch_size', help='Payloads per batch, including three invalid ones', type=int, default=25, required=False)
+	parser.add_argument('-r','--repeat', help='Runs of each validation; the fastest is reported', type=int, default=3, required=False)
+	args = parser.parse_args()
+
+	json.dump(run(args.count, args.batch_size, args.repeat), sys.stdout, indent=2, sort_keys=True)
+	print
@@ -0,0 +1,137 @@
+"""
+Client of the streaming ingest protocol (see audit.framing), with a load generator.
+
+Run from the repository root with PYTHONPATH=. against a server started with --stream_port.
+"""
+import argparse
+import json
+import socket
+import sys
+import time
+from uuid import uuid4 as uuid
+from audit import get_tm
+from audit.framing import STREAM_MAGIC, FrameError, FrameReader, codecs, encode_frame
+
+class StreamClient(object):
+	"""
+	Sends frames of [org_id, service_id, record] entries, waiting for acks only when the window is full.
+
+	saved counts the records acknowledged as saved, and failures lists the [seq, index, error_message]
+	of those that were not
+	"""
+	def __init__(self, host='localhost', port=5001, encoding=None):
+		available = codecs()
+		if encoding is None:
+			encoding = b'm' if b'm' in available else b'j'
+		self.codec = available[encoding]
+		self.encoding = encoding
+		self.address = (host, port)
+		self.sock = None
+		self.window = None
+		self.max_frame = None
+		self.sent = -1
+		self.acked = -1
+		self.saved = 0
+		self.failures = []
+		self._reader = None
+		self._frames = []
+
+	def connect(self):
+		self.sock = socket.create_connection(self.address)
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self._reader = FrameReader()
+		self.sock.sendall(STREAM_MAGIC + self.encoding)
+		hello = self._receive()
+		self.window = hello['window']
+		self.max_frame = hello['max_frame']
+		return self
+
+	def _receive(self):
+		while not self._frames:
+			data = self.sock.recv(65536)
+			if not data:
+				raise FrameError('Connection closed by the server')
+			self._frames.extend(self._reader.feed(data))
+		message = self.codec.loads(self._frames.pop(0))
+		if 'error' in message:
+			raise FrameError(message['error'])
+		return message
+
+	def _wait_ack(self):
+		ack = self._receive()
+		self.acked = ack['ack']
+		self.saved += ack['saved']
+		self.failures.extend(ack['failed'])
+
+	def send(self, records):
+		"""
+		Sends a frame of records, returning its sequence number
+		"""
+		while self.sent - self.acked >= self.window:
+			self._wait_ack()
+		frame = encode_frame(self.codec, records)
+		if len(frame) - 4 > self.max_frame:
+			raise FrameError('Frame of {} bytes exceeds the maximum of {}'.format(len(frame) - 4, self.max_frame))
+		self.sock.sendall(frame)
+		self.sent += 1
+		return self.sent
+
+	def flush(self):
+		"""
+		Waits until every frame sent has been acknowledged
+		"""
+		while self.acked < self.sent:
+			self._wait_ack()
+
+	def close(self):
+		if self.sock is not None:
+			self.flush()
+			self.sock.close()
+			self.sock = None
+
+def run(host, port, org_id, service_id, frames, frame_size, encoding):
+	users = [str(uuid()) for x in range(20)]
+	client = StreamClient(host, port, encoding).connect()
+	tm_start = time.time()
+	for x in xrange(frames):
+		records = []
+		for y in xrange(frame_size):
+			user = users[(x * frame_size + y) % len(users)]
+			records.append([org_id, service_id, {
+				'timestamp': get_tm(),
+				'obo_id': user,
+				'actor_id': user,
+				'idempotency_key': str(uuid())
+			}])
+		client.send(records)
+	client.close()
+	elapsed = time.time() - tm_start
+	return {
+		'encoding': client.codec.name,
+		'window': client.window,
+		'frames': frames,
+		'records': frames * frame_size,
+		'saved': client.saved,
+		'failed': len(client.failures),
+		'first_failures': client.failures[:5],
+		'seconds': elapsed,
+		'records_per_second': frames * frame_size / elapsed if elapsed else None
+	}
+
+if __name__ == "__main__":
+
+	# Process arguments
+	parser = argparse.ArgumentParser(description='This streams generated records to the streaming ingest port')
+	parser.add_argument('org_id', help='Org to save the records to')
+	parser.add_argument('service_id', help='Service to save the records to')
+	parser.add_argument('--host', help='Host of the server', default='localhost', required=False)
+	parser.add_argument('--port', help='Streaming ingest port of the server', type=int, default=5001, required=False)
+	parser.add_argument('-n','--frames', help='Number of frames to send', type=int, default=1000, required=False)
+	parser.add_argument('-s','--frame_size', help='Records per frame', type=int, default=100, required=False)
+	parser.add_argument('--json', help='Encode frames as JSON rather than msgpack', action='store_true', required=False)
+	args = parser.parse_args()
+
+	result = run(args.host, args.port, args.org_id, args.service_id, args.frames, args.frame_size,
+				b'j' if args.json else None)
+	json.dump(result, sys.stdout, indent=2, sort_keys=True)
+	print